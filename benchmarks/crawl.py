@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+from fake_registry import FakeGitLabRegistry
+from gitlab_registry_usage_rest.cache import GitLabRegistryCache
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measure the crawl time of the registry cache with a fake registry.')
+    parser.add_argument('--repositories', type=int, default=100, help='number of repositories (default: %(default)s)')
+    parser.add_argument('--tags', type=int, default=5, help='tags per repository (default: %(default)s)')
+    parser.add_argument(
+        '--latency', type=float, default=0.01, help='simulated latency per request in seconds (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=[1, 4, 8, 16], help='worker counts to compare (default: %(default)s)'
+    )
+    args = parser.parse_args()
+    with FakeGitLabRegistry(args.repositories, args.tags, latency=args.latency) as fake_registry:
+        baseline = None
+        for workers in args.workers:
+            cache = GitLabRegistryCache(
+                fake_registry.url, fake_registry.url, 'root', 'token', incremental_refresh=False, workers=workers
+            )
+            start_time = time.perf_counter()
+            cache.update()
+            duration = time.perf_counter() - start_time
+            if baseline is None:
+                baseline = duration
+            print(
+                'workers: {:3d}, crawl time: {:7.2f} s, speedup: {:5.2f}'.format(workers, duration, baseline / duration)
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+import time
+from fake_registry import FakeGitLabRegistry, FakeRegistryService
+from gitlab_registry_usage_rest.encoding import CONTENT_ENCODINGS, compress, is_content_encoding_available, orjson
+from typing import Any, Callable, Dict, List  # noqa: F401  # pylint: disable=unused-import
+
+ENDPOINTS = (
+    '/repositories',
+    '/repositories?embed=1',
+    '/repositories?embed=false&links=true',
+    '/repositories?embed=true&links=true',
+    '/repositories?embed=1&page=1&per_page=50',
+    '/namespaces?embed=1',
+    '/layers?embed=1',
+    '/export',
+    '/export?format=csv',
+    '/metrics',
+)
+
+
+def best_time(function: Callable[[], Any], rounds: int) -> float:
+    """Return the shortest of `rounds` runs of `function` in milliseconds."""
+    times = []  # type: List[float]
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return 1000 * min(times)
+
+
+def measure_endpoint(body: bytes, is_json: bool, rounds: int) -> Dict[str, Any]:
+    results = {'identity_bytes': len(body)}  # type: Dict[str, Any]
+    if is_json:
+        data = json.loads(body.decode('utf-8'))
+        results['encode_stdlib_ms'] = best_time(lambda: json.dumps(data, separators=(',', ':')).encode('utf-8'), rounds)
+        if orjson is not None:
+            results['encode_orjson_ms'] = best_time(lambda: orjson.dumps(data), rounds)
+    for content_encoding in CONTENT_ENCODINGS:
+        if not is_content_encoding_available(content_encoding):
+            continue
+        results['{}_bytes'.format(content_encoding)] = len(compress(body, content_encoding))
+        results['{}_ms'.format(content_encoding)] = best_time(lambda: compress(body, content_encoding), rounds)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Measure the bytes on the wire of every endpoint without compression and with every available '
+        'content coding, the compression time and the json encoding time of the standard json module and orjson.'
+    )
+    parser.add_argument(
+        '--repositories', type=int, default=1000, help='repositories of the fake registry (default: %(default)s)'
+    )
+    parser.add_argument('--tags', type=int, default=5, help='tags per repository (default: %(default)s)')
+    parser.add_argument('--layers', type=int, default=8, help='layers per tag (default: %(default)s)')
+    parser.add_argument(
+        '--layer-sharing', type=float, default=0.5, help='fraction of shared layers (default: %(default)s)'
+    )
+    parser.add_argument('--rounds', type=int, default=5, help='timing rounds, the best is kept (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='write the results to this json file (default: stdout)')
+    args = parser.parse_args()
+
+    results = {}  # type: Dict[str, Any]
+    with FakeGitLabRegistry(
+        args.repositories, args.tags, args.layers, args.layer_sharing
+    ) as fake_registry, FakeRegistryService(fake_registry, serve=False) as service:
+        client = service.app.test_client()
+        for endpoint in ENDPOINTS:
+            response = client.get(
+                endpoint, headers={'Authorization': 'Bearer ' + service.auth_token, 'Accept-Encoding': 'identity'}
+            )
+            if response.status_code != 200:
+                print('  {}: status {}'.format(endpoint, response.status_code), file=sys.stderr)
+                continue
+            results[endpoint] = measure_endpoint(response.get_data(), response.is_json, args.rounds)
+            print('  {}: {}'.format(endpoint, json.dumps(results[endpoint])), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
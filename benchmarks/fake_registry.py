@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import random
+import tempfile
+import threading
+import time
+from flask import abort, Flask, jsonify, Response
+from flask_jwt_extended import create_access_token
+from werkzeug.serving import BaseWSGIServer, make_server  # noqa: F401  # pylint: disable=unused-import
+from gitlab_registry_usage_rest import app as app_module, resources
+from gitlab_registry_usage_rest.config import config
+from typing import Dict, IO, List, Optional  # noqa: F401  # pylint: disable=unused-import
+
+CONFIG_TEMPLATE = '''
+[jwt]
+secret_key = fake-registry-service-secret-key-with-enough-length
+
+[registry]
+gitlab_base_url = {url}
+registry_base_url = {url}
+username = root
+access_token = token
+workers = {workers}
+
+[refresh]
+interval = 1 days
+'''
+
+
+class FakeGitLabRegistry:
+    """Local stand-in for the GitLab jwt auth api and the registry v2 api, serving a synthetic catalog.
+
+    Both apis are served from the same base url, so it can be passed as GitLab and as registry url. Every request can be
+    delayed by `latency` seconds to simulate network round trips.
+    """
+
+    def __init__(
+        self,
+        repository_count: int = 100,
+        tags_per_repository: int = 5,
+        layers_per_tag: int = 5,
+        layer_sharing: float = 0.5,
+        latency: float = 0.0,
+        seed: int = 0
+    ) -> None:
+        self._random = random.Random(seed)
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._request_count = 0
+        self._layer_sizes = {}  # type: Dict[str, int]
+        self._repositories = {}  # type: Dict[str, Dict[str, List[str]]]
+        self._layer_sharing = layer_sharing
+        # A small pool of layers (like base images) is shared between repositories, all other layers are unique
+        self._shared_layers = [self._new_layer() for _ in range(max(layers_per_tag, repository_count // 10))]
+        for i in range(repository_count):
+            repository = 'group{}/project{}'.format(i % max(repository_count // 10, 1), i)
+            self._repositories[repository] = {}
+            for j in range(tags_per_repository):
+                self.push_tag(repository, 'v{}'.format(j), layers_per_tag)
+        self._server = make_server('127.0.0.1', 0, self._create_app(), threaded=True)
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def _new_layer(self) -> str:
+        layer = 'sha256:{}'.format(hashlib.sha256(str(len(self._layer_sizes)).encode()).hexdigest())
+        self._layer_sizes[layer] = self._random.randint(1024, 64 * 1024 ** 2)
+        return layer
+
+    def push_tag(self, repository: str, tag: str, layer_count: int = 5) -> None:
+        with self._lock:
+            layers = [
+                self._random.choice(self._shared_layers)
+                if self._random.random() < self._layer_sharing else self._new_layer() for _ in range(layer_count)
+            ]
+            self._repositories.setdefault(repository, {})[tag] = list(dict.fromkeys(layers))
+
+    def delete_tag(self, repository: str, tag: str) -> None:
+        with self._lock:
+            del self._repositories[repository][tag]
+
+    def _manifest(self, repository: str, tag: str) -> bytes:
+        return json.dumps(
+            {
+                'schemaVersion': 2,
+                'mediaType': 'application/vnd.docker.distribution.manifest.v2+json',
+                'layers': [
+                    {
+                        'digest': layer,
+                        'size': self._layer_sizes[layer]
+                    } for layer in self._repositories[repository][tag]
+                ]
+            }
+        ).encode('utf-8')
+
+    def _create_app(self) -> Flask:
+        app = Flask(__name__)
+
+        @app.before_request
+        def simulate_latency() -> None:  # pylint: disable=unused-variable
+            with self._lock:
+                self._request_count += 1
+            if self._latency > 0:
+                time.sleep(self._latency)
+
+        @app.route('/jwt/auth')
+        def auth() -> Response:  # pylint: disable=unused-variable
+            return jsonify({'token': 'fake-token'})
+
+        @app.route('/v2/_catalog')
+        def catalog() -> Response:  # pylint: disable=unused-variable
+            return jsonify({'repositories': sorted(self._repositories)})
+
+        @app.route('/v2/<path:repository>/tags/list')
+        def tags(repository: str) -> Response:  # pylint: disable=unused-variable
+            if repository not in self._repositories:
+                abort(404)
+            return jsonify({'name': repository, 'tags': sorted(self._repositories[repository])})
+
+        @app.route('/v2/<path:repository>/manifests/<tag>', methods=['GET', 'HEAD'])
+        def manifest(repository: str, tag: str) -> Response:  # pylint: disable=unused-variable
+            if repository not in self._repositories or tag not in self._repositories[repository]:
+                abort(404)
+            manifest = self._manifest(repository, tag)
+            response = Response(manifest, mimetype='application/vnd.docker.distribution.manifest.v2+json')
+            response.headers['Docker-Content-Digest'] = 'sha256:{}'.format(hashlib.sha256(manifest).hexdigest())
+            return response
+
+        @app.route('/v2/<path:repository>/blobs/<layer>', methods=['HEAD'])
+        def blob(repository: str, layer: str) -> Response:  # pylint: disable=unused-variable
+            if layer not in self._layer_sizes:
+                abort(404)
+            response = Response()
+            response.headers['Content-Length'] = str(self._layer_sizes[layer])
+            return response
+
+        return app
+
+    def start(self) -> None:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> 'FakeGitLabRegistry':
+        self.start()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.stop()
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}/'.format(self._server.server_port)
+
+    @property
+    def request_count(self) -> int:
+        return self._request_count
+
+    @property
+    def repositories(self) -> Dict[str, Dict[str, List[str]]]:
+        return self._repositories
+
+
+class FakeRegistryService:
+    """The service in this process, configured for a `FakeGitLabRegistry`.
+
+    Entering the context writes a temporary config, sets up the app (which crawls the registry) and creates a jwt; with
+    `serve` the app is also served from a local threaded server. `config_sections` are appended to the config, the
+    periodic refresh runs only once a day, so benchmarks refresh explicitly.
+    """
+
+    def __init__(
+        self, fake_registry: FakeGitLabRegistry, config_sections: str = '', workers: int = 8, serve: bool = True
+    ) -> None:
+        self._fake_registry = fake_registry
+        self._config_sections = config_sections
+        self._workers = workers
+        self._serve = serve
+        self._config_file = None  # type: Optional[IO[str]]
+        self._app = None  # type: Optional[Flask]
+        self._auth_token = None  # type: Optional[str]
+        self._server = None  # type: Optional[BaseWSGIServer]
+
+    def __enter__(self) -> 'FakeRegistryService':
+        self._config_file = tempfile.NamedTemporaryFile('w', suffix='.conf')
+        self._config_file.write(
+            CONFIG_TEMPLATE.format(url=self._fake_registry.url, workers=self._workers) + self._config_sections
+        )
+        self._config_file.flush()
+        config.read_config(self._config_file.name)
+        self._app = app_module.setup_app()
+        with self._app.test_request_context():
+            self._auth_token = create_access_token(identity='benchmark')
+        if self._serve:
+            self.serve()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        resources.stop_refreshes()
+        if self._config_file is not None:
+            self._config_file.close()
+            self._config_file = None
+
+    def serve(self) -> None:
+        """Serve the app from a local threaded server (if it was entered without `serve`)."""
+        if self._server is None:
+            self._server = make_server('127.0.0.1', 0, self.app, threaded=True)
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def app(self) -> Flask:
+        assert self._app is not None
+        return self._app
+
+    @property
+    def auth_token(self) -> str:
+        assert self._auth_token is not None
+        return self._auth_token
+
+    @property
+    def base_url(self) -> str:
+        assert self._server is not None
+        return 'http://127.0.0.1:{}'.format(self._server.server_port)
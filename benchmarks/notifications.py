@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+import sys
+import time
+import requests
+from fake_registry import FakeGitLabRegistry, FakeRegistryService
+from gitlab_registry_usage_rest import resources
+from gitlab_registry_usage_rest.cache import GitLabRegistryCache
+from gitlab_registry_usage_rest.notifications import RepositoryRefreshQueue
+from typing import Any, Dict, List  # noqa: F401  # pylint: disable=unused-import
+
+NOTIFICATIONS_TOKEN = 'notifications-token'
+
+NOTIFICATIONS_CONFIG = '''
+[notifications]
+token = {token}
+delay = {delay} seconds
+'''
+
+
+def push_events(repository: str, tag: str, layer_count: int) -> List[Dict[str, Any]]:
+    """Events a registry sends for a push: one per uploaded layer and one for the manifest."""
+    events = [
+        {
+            'action': 'push',
+            'target': {
+                'mediaType': 'application/octet-stream',
+                'repository': repository,
+                'digest': 'sha256:layer{}'.format(i)
+            }
+        } for i in range(layer_count)
+    ]
+    events.append(
+        {
+            'action': 'push',
+            'target': {
+                'mediaType': 'application/vnd.docker.distribution.manifest.v2+json',
+                'repository': repository,
+                'tag': tag
+            }
+        }
+    )
+    # Pulls do not change the registry and must be ignored
+    events.append({'action': 'pull', 'target': {'repository': repository, 'tag': tag}})
+    return events
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Replay a stream of registry notifications and GitLab webhooks against the service and verify that '
+        'the targeted refreshes are coalesced and end up with the same data as a full crawl.'
+    )
+    parser.add_argument('--repositories', type=int, default=200, help='number of repositories (default: %(default)s)')
+    parser.add_argument('--bursts', type=int, default=5, help='number of notification bursts (default: %(default)s)')
+    parser.add_argument('--pushes', type=int, default=20, help='pushes per burst (default: %(default)s)')
+    parser.add_argument(
+        '--delay', type=float, default=1.0, help='coalescing delay of the service in seconds (default: %(default)s)'
+    )
+    args = parser.parse_args()
+    rng = random.Random(0)
+    errors = []  # type: List[str]
+    with FakeGitLabRegistry(args.repositories) as fake_registry, FakeRegistryService(
+        fake_registry, NOTIFICATIONS_CONFIG.format(token=NOTIFICATIONS_TOKEN, delay=args.delay)
+    ) as service:
+        gitlab_registry_cache = resources.get_registry_cache()
+        repository_refresh_queue = resources.get_registry().repository_refresh_queue
+        assert gitlab_registry_cache is not None and isinstance(repository_refresh_queue, RepositoryRefreshQueue)
+        notifications_url = service.base_url + '/admin/notifications'
+        session = requests.Session()
+        initial_generation = gitlab_registry_cache.snapshot.generation
+        initial_request_count = fake_registry.request_count
+        event_count = 0
+        start_time = time.perf_counter()
+        for burst in range(args.bursts):
+            for push in range(args.pushes):
+                repositories = sorted(fake_registry.repositories)
+                action = rng.random()
+                if action < 0.1:
+                    # A project which has never pushed an image before, announced by a GitLab pipeline webhook
+                    repository = 'group-new/project{}-{}'.format(burst, push)
+                    fake_registry.push_tag(repository, 'latest')
+                    response = session.post(
+                        notifications_url,
+                        json={
+                            'object_kind': 'pipeline',
+                            'project': {
+                                'path_with_namespace': repository
+                            }
+                        },
+                        headers={'X-Gitlab-Token': NOTIFICATIONS_TOKEN}
+                    )
+                    event_count += 1
+                else:
+                    repository = rng.choice(repositories)
+                    if action < 0.3 and len(fake_registry.repositories[repository]) > 1:
+                        tag = rng.choice(sorted(fake_registry.repositories[repository]))
+                        fake_registry.delete_tag(repository, tag)
+                        events = [{'action': 'delete', 'target': {'repository': repository, 'digest': 'sha256:0'}}]
+                    else:
+                        tag = 'b{}p{}'.format(burst, push)
+                        fake_registry.push_tag(repository, tag)
+                        events = push_events(repository, tag, 5)
+                    response = session.post(
+                        notifications_url,
+                        json={'events': events},
+                        headers={
+                            'Authorization': 'Bearer {}'.format(NOTIFICATIONS_TOKEN),
+                            'Content-Type': 'application/vnd.docker.distribution.events.v1+json'
+                        }
+                    )
+                    event_count += len(events)
+                if response.status_code != 202:
+                    errors.append(
+                        'notification for {} returned status code {}'.format(repository, response.status_code)
+                    )
+            # Let the service refresh the burst before the next one arrives
+            time.sleep(args.delay * 1.5)
+        while repository_refresh_queue.pending_count > 0 or gitlab_registry_cache.progress.is_running:
+            time.sleep(0.1)
+        duration = time.perf_counter() - start_time
+        refresh_count = gitlab_registry_cache.snapshot.generation - initial_generation
+        targeted_request_count = fake_registry.request_count - initial_request_count
+        snapshot_registry = gitlab_registry_cache.snapshot.registry
+        full_crawl_cache = GitLabRegistryCache(
+            fake_registry.url, fake_registry.url, 'root', 'token', incremental_refresh=False
+        )
+        full_crawl_request_count = fake_registry.request_count
+        full_crawl_cache.update()
+        full_crawl_request_count = fake_registry.request_count - full_crawl_request_count
+        full_crawl_registry = full_crawl_cache.snapshot.registry
+
+    if snapshot_registry.registry_catalog != full_crawl_registry.registry_catalog:
+        errors.append('the repository catalog differs from a full crawl')
+    for attribute in ('repository_sizes', 'repository_disk_sizes', 'repository_tags', 'tag_sizes'):
+        merged_values = getattr(snapshot_registry, attribute)
+        full_crawl_values = getattr(full_crawl_registry, attribute)
+        for repository in sorted(set(merged_values) | set(full_crawl_values)):
+            if merged_values.get(repository) != full_crawl_values.get(repository):
+                errors.append('{} of {} differs from a full crawl'.format(attribute, repository))
+    if refresh_count > args.bursts:
+        errors.append('{} bursts caused {} refreshes'.format(args.bursts, refresh_count))
+    print(
+        '{} events in {} bursts, {} refreshes ({:.2f} s), {} registry requests (a full crawl needs {})'.format(
+            event_count, args.bursts, refresh_count, duration, targeted_request_count, full_crawl_request_count
+        )
+    )
+    for error in errors:
+        print(error, file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
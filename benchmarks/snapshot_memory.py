@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from gitlab_registry_usage_rest.compact import CompactRegistry
+from gitlab_registry_usage_rest.registry import IncrementalGitLabRegistry
+from typing import Any, Dict, List, Optional, Tuple  # noqa: F401  # pylint: disable=unused-import
+
+MIB = 1024**2
+
+
+def synthetic_registry_dict(
+    tag_count: int, tags_per_repository: int, layers_per_tag: int, layer_sharing: float, seed: int = 0
+) -> Dict[str, Any]:
+    """Build a registry in the format of `IncrementalGitLabRegistry.to_dict`.
+
+    Like a registry which was crawled or loaded from json, every digest string is a separate object.
+    """
+    rng = random.Random(seed)
+    repository_count = max(tag_count // tags_per_repository, 1)
+    shared_layers = ['sha256:{:064x}'.format(i) for i in range(max(repository_count // 10, layers_per_tag))]
+    layer_sizes = {}  # type: Dict[str, int]
+    for layer in shared_layers:
+        layer_sizes[layer] = rng.randint(1024, 256 * MIB)
+    registry_catalog = sorted('group{}/project{}'.format(i % 100, i) for i in range(repository_count))
+    repository_layers = {}  # type: Dict[str, Optional[Dict[str, List[str]]]]
+    tag_digests = {}  # type: Dict[str, Dict[str, str]]
+    for repository in registry_catalog:
+        repository_layers[repository] = {}
+        tag_digests[repository] = {}
+        for i in range(tags_per_repository):
+            tag = 'v{}'.format(i)
+            layers = []  # type: List[str]
+            for _ in range(layers_per_tag):
+                if rng.random() < layer_sharing:
+                    layer = ''.join(rng.choice(shared_layers))
+                else:
+                    layer = 'sha256:{:064x}'.format(rng.getrandbits(256))
+                    layer_sizes[layer] = rng.randint(1024, 64 * MIB)
+                layers.append(layer)
+            repository_layers[repository][tag] = list(dict.fromkeys(layers))  # type: ignore
+            tag_digests[repository][tag] = 'sha256:{:064x}'.format(rng.getrandbits(256))
+    return {
+        'registry_catalog': registry_catalog,
+        'repository_layers': repository_layers,
+        'layer_sizes': layer_sizes,
+        'tag_digests': tag_digests,
+    }
+
+
+def primary_repository_layers(
+    repository_layers: Dict[str, Optional[Dict[str, List[str]]]]
+) -> Dict[str, Optional[Dict[str, List[str]]]]:
+    """Compute `GitLabRegistry.primary_repository_layers` in linear time (the library needs layers * tags steps)."""
+    layer_origins = {}  # type: Dict[str, Tuple[str, str, int]]
+    for repository, tag_layers in repository_layers.items():
+        for tag, layers in (tag_layers or {}).items():
+            for layer in layers:
+                layer_origin = layer_origins.get(layer)
+                if layer_origin is None or len(layers) < layer_origin[2]:
+                    layer_origins[layer] = (repository, tag, len(layers))
+    return {
+        repository: {
+            tag: [layer for layer in layers if layer_origins[layer][:2] == (repository, tag)]
+            for tag, layers in tag_layers.items()
+        } if tag_layers is not None else None
+        for repository, tag_layers in repository_layers.items()
+    }
+
+
+def traced_size() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Compare the memory usage of a crawled registry (nested dicts) with the compact snapshot structure.'
+    )
+    parser.add_argument('--tags', type=int, default=100000, help='number of tags (default: %(default)s)')
+    parser.add_argument(
+        '--tags-per-repository', type=int, default=20, help='tags per repository (default: %(default)s)'
+    )
+    parser.add_argument('--layers', type=int, default=10, help='layers per tag (default: %(default)s)')
+    parser.add_argument(
+        '--layer-sharing', type=float, default=0.5, help='share of layers from a common pool (default: %(default)s)'
+    )
+    parser.add_argument('--lookups', type=int, default=100000, help='number of timed lookups (default: %(default)s)')
+    args = parser.parse_args()
+
+    def crawled_registry() -> IncrementalGitLabRegistry:
+        return IncrementalGitLabRegistry.from_dict(
+            synthetic_registry_dict(args.tags, args.tags_per_repository, args.layers, args.layer_sharing), '', '',
+            '', ''
+        )
+
+    tracemalloc.start()
+    gitlab_registry = crawled_registry()
+    crawled_size = traced_size()
+    # The size caches the library builds on first access (the service used to read all of them)
+    gitlab_registry._primary_repository_layers = primary_repository_layers(  # pylint: disable=protected-access
+        gitlab_registry.repository_layers
+    )
+    gitlab_registry.repository_sizes  # pylint: disable=pointless-statement
+    gitlab_registry.repository_disk_sizes  # pylint: disable=pointless-statement
+    dict_size = traced_size()
+    tracemalloc.reset_peak()
+    compact_registry = CompactRegistry(gitlab_registry)
+    compaction_peak = tracemalloc.get_traced_memory()[1] - dict_size
+    # The compact registry shares the (deduplicated) name and digest strings with the crawled registry
+    del gitlab_registry
+    compact_size = traced_size()
+    tracemalloc.stop()
+
+    gitlab_registry = crawled_registry()
+    start_time = time.perf_counter()
+    CompactRegistry(gitlab_registry)
+    compact_duration = time.perf_counter() - start_time
+    gitlab_registry._primary_repository_layers = primary_repository_layers(  # pylint: disable=protected-access
+        gitlab_registry.repository_layers
+    )
+    rng = random.Random(1)
+    repository_tags = [
+        (repository, tag) for repository, tag_layers in gitlab_registry.repository_layers.items()
+        for tag in tag_layers or ()
+    ]
+    lookups = [rng.choice(repository_tags) for _ in range(args.lookups)]
+    for repository, tag in lookups[:1000]:
+        assert compact_registry.tag_disk_sizes[repository][tag] == gitlab_registry.tag_disk_sizes[repository][tag]
+    lookup_durations = []  # type: List[float]
+    for registry in (gitlab_registry, compact_registry):
+        tag_sizes = registry.tag_sizes
+        start_time = time.perf_counter()
+        for repository, tag in lookups:
+            tag_sizes[repository][tag]  # pylint: disable=pointless-statement
+        lookup_durations.append((time.perf_counter() - start_time) / len(lookups))
+
+    print(
+        '{} repositories, {} tags, {} layers'.format(
+            len(gitlab_registry.registry_catalog), len(repository_tags), len(gitlab_registry.layer_sizes)
+        )
+    )
+    print('crawled registry:             {:8.1f} MiB'.format(crawled_size / MIB))
+    print('crawled registry with sizes:  {:8.1f} MiB'.format(dict_size / MIB))
+    print(
+        'compact registry:             {:8.1f} MiB ({:.1f}x smaller)'.format(
+            compact_size / MIB, dict_size / max(compact_size, 1)
+        )
+    )
+    print('compaction:                   {:8.1f} MiB peak, {:.2f} s'.format(compaction_peak / MIB, compact_duration))
+    print(
+        'tag size lookup:              {:8.2f} us (dicts), {:.2f} us (compact)'.format(
+            lookup_durations[0] * 1e6, lookup_durations[1] * 1e6
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
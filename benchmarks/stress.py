@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import json
+import random
+import sys
+import threading
+import requests
+from fake_registry import FakeGitLabRegistry, FakeRegistryService
+from gitlab_registry_usage_rest import resources
+from typing import Any, Dict, List, Set, Tuple  # noqa: F401  # pylint: disable=unused-import
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Query the service from many threads while the registry is refreshed and verify that every '
+        'response is consistent with the snapshot generation it reports.'
+    )
+    parser.add_argument('--repositories', type=int, default=100, help='number of repositories (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=16, help='number of client threads (default: %(default)s)')
+    parser.add_argument('--refreshes', type=int, default=20, help='number of registry refreshes (default: %(default)s)')
+    args = parser.parse_args()
+    with FakeGitLabRegistry(args.repositories) as fake_registry, FakeRegistryService(fake_registry) as service:
+        repositories = sorted(fake_registry.repositories)
+        urls = ['/repositories?embed=1', '/namespaces'] + ['/repositories/{}'.format(name) for name in repositories[:5]]
+        bodies = collections.defaultdict(set)  # type: Dict[Tuple[int, str], Set[bytes]]
+        errors = []  # type: List[str]
+        lock = threading.Lock()
+        done = threading.Event()
+        request_count = 0
+
+        def query() -> None:
+            nonlocal request_count
+            session = requests.Session()
+            session.headers['Authorization'] = 'Bearer {}'.format(service.auth_token)
+            last_generation = 0
+            while not done.is_set():
+                url = random.choice(urls)
+                response = session.get(service.base_url + url)
+                generation = int(response.headers.get('X-Snapshot-Generation', 0))
+                with lock:
+                    request_count += 1
+                    if response.status_code != 200:
+                        # Error documents are not snapshot data and would break the cross-check below
+                        errors.append('{} returned status code {}'.format(url, response.status_code))
+                    else:
+                        if generation < last_generation:
+                            errors.append(
+                                '{} went back from generation {} to {}'.format(url, last_generation, generation)
+                            )
+                        bodies[(generation, url)].add(response.content)
+                last_generation = generation
+
+        def refresh() -> None:
+            gitlab_registry_cache = resources.get_registry_cache()
+            assert gitlab_registry_cache is not None
+            for i in range(args.refreshes):
+                fake_registry.push_tag(random.choice(repositories), 'stress{}'.format(i))
+                gitlab_registry_cache.update()
+            done.set()
+
+        threads = [threading.Thread(target=query) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        refresh()
+        for thread in threads:
+            thread.join()
+
+    generations = sorted(set(generation for generation, _ in bodies))
+    for (generation, url), url_bodies in sorted(bodies.items()):
+        if len(url_bodies) > 1:
+            errors.append(
+                '{} returned {} different documents for generation {}'.format(url, len(url_bodies), generation)
+            )
+    for generation in generations:
+        # The repository collection and the namespace tree are computed separately, but must agree on the total size
+        if (generation, urls[0]) in bodies and (generation, urls[1]) in bodies:
+            repositories_document = json.loads(next(iter(bodies[(generation, urls[0])])))  # type: Dict[str, Any]
+            namespaces_document = json.loads(next(iter(bodies[(generation, urls[1])])))  # type: Dict[str, Any]
+            total_size = sum(item['size'] or 0 for item in repositories_document['_embedded']['items'])
+            if total_size != namespaces_document['size']:
+                errors.append(
+                    'generation {}: repositories sum up to {} bytes, namespaces report {} bytes'.format(
+                        generation, total_size, namespaces_document['size']
+                    )
+                )
+    print('{} requests, {} snapshot generations, {} errors'.format(request_count, len(generations), len(errors)))
+    for error, count in collections.Counter(errors).items():
+        print(error if count == 1 else '{} ({} times)'.format(error, count), file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import requests
+from fake_registry import FakeGitLabRegistry, FakeRegistryService
+from gitlab_registry_usage_rest._version import __version__
+from gitlab_registry_usage_rest.cache import GitLabRegistryCache
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple  # noqa: F401  # pylint: disable=unused-import
+
+RESULTS_FORMAT_VERSION = 1
+
+# A request of an endpoint benchmark: method, path and json body
+EndpointRequest = NamedTuple(
+    'EndpointRequest', [('method', str), ('path', str), ('body', Optional[Dict[str, Any]])]
+)  # yapf: disable
+EndpointBenchmark = Callable[[random.Random], EndpointRequest]
+
+
+def endpoint_benchmarks(fake_registry: FakeGitLabRegistry) -> Dict[str, EndpointBenchmark]:
+    """Return a request factory for every endpoint of the service, parameterized endpoints get random arguments."""
+    repositories = sorted(fake_registry.repositories)
+    namespaces = sorted(set(repository.rsplit('/', 1)[0] for repository in repositories))
+    layers = sorted(
+        set(layer for tags in fake_registry.repositories.values() for tag in tags.values() for layer in tag)
+    )
+
+    def random_tag(rng: random.Random) -> Tuple[str, str]:
+        repository = rng.choice(repositories)
+        return repository, rng.choice(sorted(fake_registry.repositories[repository]))
+
+    def get(path: str) -> EndpointBenchmark:
+        return lambda rng: EndpointRequest('GET', path, None)
+
+    return {
+        'GET /repositories': get('/repositories'),
+        'GET /repositories?embed=1&page=1&per_page=50': get('/repositories?embed=1&page=1&per_page=50'),
+        'GET /repositories?embed=1': get('/repositories?embed=1'),
+        'GET /repositories/<repository>': lambda rng: EndpointRequest(
+            'GET', '/repositories/{}'.format(rng.choice(repositories)), None
+        ),
+        'GET /repositories/<repository>/tags?embed=1': lambda rng: EndpointRequest(
+            'GET', '/repositories/{}/tags?embed=1'.format(rng.choice(repositories)), None
+        ),
+        'GET /repositories/<repository>/tags/<tag>': lambda rng: EndpointRequest(
+            'GET', '/repositories/{}/tags/{}'.format(*random_tag(rng)), None
+        ),
+        'POST /repositories/_batch': lambda rng: EndpointRequest(
+            'POST', '/repositories/_batch', {'repositories': rng.sample(repositories, min(len(repositories), 100))}
+        ),
+        'POST /repositories/_batch/tags': lambda rng: EndpointRequest(
+            'POST', '/repositories/_batch/tags', {
+                'tags': [dict(zip(('repository', 'tag'), random_tag(rng))) for _ in range(100)]
+            }
+        ),
+        'GET /namespaces': get('/namespaces'),
+        'GET /namespaces/<namespace>': lambda rng: EndpointRequest(
+            'GET', '/namespaces/{}'.format(rng.choice(namespaces)), None
+        ),
+        'GET /layers': get('/layers'),
+        'GET /layers/<layer>': lambda rng: EndpointRequest('GET', '/layers/{}'.format(rng.choice(layers)), None),
+        'GET /export': get('/export'),
+        'GET /registries?embed=1': get('/registries?embed=1'),
+        'GET /metrics': get('/metrics'),
+    }
+
+
+def traced_size() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def measure_crawl(fake_registry: FakeGitLabRegistry, workers: int) -> Dict[str, Any]:
+    """Time a full crawl and an incremental refresh without registry changes."""
+    gitlab_registry_cache = GitLabRegistryCache(
+        fake_registry.url, fake_registry.url, 'root', 'token', incremental_refresh=True, workers=workers
+    )
+    results = {}  # type: Dict[str, Any]
+    for name in ('full', 'incremental'):
+        request_count = fake_registry.request_count
+        start_time = time.perf_counter()
+        gitlab_registry_cache.update()
+        results[name] = {
+            'seconds': time.perf_counter() - start_time,
+            'registry_requests': fake_registry.request_count - request_count
+        }
+    return results
+
+
+def measure_endpoint(
+    base_url: str, auth_token: str, endpoint_benchmark: EndpointBenchmark, request_count: int, thread_count: int
+) -> Dict[str, Any]:
+    """Send `request_count` requests from `thread_count` threads and summarize latencies and throughput."""
+    latencies = []  # type: List[float]
+    response_sizes = []  # type: List[int]
+    errors = []  # type: List[int]
+    lock = threading.Lock()
+
+    def query(thread_index: int, thread_request_count: int) -> None:
+        rng = random.Random(thread_index)
+        session = requests.Session()
+        session.headers['Authorization'] = 'Bearer {}'.format(auth_token)
+        for _ in range(thread_request_count):
+            endpoint_request = endpoint_benchmark(rng)
+            start_time = time.perf_counter()
+            response = session.request(
+                endpoint_request.method, base_url + endpoint_request.path, json=endpoint_request.body
+            )
+            latency = time.perf_counter() - start_time
+            with lock:
+                latencies.append(latency)
+                response_sizes.append(len(response.content))
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+
+    threads = [
+        threading.Thread(target=query, args=(i, request_count // thread_count + (i < request_count % thread_count)))
+        for i in range(thread_count)
+    ]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start_time
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput': len(latencies) / duration,
+        'latency_mean_ms': 1000 * sum(latencies) / len(latencies),
+        'latency_p50_ms': 1000 * percentile(latencies, 0.5),
+        'latency_p90_ms': 1000 * percentile(latencies, 0.9),
+        'latency_p99_ms': 1000 * percentile(latencies, 0.99),
+        'response_bytes_mean': sum(response_sizes) / len(response_sizes),
+    }
+
+
+def run_benchmarks(repository_count: int, args: argparse.Namespace) -> Dict[str, Any]:
+    print('{} repositories:'.format(repository_count), file=sys.stderr)
+    with FakeGitLabRegistry(
+        repository_count, args.tags, args.layers, args.layer_sharing, args.latency
+    ) as fake_registry:
+        results = {
+            'repositories': repository_count,
+            'tags': sum(len(tags) for tags in fake_registry.repositories.values()),
+            'crawl': measure_crawl(fake_registry, args.workers),
+        }  # type: Dict[str, Any]
+        print('  crawl: {}'.format(json.dumps(results['crawl'])), file=sys.stderr)
+        service = FakeRegistryService(fake_registry, workers=args.workers, serve=False)
+        # The service crawls the registry on startup, so this traces the memory needed for the first snapshot
+        tracemalloc.start()
+        baseline_size = traced_size()
+        with service:
+            results['memory'] = {
+                'service_bytes': traced_size() - baseline_size,
+                'startup_peak_bytes': tracemalloc.get_traced_memory()[1] - baseline_size,
+            }
+            tracemalloc.stop()
+            print('  memory: {}'.format(json.dumps(results['memory'])), file=sys.stderr)
+            service.serve()
+            results['endpoints'] = {}
+            for name, endpoint_benchmark in endpoint_benchmarks(fake_registry).items():
+                if args.endpoints and not any(endpoint in name for endpoint in args.endpoints):
+                    continue
+                results['endpoints'][name] = measure_endpoint(
+                    service.base_url, service.auth_token, endpoint_benchmark, args.requests, args.threads
+                )
+                print(
+                    '  {}: {:.1f} requests/s, p50 {:.2f} ms, p99 {:.2f} ms'.format(
+                        name, results['endpoints'][name]['throughput'], results['endpoints'][name]['latency_p50_ms'],
+                        results['endpoints'][name]['latency_p99_ms']
+                    ),
+                    file=sys.stderr
+                )
+    return results
+
+
+def flatten_metrics(run_results: Dict[str, Any]) -> Dict[str, Tuple[float, bool]]:
+    """Map metric names to their value and whether a higher value is better."""
+    metrics = {}  # type: Dict[str, Tuple[float, bool]]
+    for name, crawl_results in run_results['crawl'].items():
+        metrics['crawl {} seconds'.format(name)] = (crawl_results['seconds'], False)
+    # The startup peak depends on the timing of the crawler threads and is too noisy to compare
+    metrics['memory service_bytes'] = (run_results['memory']['service_bytes'], False)
+    for endpoint, endpoint_results in run_results['endpoints'].items():
+        metrics['{} throughput'.format(endpoint)] = (endpoint_results['throughput'], True)
+        metrics['{} latency_p50_ms'.format(endpoint)] = (endpoint_results['latency_p50_ms'], False)
+        metrics['{} latency_p99_ms'.format(endpoint)] = (endpoint_results['latency_p99_ms'], False)
+    return metrics
+
+
+def compare_results(baseline: Dict[str, Any], results: Dict[str, Any], max_regression: float) -> List[str]:
+    """Print the relative change of every metric measured in both result sets and return the regressions."""
+    regressions = []  # type: List[str]
+    baseline_runs = {run_results['repositories']: run_results for run_results in baseline['runs']}
+    for run_results in results['runs']:
+        if run_results['repositories'] not in baseline_runs:
+            continue
+        baseline_metrics = flatten_metrics(baseline_runs[run_results['repositories']])
+        print('{} repositories (baseline: version {}):'.format(run_results['repositories'], baseline['version']))
+        for name, (value, higher_is_better) in flatten_metrics(run_results).items():
+            if name not in baseline_metrics or baseline_metrics[name][0] == 0:
+                continue
+            change = value / baseline_metrics[name][0] - 1
+            regression = -change if higher_is_better else change
+            print(
+                '  {:60s} {:14.2f} {:+7.1%}{}'.format(name, value, change, ' !' if regression > max_regression else '')
+            )
+            if regression > max_regression:
+                regressions.append('{} repositories: {}'.format(run_results['repositories'], name))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Run the service against a fake GitLab registry and measure crawl time, snapshot memory and the '
+        'latency and throughput of every endpoint. The results are written as json and can be compared with the '
+        'results of another version.'
+    )
+    parser.add_argument(
+        '--repositories',
+        type=int,
+        nargs='+',
+        default=[1000],
+        help='numbers of repositories to benchmark (default: %(default)s)'
+    )
+    parser.add_argument('--tags', type=int, default=5, help='tags per repository (default: %(default)s)')
+    parser.add_argument('--layers', type=int, default=5, help='layers per tag (default: %(default)s)')
+    parser.add_argument(
+        '--layer-sharing', type=float, default=0.5, help='share of layers from a common pool (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.0, help='simulated latency per request in seconds (default: %(default)s)'
+    )
+    parser.add_argument('--workers', type=int, default=8, help='number of crawler workers (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=8, help='number of client threads (default: %(default)s)')
+    parser.add_argument(
+        '--endpoints', nargs='+', help='only benchmark endpoints whose name contains one of these strings'
+    )
+    parser.add_argument('-o', '--output', help='write the results to this json file (default: stdout)')
+    parser.add_argument('--compare', help='compare the results with a json file of a previous run')
+    parser.add_argument(
+        '--max-regression',
+        type=float,
+        default=0.2,
+        help='relative regression of a metric which makes the comparison fail (default: %(default)s)'
+    )
+    args = parser.parse_args()
+    parameters = {
+        key: value
+        for key, value in vars(args).items() if key not in ('repositories', 'output', 'compare', 'max_regression')
+    }
+    results = {
+        'format_version': RESULTS_FORMAT_VERSION,
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'parameters': parameters,
+        'runs': [run_benchmarks(repository_count, args) for repository_count in args.repositories],
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('parameters') != parameters:
+            print('warning: the baseline was measured with different parameters', file=sys.stderr)
+        regressions = compare_results(baseline, results, args.max_regression)
+        for regression in regressions:
+            print('regression: {}'.format(regression), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 
 import argparse
 import os
+import signal
 import sys
 from cheroot import wsgi
 from flask import Flask
@@ -12,13 +13,20 @@ from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from . import resources
 from .config import Config, config, DEFAULT_CONFIG_FILENAME
 from ._version import __version__, __version_info__  # noqa: F401 # pylint: disable=unused-import
-from typing import cast, Any, AnyStr, Callable
+from typing import cast, Any, AnyStr, Callable, List, Optional
+
+SERVER_TYPES = ('wsgi', 'asgi', 'prefork')
+REFRESH_STOP_TIMEOUT = 10.0
 
 
 class ConfigFileNotAccessibleError(Exception):
     pass
 
 
+class InvalidServerTypeError(Exception):
+    pass
+
+
 class AttributeDict(dict):
     def __getattr__(self, attr: str) -> Any:
         return self[attr]
@@ -27,7 +35,7 @@ class AttributeDict(dict):
         self[attr] = value
 
 
-def setup_app() -> Flask:
+def setup_app(shared_snapshot_filename: Optional[str] = None, refresh_request_queue: Optional[Any] = None) -> Flask:
     app = Flask(__name__)
     # `PROPAGATE_EXCEPTIONS` must be set explicitly, otherwise jwt error handling won't work with flask-restful in
     # production mode
@@ -37,10 +45,18 @@ def setup_app() -> Flask:
     app.config['JWT_SECRET_KEY'] = config.jwt_secret_key
     CORS(app)
     JWTManager(app)
-    resources.init_resources(app)
+    resources.init_resources(app, shared_snapshot_filename, refresh_request_queue)
     return app
 
 
+def create_wsgi_server(app: Flask, reuse_port: bool = False) -> wsgi.Server:
+    return wsgi.Server(
+        (config.socket_host, config.socket_port),
+        wsgi.PathInfoDispatcher({config.server_prefix: app}),
+        reuse_port=reuse_port
+    )
+
+
 def get_argumentparser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -91,18 +107,37 @@ def main() -> None:
         Config.write_default_config(sys.stdout)
         sys.exit(0)
     config.read_config(args.config_filename)
+    if config.server not in SERVER_TYPES:
+        raise InvalidServerTypeError(
+            'The server type must be one of {}, got "{}".'.format(', '.join(SERVER_TYPES), config.server)
+        )
+    if config.server == 'prefork' and not config.debug:
+        # The main process only refreshes the registry, the app is set up in the worker processes
+        from .prefork import serve as serve_prefork
+        serve_prefork(args.config_filename, config.processes)
+        return
     app = setup_app()
     if config.debug:
         if config.server_prefix != '/':
             app = DispatcherMiddleware(Flask('debugging_frontend'), {config.server_prefix: app})  # type: ignore
         run_simple(config.socket_host, config.socket_port, app, use_debugger=True, use_reloader=True)  # type: ignore
+    elif config.server == 'asgi':
+        from .asgi import AsyncRefreshScheduler, serve
+        try:
+            serve(
+                app, cast(List[AsyncRefreshScheduler], resources.get_refresh_schedulers()), config.socket_host,
+                config.socket_port, config.server_prefix
+            )
+        finally:
+            resources.stop_refreshes(REFRESH_STOP_TIMEOUT)
     else:
-        wsgi_server = wsgi.Server(
-            (config.socket_host, config.socket_port), wsgi.PathInfoDispatcher({
-                config.server_prefix: app
-            })
-        )
-        wsgi_server.safe_start()
+        wsgi_server = create_wsgi_server(app)
+        # `safe_start` stops the server gracefully on `SystemExit`
+        signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+        try:
+            wsgi_server.safe_start()
+        finally:
+            resources.stop_refreshes(REFRESH_STOP_TIMEOUT)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from flask import Flask
+from .async_registry import AsyncIncrementalGitLabRegistry
+from .cache import GitLabRegistryCache
+from .registry import RefreshCancelledError
+from .scheduler import RefreshScheduler
+from typing import cast, Any, Awaitable, Callable, Dict, Optional, Sequence  # noqa: F401
+
+logger = logging.getLogger(__name__)
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# Triggers and stop requests of the refresh scheduler come from other threads, the event loop polls for them
+SCHEDULER_POLL_INTERVAL = 1.0
+
+
+class AsyncGitLabRegistryCache(GitLabRegistryCache):
+    """Registry cache which crawls the registry on an event loop.
+
+    Blocking callers (like the initial crawl on startup) get their own event loop, the ASGI server runs the periodic
+    refresh with an `AsyncRefreshScheduler` on its event loop.
+    """
+
+    registry_class = AsyncIncrementalGitLabRegistry
+
+    async def _update_async(self) -> None:
+        gitlab_registry = cast(AsyncIncrementalGitLabRegistry, self._new_registry())
+        self._running_registry = gitlab_registry
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        await gitlab_registry.update_async()
+        # Indexing and saving are cpu and disk bound, run them in a thread to keep the event loop responsive
+        await loop.run_in_executor(None, self._finish_update, gitlab_registry, loop.time() - start_time)
+
+    def _update(self) -> None:
+        asyncio.run(self._update_async())
+
+    async def update_if_idle_async(self) -> bool:
+        """Refresh the registry unless a refresh is already running; return whether a refresh was run."""
+        if not self._begin_update(blocking=False):
+            return False
+        try:
+            await self._update_async()
+        except Exception as e:
+            self._record_failure(e)
+            raise
+        finally:
+            self._end_update()
+        return True
+
+
+class AsyncRefreshScheduler(RefreshScheduler):
+    """Refresh scheduler which runs on an event loop (with `run_async`) instead of a thread."""
+
+    async def run_async(self) -> None:
+        gitlab_registry_cache = cast(AsyncGitLabRegistryCache, self._gitlab_registry_cache)
+        self._schedule_next_refresh(self._first_delay())
+        while True:
+            await asyncio.sleep(min(max(self._next_refresh_time_or_now - time.time(), 0), SCHEDULER_POLL_INTERVAL))
+            if self._stop_event.is_set():
+                return
+            if time.time() < self._next_refresh_time_or_now:
+                continue
+            try:
+                is_run = await gitlab_registry_cache.update_if_idle_async()
+            except RefreshCancelledError:
+                return
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception('Registry refresh failed')
+                self._refreshed(True, e)
+                continue
+            self._refreshed(is_run)
+
+
+class AsgiApplication:
+    """Serves a WSGI app in a thread pool and refreshes the registry caches on the event loop of the ASGI server.
+
+    Idle (keep-alive) connections are handled by the event loop and do not occupy one of the `threads`. The refreshes
+    of different registries run concurrently.
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        refresh_schedulers: Sequence[AsyncRefreshScheduler],
+        server_prefix: str = '/',
+        threads: int = 10
+    ) -> None:
+        self._wsgi_application = WSGIMiddleware(app, workers=threads)  # type: ignore
+        self._refresh_schedulers = refresh_schedulers
+        self._root_path = server_prefix.rstrip('/')
+        self._refresh_task = None  # type: Optional[asyncio.Future[Any]]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if self._root_path:
+            # Mount the app below the server prefix like the `PathInfoDispatcher` of the WSGI server does
+            if scope['path'] != self._root_path and not scope['path'].startswith(self._root_path + '/'):
+                await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            scope = dict(scope, root_path=self._root_path)
+        await self._wsgi_application(scope, receive, send)  # type: ignore
+
+    async def _lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._refresh_task = asyncio.gather(
+                    *(refresh_scheduler.run_async() for refresh_scheduler in self._refresh_schedulers)
+                )
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._refresh_task is not None:
+                    # Cancel running crawls, the schedulers stop after the repositories in progress
+                    for refresh_scheduler in self._refresh_schedulers:
+                        refresh_scheduler.stop()
+                    self._refresh_task.cancel()
+                    try:
+                        await self._refresh_task
+                    except asyncio.CancelledError:
+                        pass
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def serve(
+    app: Flask, refresh_schedulers: Sequence[AsyncRefreshScheduler], host: str, port: int, server_prefix: str = '/'
+) -> None:
+    uvicorn.run(AsgiApplication(app, refresh_schedulers, server_prefix), host=host, port=port, lifespan='on')
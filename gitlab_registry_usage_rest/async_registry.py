@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import aiohttp
+from gitlab_registry_usage.registry.low_level_api import (
+    AuthTokenError,
+    LayerSizeReadError,
+    LayersReadError,
+    TagsReadError,
+)
+from .registry import (
+    ApiRequest,
+    HttpResponse,
+    IncrementalGitLabRegistry,
+    MAX_RETRIES,
+    RegistryApi,
+    RegistryServerError,
+    RepositoryCrawl,
+    RepositoryResult,
+    RETRY_BACKOFF_FACTOR,
+    RETRY_STATUS_CODES,
+)
+from typing import cast, Any, Dict, List, Mapping, Optional, Tuple, Type  # noqa: F401
+
+logger = logging.getLogger(__name__)
+
+# Like `REPOSITORY_ERRORS`, with the exceptions of `aiohttp` instead of `requests`
+ASYNC_REPOSITORY_ERRORS = (
+    AuthTokenError, LayerSizeReadError, RegistryServerError, aiohttp.ClientError, asyncio.TimeoutError
+)  # type: Tuple[Type[Exception], ...]
+
+
+class AsyncRegistryClient:
+    """asyncio counterpart of `RegistryClient`, all requests share one connection pool of `pool_size` connections.
+
+    Must be created and used inside a running event loop.
+    """
+
+    def __init__(self, gitlab_url: str, registry_url: str, username: str, password: str, pool_size: int = 10) -> None:
+        self._api = RegistryApi(gitlab_url, registry_url)
+        self._auth = aiohttp.BasicAuth(username, password)
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size))
+        self._request_count = 0
+
+    async def close(self) -> None:
+        await self._session.close()
+
+    @property
+    def request_count(self) -> int:
+        return self._request_count
+
+    async def _request(self, api_request: ApiRequest) -> HttpResponse:
+        # Same retry policy as the urllib3 `Retry` of the synchronous client
+        for retry in range(MAX_RETRIES + 1):
+            if retry > 0:
+                await asyncio.sleep(RETRY_BACKOFF_FACTOR * 2**(retry - 1))
+            try:
+                async with self._session.request(
+                    api_request.method,
+                    api_request.url,
+                    headers=api_request.headers,
+                    auth=self._auth if api_request.basic_auth else None,
+                    allow_redirects=False
+                ) as response:
+                    content = await response.read()
+                    if response.status in RETRY_STATUS_CODES and retry < MAX_RETRIES:
+                        continue
+                    # Count requests like the synchronous client, which does not see retries
+                    self._request_count += 1
+                    return HttpResponse(response.status, response.headers, content)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if retry == MAX_RETRIES:
+                    raise
+        raise AssertionError('unreachable')
+
+    async def _call(self, api_request: ApiRequest) -> Any:
+        result = api_request  # type: Any
+        while isinstance(result, ApiRequest):
+            result = result.parse(await self._request(result))
+        return result
+
+    async def get_catalog_auth_token(self) -> str:
+        return cast(str, await self._call(self._api.catalog_auth_token()))
+
+    async def get_repository_auth_token(self, repository: str) -> str:
+        return cast(str, await self._call(self._api.repository_auth_token(repository)))
+
+    async def get_registry_catalog(self, auth_token: str) -> List[str]:
+        return cast(List[str], await self._call(self._api.registry_catalog(auth_token)))
+
+    async def get_repository_tags(self, auth_token: str, repository: str) -> List[str]:
+        return cast(List[str], await self._call(self._api.repository_tags(auth_token, repository)))
+
+    async def get_tag_digest(self, auth_token: str, repository: str, tag: str) -> Optional[str]:
+        return cast(Optional[str], await self._call(self._api.tag_digest(auth_token, repository, tag)))
+
+    async def get_tag_layers(self, auth_token: str, repository: str, tag: str) -> Dict[str, Optional[int]]:
+        return cast(Dict[str, Optional[int]], await self._call(self._api.tag_layers(auth_token, repository, tag)))
+
+    async def get_layer_size(self, auth_token: str, repository: str, layer: str) -> int:
+        return cast(int, await self._call(self._api.layer_size(auth_token, repository, layer)))
+
+
+class AsyncIncrementalGitLabRegistry(IncrementalGitLabRegistry):
+    """Registry which is crawled with `update_async` on an event loop instead of a thread pool.
+
+    `workers` is the number of repositories which are processed concurrently.
+    """
+
+    async def update_async(self) -> None:
+        self.clear()
+        self._repository_layers, self._layer_sizes = await self._get_repository_layers_and_layer_sizes_async()
+        self._previous_registry = None
+
+    async def _process_repository_async(
+        self,
+        client: AsyncRegistryClient,
+        repository: str,
+        previous_tag_layers: Mapping[str, List[str]],
+        previous_tag_digests: Mapping[str, str],
+        previous_layer_sizes: Mapping[str, int],
+    ) -> RepositoryResult:
+        """Like `_process_repository`, with the requests of `AsyncRegistryClient`."""
+        self._check_cancelled()
+        logger.info('Processing repository "%s"', repository)
+        repository_auth_token = await client.get_repository_auth_token(repository)
+        crawl = RepositoryCrawl(previous_tag_layers, previous_tag_digests, previous_layer_sizes)
+        try:
+            repository_tags = await client.get_repository_tags(repository_auth_token, repository)
+            for tag in repository_tags:
+                tag_digest = None  # type: Optional[str]
+                if self._incremental:
+                    tag_digest = await client.get_tag_digest(repository_auth_token, repository, tag)
+                if crawl.reuse_tag(tag, tag_digest):
+                    continue
+                tag_layers = await client.get_tag_layers(repository_auth_token, repository, tag)
+                for layer in crawl.add_tag_layers(tag, tag_layers):
+                    crawl.add_layer_size(layer, await client.get_layer_size(repository_auth_token, repository, layer))
+        except (TagsReadError, LayersReadError):
+            return crawl.unreadable_result()
+        return crawl.result(repository_tags)
+
+    async def _get_repository_layers_and_layer_sizes_async(
+        self,
+    ) -> Tuple[Dict[str, Optional[Dict[str, List[str]]]], Dict[str, int]]:
+        previous_repository_layers, previous_tag_digests, previous_layer_sizes = self._previous_state()
+        client = AsyncRegistryClient(
+            self._gitlab_url, self._registry_url, self._admin_username, self._admin_auth_token, self._workers
+        )
+        try:
+            if self._registry_catalog is None:
+                self._registry_catalog = await client.get_registry_catalog(await client.get_catalog_auth_token())
+            semaphore = asyncio.Semaphore(self._workers)
+
+            async def process_repository(repository: str) -> RepositoryResult:
+                async with semaphore:
+                    try:
+                        repository_result = await self._process_repository_async(
+                            client, repository,
+                            previous_repository_layers.get(repository) or {},
+                            previous_tag_digests.get(repository, {}), previous_layer_sizes
+                        )
+                    except ASYNC_REPOSITORY_ERRORS as e:
+                        repository_result = self._failed_repository_result(
+                            repository, e, previous_repository_layers, previous_tag_digests, previous_layer_sizes
+                        )
+                    self._count_processed_repository()
+                    return repository_result
+
+            repository_results = await asyncio.gather(
+                *(process_repository(repository) for repository in self._registry_catalog)
+            )
+        finally:
+            await client.close()
+        return self._collect_repository_results(list(repository_results), client.request_count)
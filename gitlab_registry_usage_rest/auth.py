@@ -1,23 +1,171 @@
+import contextlib
+import datetime
+import hashlib
+import hmac
+import os
+import threading
+import time
 import ldap3
+from collections import OrderedDict
 from flask import g
 from flask_httpauth import HTTPBasicAuth
 from flask_jwt_extended import create_access_token
+from ldap3.core.exceptions import LDAPException
 from .config import config
-from typing import cast
+from typing import cast, Iterator, List, NamedTuple, Optional  # noqa: F401  # pylint: disable=unused-import
 
 http_basic_auth = HTTPBasicAuth()
 
+AuthStatistics = NamedTuple(
+    'AuthStatistics', [
+        ('cache_hits', int), ('cache_misses', int), ('ldap_verifications', int),
+        ('ldap_verification_seconds', float)
+    ]
+)
+
+
+class LdapConnectionPool:
+    """Pool of open anonymous LDAP connections which are reused to search users.
+
+    Only the bind with the user credentials needs a new connection (and TLS handshake) per verification.
+    """
+
+    def __init__(self, ldap_url: str, max_size: int = 4) -> None:
+        self._server = ldap3.Server(ldap_url, use_ssl=True)
+        self._max_size = max_size
+        self._idle_connections = []  # type: List[ldap3.Connection]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[ldap3.Connection]:
+        with self._lock:
+            ldap_connection = self._idle_connections.pop() if self._idle_connections else None
+        if ldap_connection is None:
+            ldap_connection = ldap3.Connection(self._server)
+            ldap_connection.open()
+        try:
+            yield ldap_connection
+        except BaseException:
+            # The connection may be broken, so do not hand it out again
+            ldap_connection.unbind()
+            raise
+        with self._lock:
+            if not ldap_connection.closed and len(self._idle_connections) < self._max_size:
+                self._idle_connections.append(ldap_connection)
+                return
+        ldap_connection.unbind()
+
+    @property
+    def server(self) -> ldap3.Server:
+        return self._server
+
+
+class VerificationCache:
+    """Remembers successful credential verifications for `ttl`, bounded to `max_size` entries by LRU eviction.
+
+    Credentials are only stored as hashes with a random salt that is created per process.
+    """
+
+    def __init__(self, ttl: datetime.timedelta, max_size: int = 1000) -> None:
+        self._ttl = ttl.total_seconds()
+        self._max_size = max_size
+        self._salt = os.urandom(16)
+        self._expiration_times = OrderedDict()  # type: OrderedDict[bytes, float]
+        self._lock = threading.Lock()
+
+    def _key(self, username: str, password: str) -> bytes:
+        return hmac.new(self._salt, '{}\0{}'.format(username, password).encode('utf-8'), hashlib.sha256).digest()
+
+    def contains(self, username: str, password: str) -> bool:
+        key = self._key(username, password)
+        with self._lock:
+            expiration_time = self._expiration_times.get(key)
+            if expiration_time is None:
+                return False
+            if expiration_time < time.monotonic():
+                del self._expiration_times[key]
+                return False
+            self._expiration_times.move_to_end(key)
+            return True
+
+    def add(self, username: str, password: str) -> None:
+        if self._ttl <= 0 or self._max_size <= 0:
+            return
+        key = self._key(username, password)
+        with self._lock:
+            self._expiration_times[key] = time.monotonic() + self._ttl
+            self._expiration_times.move_to_end(key)
+            while len(self._expiration_times) > self._max_size:
+                self._expiration_times.popitem(last=False)
+
+
+_ldap_connection_pool = None  # type: Optional[LdapConnectionPool]
+_verification_cache = None  # type: Optional[VerificationCache]
+_init_lock = threading.Lock()
+_statistics_lock = threading.Lock()
+_auth_statistics = AuthStatistics(0, 0, 0, 0.0)
+
+
+def _count(cache_hit: bool, ldap_verification_seconds: Optional[float] = None) -> None:
+    # One LDAP verification consists of a search (on a pooled connection) and a bind
+    global _auth_statistics
+    with _statistics_lock:
+        cache_hits, cache_misses, ldap_verifications, total_ldap_verification_seconds = _auth_statistics
+        if cache_hit:
+            cache_hits += 1
+        else:
+            cache_misses += 1
+        if ldap_verification_seconds is not None:
+            ldap_verifications += 1
+            total_ldap_verification_seconds += ldap_verification_seconds
+        _auth_statistics = AuthStatistics(cache_hits, cache_misses, ldap_verifications, total_ldap_verification_seconds)
+
+
+def auth_statistics() -> AuthStatistics:
+    """Return the verification cache hits and misses and the number and total duration of LDAP verifications."""
+    return _auth_statistics
+
+
+def _init_ldap() -> None:
+    global _ldap_connection_pool, _verification_cache
+    with _init_lock:
+        if _ldap_connection_pool is None:
+            ldap_url = config.ldap_host
+            if not ldap_url.startswith('ldaps://'):
+                ldap_url = 'ldaps://{}'.format(ldap_url)
+            _ldap_connection_pool = LdapConnectionPool(ldap_url, config.ldap_pool_size)
+            _verification_cache = VerificationCache(config.ldap_cache_ttl, config.ldap_cache_size)
+
 
 def create_jwt() -> str:
     return cast(str, create_access_token(identity=g.username))
 
 
+def _search_user_dn(ldap_connection_pool: LdapConnectionPool, search_string: str) -> Optional[str]:
+    for attempt in range(2):
+        try:
+            with ldap_connection_pool.connection() as ldap_connection:
+                success = ldap_connection.search(config.ldap_base_dn, search_string)
+                # select user_dn string of first user found (if exactly one user is found) for given uid and groupId
+                if success and len(ldap_connection.entries) == 1:
+                    return cast(str, ldap_connection.entries[0].entry_dn)
+                return None
+        except LDAPException:
+            # A pooled connection may have been closed by the server in the meantime, retry once with a new one
+            if attempt > 0:
+                raise
+    return None
+
+
 @http_basic_auth.verify_password  # type: ignore
 def _verify_password(username: str, password: str) -> bool:
-    ldap_url = config.ldap_host
-    if not ldap_url.startswith('ldaps://'):
-        ldap_url = 'ldaps://{}'.format(ldap_url)
-    base_dn = config.ldap_base_dn
+    _init_ldap()
+    ldap_connection_pool = cast(LdapConnectionPool, _ldap_connection_pool)
+    verification_cache = cast(VerificationCache, _verification_cache)
+    if verification_cache.contains(username, password):
+        _count(cache_hit=True)
+        g.username = username
+        return True
     valid_gid = config.ldap_valid_gid
     username_attribute = config.ldap_username_attribute
     gid_attribute = config.ldap_gid_attribute
@@ -26,20 +174,19 @@ def _verify_password(username: str, password: str) -> bool:
     else:
         search_string = '(&({}={}))'.format(username_attribute, username)
     is_verified = False
+    start_time = time.perf_counter()
     try:
-        ldap_server = ldap3.Server(ldap_url, use_ssl=True)
-        ldap_connection = ldap3.Connection(ldap_server)
-        ldap_connection.open()
-        success = ldap_connection.search(base_dn, search_string)
-        if success:
-            # select user_dn string of first user found (if exactly one user is found) for given uid and groupId
-            if len(ldap_connection.entries) == 1:
-                user_dn = ldap_connection.entries[0].entry_dn
-                # try to bind with credentials. throws exception if credentials are invalid
-                ldap_connection.unbind()
-                ldap_connection = ldap3.Connection(ldap_server, user_dn, password)
+        user_dn = _search_user_dn(ldap_connection_pool, search_string)
+        if user_dn is not None:
+            # try to bind with credentials. throws exception if credentials are invalid
+            ldap_connection = ldap3.Connection(ldap_connection_pool.server, user_dn, password)
+            try:
                 is_verified = ldap_connection.bind()
-                g.username = username
+            finally:
+                ldap_connection.unbind()
     finally:
-        ldap_connection.unbind()
+        _count(cache_hit=False, ldap_verification_seconds=time.perf_counter() - start_time)
+    if is_verified:
+        verification_cache.add(username, password)
+        g.username = username
     return is_verified
@@ -1,56 +1,411 @@
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import tempfile
 import threading
 import time
-from gitlab_registry_usage.registry.high_level_api import GitLabRegistry
-from typing import cast, Optional
+from .changes import compute_changes, SnapshotChanges
+from .compact import CompactRegistry, RegistryPatch
+from .history import UsageHistory
+from .index import RegistryIndex
+from .registry import (
+    check_refreshed_results,
+    IncrementalGitLabRegistry,
+    RefreshCancelledError,
+    RefreshStatistics,
+    RepositoryResult,
+)
+from typing import cast, Iterable, Mapping, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT_VERSION = 1
+DEFAULT_CHANGE_GENERATIONS = 100
+
+# Immutable view of one refresh result; a new snapshot is published by replacing the reference in the cache, so a
+# request which holds a snapshot always sees consistent data. `changes` are the changes of the last published
+# generations up to this one (oldest first).
+RegistrySnapshot = NamedTuple(
+    'RegistrySnapshot', [
+        ('registry', CompactRegistry), ('index', RegistryIndex), ('timestamp', float), ('is_stale', bool),
+        ('generation', int), ('crawl_duration', Optional[float]), ('changes', Tuple[SnapshotChanges, ...])
+    ]
+)
+
+
+RefreshProgress = NamedTuple(
+    'RefreshProgress', [
+        ('is_running', bool), ('start_time', Optional[float]), ('processed_repositories', int),
+        ('total_repositories', Optional[int])
+    ]
+)
+
+# Outcome of the refreshes so far: the last failure is kept after later successes, `consecutive_failures` is reset
+RefreshHealth = NamedTuple(
+    'RefreshHealth', [
+        ('last_success_time', Optional[float]), ('last_failure_time', Optional[float]), ('last_failure', Optional[str]),
+        ('consecutive_failures', int)
+    ]
+)
 
 
 class GitLabRegistryCache:
-    def __init__(self, gitlab_base_url: str, registry_base_url: str, username: str, password: str) -> None:
+    registry_class = IncrementalGitLabRegistry
+
+    def __init__(
+        self,
+        gitlab_base_url: str,
+        registry_base_url: str,
+        username: str,
+        password: str,
+        incremental_refresh: bool = True,
+        workers: int = 1,
+        snapshot_filename: Optional[str] = None,
+        history: Optional[UsageHistory] = None,
+        change_generations: int = DEFAULT_CHANGE_GENERATIONS
+    ) -> None:
         self._gitlab_base_url = gitlab_base_url
         self._registry_base_url = registry_base_url
         self._username = username
         self._password = password
-        self._gitlab_registry = None  # type: Optional[GitLabRegistry]
-        self._timestamp = None  # type: Optional[float]
+        self._incremental_refresh = incremental_refresh
+        self._workers = workers
+        self._snapshot_filename = snapshot_filename
+        self._history = history
+        self._change_generations = change_generations
+        self._snapshot = None  # type: Optional[RegistrySnapshot]
+        self._publish_lock = threading.Lock()
+        # Held while a refresh is running, refreshes never overlap
+        self._update_lock = threading.Lock()
+        self._running_registry = None  # type: Optional[IncrementalGitLabRegistry]
+        self._running_start_time = None  # type: Optional[float]
+        self._health = RefreshHealth(None, None, None, 0)
 
-    def update(self, run_async: bool = False) -> Optional[threading.Thread]:
-        def job_function() -> None:
-            gitlab_registry = GitLabRegistry(
-                self._gitlab_base_url, self._registry_base_url, self._username, self._password
+    def _publish(
+        self,
+        gitlab_registry: CompactRegistry,
+        index: RegistryIndex,
+        timestamp: float,
+        is_stale: bool,
+        crawl_duration: Optional[float] = None,
+        registry_patch: Optional[RegistryPatch] = None
+    ) -> RegistrySnapshot:
+        with self._publish_lock:
+            previous_snapshot = self._snapshot
+            generation = previous_snapshot.generation + 1 if previous_snapshot is not None else 1
+            changes = ()  # type: Tuple[SnapshotChanges, ...]
+            if previous_snapshot is not None and self._change_generations > 0:
+                # The diff is computed once per refresh, requests only combine the diffs of the requested generations
+                snapshot_changes = SnapshotChanges(
+                    generation, timestamp, previous_snapshot.generation, previous_snapshot.timestamp,
+                    compute_changes(
+                        previous_snapshot.registry, gitlab_registry,
+                        registry_patch.changed_repository_ids if registry_patch is not None else None
+                    )
+                )
+                previous_changes = previous_snapshot.changes
+                changes = previous_changes[max(len(previous_changes) - self._change_generations + 1, 0):] + (
+                    snapshot_changes,
+                )
+            self._snapshot = RegistrySnapshot(
+                gitlab_registry, index, timestamp, is_stale, generation, crawl_duration, changes
+            )
+            return self._snapshot
+
+    def _new_registry(self) -> IncrementalGitLabRegistry:
+        return self.registry_class(
+            self._gitlab_base_url,
+            self._registry_base_url,
+            self._username,
+            self._password,
+            previous_registry=self._snapshot.registry if self._snapshot is not None else None,
+            incremental=self._incremental_refresh,
+            workers=self._workers
+        )
+
+    def _finish_update(self, gitlab_registry: IncrementalGitLabRegistry, crawl_duration: float) -> None:
+        """Compact, index, record, publish and save a freshly crawled registry (which took `crawl_duration` seconds)."""
+        compact_registry = CompactRegistry(gitlab_registry)
+        self._finish(compact_registry, RegistryIndex(compact_registry), crawl_duration)
+
+    def _finish_patch(
+        self, snapshot: RegistrySnapshot, repository_results: Mapping[str, RepositoryResult], api_requests: int,
+        crawl_duration: float
+    ) -> None:
+        """Patch the results of a targeted refresh into the registry and index of `snapshot` and publish them."""
+        compact_registry, registry_patch = snapshot.registry.patched(repository_results, api_requests)
+        self._finish(
+            compact_registry, snapshot.index.patched(compact_registry, registry_patch), crawl_duration, registry_patch
+        )
+
+    def _finish(
+        self,
+        compact_registry: CompactRegistry,
+        index: RegistryIndex,
+        crawl_duration: float,
+        registry_patch: Optional[RegistryPatch] = None
+    ) -> None:
+        """Record, publish and save a new registry.
+
+        Of a patched registry (`registry_patch`), only the changed repositories are recorded and compared. It is not
+        saved to the snapshot file, the next full crawl saves it (and a snapshot which is loaded on startup is crawled
+        completely anyway).
+        """
+        timestamp = time.time()
+        if self._history is not None:
+            try:
+                if registry_patch is None:
+                    self._history.record(
+                        timestamp, compact_registry.repository_sizes, compact_registry.repository_disk_sizes
+                    )
+                else:
+                    self._history.record(
+                        timestamp, {
+                            compact_registry.repository_name(repository_id):
+                            compact_registry.repository_size(repository_id)
+                            for repository_id in registry_patch.changed_repository_ids
+                        }, {
+                            compact_registry.repository_name(repository_id):
+                            compact_registry.repository_disk_size(repository_id)
+                            for repository_id in registry_patch.changed_repository_ids
+                        },
+                        partial=True
+                    )
+            except sqlite3.Error as e:
+                logger.warning('Could not record the usage history: %s', e)
+        snapshot = self._publish(compact_registry, index, timestamp, False, crawl_duration, registry_patch)
+        self._set_health(self._health._replace(last_success_time=timestamp, consecutive_failures=0))
+        if self._snapshot_filename is not None and registry_patch is None:
+            self.save_snapshot(snapshot)
+        refresh_statistics = compact_registry.refresh_statistics
+        if refresh_statistics is not None:
+            logger.info(
+                'Refreshed %d repositories (%d tags), reused %d repositories (%d tags)',
+                refresh_statistics.fetched_repositories, refresh_statistics.fetched_tags,
+                refresh_statistics.reused_repositories, refresh_statistics.reused_tags
+            )
+            if refresh_statistics.failed_repositories > 0:
+                logger.warning(
+                    'Kept the previous data of %d repositories which could not be refreshed',
+                    refresh_statistics.failed_repositories
+                )
+
+    def _record_failure(self, error: Exception) -> None:
+        # A cancelled refresh (on shutdown) says nothing about the registry
+        if isinstance(error, RefreshCancelledError):
+            return
+        self._set_health(
+            RefreshHealth(
+                self._health.last_success_time, time.time(), str(error) or type(error).__name__,
+                self._health.consecutive_failures + 1
             )
-            gitlab_registry.update()
-            self._gitlab_registry = gitlab_registry
-            self._timestamp = time.time()
+        )
+
+    def _set_health(self, health: RefreshHealth) -> None:
+        self._health = health
+
+    def _begin_update(self, blocking: bool) -> bool:
+        if not self._update_lock.acquire(blocking):
+            return False
+        self._running_start_time = time.time()
+        return True
 
+    def _end_update(self) -> None:
+        self._running_registry = None
+        self._running_start_time = None
+        self._update_lock.release()
+
+    def _update(self) -> None:
+        gitlab_registry = self._new_registry()
+        self._running_registry = gitlab_registry
+        start_time = time.monotonic()
+        gitlab_registry.update()
+        self._finish_update(gitlab_registry, time.monotonic() - start_time)
+
+    def _locked_update(self, blocking: bool = True) -> bool:
+        if not self._begin_update(blocking):
+            return False
+        try:
+            self._update()
+        except Exception as e:
+            self._record_failure(e)
+            raise
+        finally:
+            self._end_update()
+        return True
+
+    def update(self, run_async: bool = False) -> Optional[threading.Thread]:
+        """Refresh the registry, a refresh which is started while another one is running waits for it."""
         if run_async:
-            thread = threading.Thread(target=job_function)
+            thread = threading.Thread(target=self._locked_update)
             thread.start()
             return thread
         else:
-            job_function()
+            self._locked_update()
             return None
 
-    def update_continuously(self, minutes_interval: int = 60) -> threading.Thread:
-        def job_function() -> None:
-            time_delta = 0.0
-            while True:
-                start_time = time.time()
-                self.update()
-                time_delta = time.time() - start_time
-                time.sleep(minutes_interval * 60 - time_delta)
+    def update_repositories(self, repositories: Iterable[str]) -> bool:
+        """Refresh only `repositories` and patch them into the current snapshot; return whether the refresh was run.
+
+        A running refresh is not waited for: a full crawl picks up the changes of the repositories anyway. A snapshot
+        which was loaded from disk is refreshed completely instead, like a snapshot in which refreshed repositories
+        have to be added to the registry catalog.
+        """
+        if not self._begin_update(blocking=False):
+            return False
+        try:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.is_stale:
+                self._update()
+                return True
+            gitlab_registry = self._new_registry()
+            self._running_registry = gitlab_registry
+            start_time = time.monotonic()
+            repository_results, api_requests = gitlab_registry.fetch_repositories(repositories)
+            check_refreshed_results(repository_results)
+            # Repositories which are neither in the catalog nor readable are not added, like in a crawl
+            catalog_results = {
+                repository: repository_result
+                for repository, repository_result in repository_results.items()
+                if repository in snapshot.registry.repository_sizes
+            }
+            if any(
+                repository_result.tag_layers is not None
+                for repository, repository_result in repository_results.items()
+                if repository not in catalog_results
+            ):
+                gitlab_registry.merge_repository_results(repository_results, api_requests)
+                self._finish_update(gitlab_registry, time.monotonic() - start_time)
+            else:
+                self._finish_patch(snapshot, catalog_results, api_requests, time.monotonic() - start_time)
+        except Exception as e:
+            self._record_failure(e)
+            raise
+        finally:
+            self._end_update()
+        return True
+
+    def update_if_idle(self) -> bool:
+        """Refresh the registry unless a refresh is already running; return whether a refresh was run."""
+        return self._locked_update(blocking=False)
 
-        thread = threading.Thread(target=job_function)
-        thread.start()
-        return thread
+    def cancel_update(self) -> None:
+        """Make a running refresh fail with a `RefreshCancelledError` (after the repositories in progress)."""
+        running_registry = self._running_registry
+        if running_registry is not None:
+            running_registry.cancel()
+
+    def load_snapshot(self) -> bool:
+        if self._snapshot_filename is None or not os.path.isfile(self._snapshot_filename):
+            return False
+        try:
+            with gzip.open(self._snapshot_filename, 'rt', encoding='utf-8') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            if snapshot.get('version') != SNAPSHOT_FORMAT_VERSION:
+                logger.warning('Ignoring snapshot "%s" with an unsupported format version', self._snapshot_filename)
+                return False
+            gitlab_registry = CompactRegistry(
+                self.registry_class.from_dict(
+                    snapshot['registry'],
+                    self._gitlab_base_url,
+                    self._registry_base_url,
+                    self._username,
+                    self._password,
+                    incremental=self._incremental_refresh,
+                    workers=self._workers
+                )
+            )
+            timestamp = float(snapshot['timestamp'])
+            index = RegistryIndex(gitlab_registry)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning('Could not load snapshot "%s": %s', self._snapshot_filename, e)
+            return False
+        self._publish(gitlab_registry, index, timestamp, True)
+        logger.info('Loaded snapshot "%s" from %s', self._snapshot_filename, time.ctime(timestamp))
+        return True
+
+    def save_snapshot(self, registry_snapshot: Optional[RegistrySnapshot] = None) -> None:
+        if registry_snapshot is None:
+            registry_snapshot = self._snapshot
+        if self._snapshot_filename is None or registry_snapshot is None:
+            return
+        snapshot = {
+            'version': SNAPSHOT_FORMAT_VERSION,
+            'timestamp': registry_snapshot.timestamp,
+            'registry': registry_snapshot.registry.to_dict(),
+        }
+        snapshot_dirname = os.path.dirname(self._snapshot_filename) or '.'
+        try:
+            # Write to a temporary file in the same directory and rename it, so readers never see a partial snapshot
+            fd, temp_filename = tempfile.mkstemp(dir=snapshot_dirname, prefix='.snapshot-', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as raw_snapshot_file:
+                    with gzip.open(raw_snapshot_file, 'wt', encoding='utf-8') as snapshot_file:
+                        json.dump(snapshot, snapshot_file, separators=(',', ':'))
+                    raw_snapshot_file.flush()
+                    os.fsync(raw_snapshot_file.fileno())
+                os.replace(temp_filename, self._snapshot_filename)
+            except BaseException:
+                os.remove(temp_filename)
+                raise
+        except OSError as e:
+            logger.warning('Could not save snapshot "%s": %s', self._snapshot_filename, e)
 
     @property
-    def registry(self) -> GitLabRegistry:
-        if self._gitlab_registry is None:
+    def snapshot(self) -> RegistrySnapshot:
+        if self._snapshot is None:
             self.update()
-        return self._gitlab_registry
+        return cast(RegistrySnapshot, self._snapshot)
+
+    @property
+    def current_snapshot(self) -> Optional[RegistrySnapshot]:
+        """The published snapshot without waiting for a crawl, `None` until the first refresh succeeded."""
+        return self._snapshot
+
+    @property
+    def registry(self) -> CompactRegistry:
+        return self.snapshot.registry
+
+    @property
+    def index(self) -> RegistryIndex:
+        return self.snapshot.index
 
     @property
     def timestamp(self) -> float:
-        if self._timestamp is None:
-            self.update()
-        return cast(float, self._timestamp)
+        return self.snapshot.timestamp
+
+    @property
+    def generation(self) -> int:
+        return self._snapshot.generation if self._snapshot is not None else 0
+
+    @property
+    def is_stale(self) -> bool:
+        return self._snapshot.is_stale if self._snapshot is not None else False
+
+    @property
+    def incremental_refresh(self) -> bool:
+        return self._incremental_refresh
+
+    @property
+    def progress(self) -> RefreshProgress:
+        running_registry, start_time = self._running_registry, self._running_start_time
+        if start_time is None:
+            return RefreshProgress(False, None, 0, None)
+        if running_registry is None:
+            return RefreshProgress(True, start_time, 0, None)
+        crawl_progress = running_registry.crawl_progress
+        return RefreshProgress(
+            True, start_time, crawl_progress.processed_repositories, crawl_progress.total_repositories
+        )
+
+    @property
+    def health(self) -> RefreshHealth:
+        return self._health
+
+    @property
+    def refresh_statistics(self) -> Optional[RefreshStatistics]:
+        if self._snapshot is None:
+            return None
+        return self._snapshot.registry.refresh_statistics
@@ -0,0 +1,158 @@
+from .compact import CompactRegistry
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple  # noqa: F401
+
+ADDED = 'added'
+REMOVED = 'removed'
+RESIZED = 'resized'
+
+TagChange = NamedTuple('TagChange', [('change', str), ('size_delta', int)])
+RepositoryChange = NamedTuple(
+    'RepositoryChange', [('change', str), ('size_delta', int), ('disk_size_delta', int), ('tags', Dict[str, TagChange])]
+)
+# The changes from the snapshot `previous_generation` to the snapshot `generation`
+SnapshotChanges = NamedTuple(
+    'SnapshotChanges', [
+        ('generation', int), ('timestamp', float), ('previous_generation', int), ('previous_timestamp', float),
+        ('repositories', Dict[str, RepositoryChange])
+    ]
+)
+
+
+def _tag_changes(
+    previous_tag_sizes: Optional[Mapping[str, int]], current_tag_sizes: Optional[Mapping[str, int]]
+) -> Dict[str, TagChange]:
+    previous_tag_sizes, current_tag_sizes = previous_tag_sizes or {}, current_tag_sizes or {}
+    tag_changes = {}  # type: Dict[str, TagChange]
+    for tag, size in current_tag_sizes.items():
+        previous_size = previous_tag_sizes.get(tag)
+        if previous_size is None:
+            tag_changes[tag] = TagChange(ADDED, size)
+        elif size != previous_size:
+            tag_changes[tag] = TagChange(RESIZED, size - previous_size)
+    for tag, previous_size in previous_tag_sizes.items():
+        if tag not in current_tag_sizes:
+            tag_changes[tag] = TagChange(REMOVED, -previous_size)
+    return tag_changes
+
+
+def _repository_tag_sizes(gitlab_registry: CompactRegistry, repository_id: int) -> Dict[str, int]:
+    return {
+        gitlab_registry.tag_name(tag_id): gitlab_registry.tag_size(tag_id)
+        for tag_id in gitlab_registry.repository_tag_ids(repository_id)
+    }
+
+
+def _repository_change(
+    previous_registry: CompactRegistry, current_registry: CompactRegistry, repository_id: int,
+    previous_repository_id: Optional[int]
+) -> Optional[RepositoryChange]:
+    """Compare a repository of the current registry with its previous version (`None` if it did not exist)."""
+    size = current_registry.repository_size(repository_id)
+    disk_size = current_registry.repository_disk_size(repository_id)
+    # The registry does not guarantee an order of the tag list, the tags are compared as dict
+    tag_sizes = _repository_tag_sizes(current_registry, repository_id)
+    if previous_repository_id is None:
+        change, previous_size, previous_disk_size, previous_tag_sizes = ADDED, None, None, {}
+    else:
+        previous_size = previous_registry.repository_size(previous_repository_id)
+        previous_disk_size = previous_registry.repository_disk_size(previous_repository_id)
+        previous_tag_sizes = _repository_tag_sizes(previous_registry, previous_repository_id)
+        # Same tag names and total size, a tag can still have grown by as much as another one shrank
+        if size == previous_size and disk_size == previous_disk_size and tag_sizes == previous_tag_sizes:
+            return None
+        change = RESIZED
+    return RepositoryChange(
+        change, (size or 0) - (previous_size or 0), (disk_size or 0) - (previous_disk_size or 0),
+        _tag_changes(previous_tag_sizes, tag_sizes)
+    )
+
+
+def compute_changes(
+    previous_registry: CompactRegistry,
+    current_registry: CompactRegistry,
+    changed_repository_ids: Optional[Iterable[int]] = None
+) -> Dict[str, RepositoryChange]:
+    """Return the added, removed and resized repositories (with their added, removed and resized tags).
+
+    Tags only count as resized if their size changed. A repository also counts as resized if only its disk size changed
+    (the layers it shares with other repositories are counted for one of them, which can change by pushes elsewhere).
+    Repositories whose tags could not be read count as repositories without tags.
+
+    If the current registry was patched from the previous one (see `CompactRegistry.patched`), only the
+    `changed_repository_ids` of the patch are compared (the repository ids of both registries are the same).
+    """
+    repository_changes = {}  # type: Dict[str, RepositoryChange]
+    if changed_repository_ids is not None:
+        for repository_id in changed_repository_ids:
+            repository_change = _repository_change(previous_registry, current_registry, repository_id, repository_id)
+            if repository_change is not None:
+                repository_changes[current_registry.repository_name(repository_id)] = repository_change
+        return repository_changes
+    # Both registries are compared by repository id, only the ids of the previous one need a lookup by name
+    previous_repository_ids = {
+        repository: repository_id for repository_id, repository in enumerate(previous_registry.registry_catalog)
+    }
+    for repository_id, repository in enumerate(current_registry.registry_catalog):
+        repository_change = _repository_change(
+            previous_registry, current_registry, repository_id, previous_repository_ids.pop(repository, None)
+        )
+        if repository_change is not None:
+            repository_changes[repository] = repository_change
+    for repository, previous_repository_id in previous_repository_ids.items():
+        repository_changes[repository] = RepositoryChange(
+            REMOVED, -(previous_registry.repository_size(previous_repository_id) or 0),
+            -(previous_registry.repository_disk_size(previous_repository_id) or 0),
+            _tag_changes(_repository_tag_sizes(previous_registry, previous_repository_id), None)
+        )
+    return repository_changes
+
+
+def _merged_change(first_change: str, last_change: str) -> Optional[str]:
+    """Return the change of an item from before `first_change` to after `last_change` (`None`: it did not exist)."""
+    existed_before, exists_after = first_change != ADDED, last_change != REMOVED
+    if existed_before and exists_after:
+        return RESIZED
+    if exists_after:
+        return ADDED
+    if existed_before:
+        return REMOVED
+    return None
+
+
+def _merge_tag_changes(tag_changes: Iterable[Dict[str, TagChange]]) -> Dict[str, TagChange]:
+    first_and_last_changes = {}  # type: Dict[str, Tuple[TagChange, TagChange, int]]
+    for changes in tag_changes:
+        for tag, tag_change in changes.items():
+            first_change, _, size_delta = first_and_last_changes.get(tag, (tag_change, tag_change, 0))
+            first_and_last_changes[tag] = (first_change, tag_change, size_delta + tag_change.size_delta)
+    merged_changes = {}  # type: Dict[str, TagChange]
+    for tag, (first_change, last_change, size_delta) in first_and_last_changes.items():
+        change = _merged_change(first_change.change, last_change.change)
+        if change is not None and (change != RESIZED or size_delta != 0):
+            merged_changes[tag] = TagChange(change, size_delta)
+    return merged_changes
+
+
+def merge_changes(snapshot_changes: Sequence[SnapshotChanges]) -> Dict[str, RepositoryChange]:
+    """Combine the changes of consecutive snapshots into the changes from the first to the last snapshot.
+
+    The byte deltas add up, items which were added and removed again are dropped and items which changed back to their
+    original size count as unchanged.
+    """
+    if len(snapshot_changes) == 1:
+        return snapshot_changes[0].repositories
+    repository_change_lists = {}  # type: Dict[str, List[RepositoryChange]]
+    for changes in snapshot_changes:
+        for repository, repository_change in changes.repositories.items():
+            repository_change_lists.setdefault(repository, []).append(repository_change)
+    merged_changes = {}  # type: Dict[str, RepositoryChange]
+    for repository, repository_changes in repository_change_lists.items():
+        change = _merged_change(repository_changes[0].change, repository_changes[-1].change)
+        if change is None:
+            continue
+        size_delta = sum(repository_change.size_delta for repository_change in repository_changes)
+        disk_size_delta = sum(repository_change.disk_size_delta for repository_change in repository_changes)
+        tag_changes = _merge_tag_changes(repository_change.tags for repository_change in repository_changes)
+        if change != RESIZED or size_delta != 0 or disk_size_delta != 0 or tag_changes:
+            merged_changes[repository] = RepositoryChange(change, size_delta, disk_size_delta, tag_changes)
+    return merged_changes
@@ -0,0 +1,571 @@
+import copy
+from array import array
+from itertools import accumulate, chain
+from .registry import check_refreshed_results, IncrementalGitLabRegistry, RefreshStatistics, RepositoryResult
+from .tables import StringIndex, StringTable
+from typing import (  # noqa: F401
+    cast, Any, Callable, Dict, ItemsView, Iterator, List, Mapping, NamedTuple, Optional, Set, Tuple, ValuesView
+)
+
+# Size of a repository whose tags could not be read
+NO_SIZE = -1
+
+# Which ids a `CompactRegistry.patched` registry changed: the refreshed repositories (whose tags got new ids), these and
+# the repositories whose disk size changed because a layer is charged to another tag now, the layers which the
+# refreshed repositories referenced before or after the refresh and the first new tag id
+RegistryPatch = NamedTuple(
+    'RegistryPatch', [
+        ('repository_ids', List[int]), ('changed_repository_ids', List[int]), ('layer_ids', List[int]),
+        ('first_tag_id', int)
+    ]
+)
+
+
+class _IdItemsView(ItemsView[str, Any]):
+    def __init__(self, mapping: '_IdMapping') -> None:
+        super().__init__(mapping)
+        self._id_mapping = mapping
+
+    def __iter__(self) -> Iterator[Tuple[str, Any]]:
+        return zip(self._id_mapping, map(self._id_mapping.value, range(len(self._id_mapping))))
+
+
+class _IdValuesView(ValuesView[Any]):
+    def __init__(self, mapping: '_IdMapping') -> None:
+        super().__init__(mapping)
+        self._id_mapping = mapping
+
+    def __iter__(self) -> Iterator[Any]:
+        return map(self._id_mapping.value, range(len(self._id_mapping)))
+
+
+class _IdMapping(Mapping[str, Any]):
+    """Read-only mapping which maps keys to consecutive ids and computes the value of an id on access."""
+
+    def __init__(self, ids: StringIndex, value: Callable[[int], Any]) -> None:
+        self._ids = ids
+        self.value = value
+
+    def __getitem__(self, key: str) -> Any:
+        key_id = self._ids.find(key) if isinstance(key, str) else None
+        if key_id is None:
+            raise KeyError(key)
+        return self.value(key_id)
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self._ids.find(key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._ids.strings)
+
+    def __len__(self) -> int:
+        return len(self._ids.strings)
+
+    # Iterate the ids instead of looking up every key
+
+    def items(self) -> ItemsView[str, Any]:
+        return _IdItemsView(self)
+
+    def values(self) -> ValuesView[Any]:
+        return _IdValuesView(self)
+
+
+class _TagMapping(Mapping[str, Any]):
+    """Read-only mapping of the tags `start` to `stop` of the flat tag arrays, looked up by binary search."""
+
+    def __init__(
+        self, tag_name: Callable[[int], str], sorted_tag_ids: 'array[int]', start: int, stop: int,
+        value: Callable[[int], Any]
+    ) -> None:
+        self._tag_name = tag_name
+        self._sorted_tag_ids = sorted_tag_ids
+        self._start = start
+        self._stop = stop
+        self._value = value
+
+    def _tag_id(self, tag: object) -> Optional[int]:
+        low, high = self._start, self._stop
+        while low < high:
+            middle = (low + high) // 2
+            tag_id = self._sorted_tag_ids[middle]
+            tag_name = self._tag_name(tag_id)
+            if tag_name == tag:
+                return tag_id
+            if tag_name < tag:  # type: ignore
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def __getitem__(self, tag: str) -> Any:
+        tag_id = self._tag_id(tag) if isinstance(tag, str) else None
+        if tag_id is None:
+            raise KeyError(tag)
+        return self._value(tag_id)
+
+    def __contains__(self, tag: object) -> bool:
+        return isinstance(tag, str) and self._tag_id(tag) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return map(self._tag_name, range(self._start, self._stop))
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+
+class CompactRegistry:
+    """Read-only copy of a crawled registry which is kept in the registry snapshot.
+
+    A crawled `GitLabRegistry` stores (and lazily computes) nested dicts keyed by repository and tag names with one list
+    of layer digest strings per tag. This class maps repositories, tags and layers to consecutive integer ids instead:
+    all sizes are stored in typed arrays indexed by these ids, the tags of a repository, the layers of a tag and the
+    tags of a layer are slices of flat arrays and names and digests are kept in string tables (see `tables`). So the
+    registry consists of flat buffers only, which the prefork mode shares between the worker processes. The registry
+    properties the service uses are offered as read-only mappings which compute their values on access.
+
+    Disk sizes are computed like `GitLabRegistry` does: every layer is counted for the tag with the fewest layers
+    which references it (the first one in catalog order if several tags have as few layers).
+    """
+
+    def __init__(self, gitlab_registry: IncrementalGitLabRegistry) -> None:
+        repository_layers = gitlab_registry.repository_layers
+        layer_sizes = gitlab_registry.layer_sizes
+        tag_digests = gitlab_registry.tag_digests
+        self._refresh_statistics = gitlab_registry.refresh_statistics
+        self._failed_repositories = tuple(gitlab_registry.failed_repositories)
+        repositories = list(gitlab_registry.registry_catalog)
+        self._repositories = StringIndex(StringTable(repositories))
+        digests = list(layer_sizes)
+        self._layers = StringIndex(StringTable(digests))
+        layer_ids = {digest: layer_id for layer_id, digest in enumerate(digests)}  # type: Dict[str, int]
+        self._layer_sizes = array('q', (layer_sizes[digest] for digest in digests))
+        # Every tag refers to one of the distinct tag names, tags without a digest have an empty one
+        tag_names = []  # type: List[str]
+        tag_name_ids = {}  # type: Dict[str, int]
+        self._tag_name_ids = array('I')
+        tag_digest_list = []  # type: List[str]
+        # Tags of every repository (start and stop ids) and layer ids of every tag (a flat array with start offsets)
+        self._tag_starts = array('Q')
+        self._tag_stops = array('Q')
+        self._tag_repository_ids = array('I')
+        self._tag_layer_offsets = array('Q', [0])
+        self._tag_layer_ids = array('I')
+        self._repository_sizes = array('q')
+        self._repository_disk_sizes = array('q')
+        for repository_id, repository in enumerate(repositories):
+            tag_layers = repository_layers.get(repository)
+            self._tag_starts.append(len(self._tag_name_ids))
+            if tag_layers is not None:
+                repository_tag_digests = tag_digests.get(repository, {})
+                for tag, layers in tag_layers.items():
+                    tag_name_id = tag_name_ids.setdefault(tag, len(tag_names))
+                    if tag_name_id == len(tag_names):
+                        tag_names.append(tag)
+                    self._tag_name_ids.append(tag_name_id)
+                    self._tag_repository_ids.append(repository_id)
+                    tag_digest_list.append(repository_tag_digests.get(tag) or '')
+                    self._tag_layer_ids.extend(layer_ids[layer] for layer in layers)
+                    self._tag_layer_offsets.append(len(self._tag_layer_ids))
+            self._tag_stops.append(len(self._tag_name_ids))
+            self._repository_sizes.append(0 if tag_layers is not None else NO_SIZE)
+        self._tag_names = StringTable(tag_names)
+        self._tag_digests = StringTable(tag_digest_list)
+        self._sorted_tag_ids = array('I')
+        for repository_id in range(len(repositories)):
+            self._sorted_tag_ids.extend(
+                sorted(
+                    self.repository_tag_ids(repository_id),
+                    key=lambda tag_id: tag_names[self._tag_name_ids[tag_id]]
+                )
+            )
+        self._index_layer_tags()
+        self._compute_sizes()
+
+    def _tag_layer_id_slice(self, tag_id: int) -> 'array[int]':
+        return self._tag_layer_ids[self._tag_layer_offsets[tag_id]:self._tag_layer_offsets[tag_id + 1]]
+
+    def _tag_layer_count(self, tag_id: int) -> int:
+        return self._tag_layer_offsets[tag_id + 1] - self._tag_layer_offsets[tag_id]
+
+    def _index_layer_tags(self) -> None:
+        # Invert the tag -> layers rows into layer -> tags rows with a counting sort
+        reference_counts = array('Q', bytes(8 * self.layer_count))
+        for tag_id in range(self.tag_count):
+            for layer_id in self.tag_unique_layer_ids(tag_id):
+                reference_counts[layer_id] += 1
+        self._layer_tag_starts = array('Q', accumulate(chain((0, ), reference_counts[:-1])))
+        self._layer_tag_stops = array('Q', self._layer_tag_starts)
+        self._layer_tag_ids = array('I', bytes(4 * sum(reference_counts)))
+        for tag_id in range(self.tag_count):
+            for layer_id in self.tag_unique_layer_ids(tag_id):
+                self._layer_tag_ids[self._layer_tag_stops[layer_id]] = tag_id
+                self._layer_tag_stops[layer_id] += 1
+
+    def _compute_sizes(self) -> None:
+        tag_count = self.tag_count
+        # The tag which is charged for a layer (`-1`: not referenced)
+        self._layer_origins = array('q', [-1]) * self.layer_count
+        layer_origin_lengths = array('Q', bytes(8 * self.layer_count))
+        self._tag_sizes = array('q', bytes(8 * tag_count))
+        self._tag_disk_sizes = array('q', bytes(8 * tag_count))
+        for tag_id in range(tag_count):
+            layer_ids = self._tag_layer_id_slice(tag_id)
+            self._tag_sizes[tag_id] = sum(self._layer_sizes[layer_id] for layer_id in layer_ids)
+            for layer_id in layer_ids:
+                if self._layer_origins[layer_id] < 0 or len(layer_ids) < layer_origin_lengths[layer_id]:
+                    self._layer_origins[layer_id] = tag_id
+                    layer_origin_lengths[layer_id] = len(layer_ids)
+        for tag_id in range(tag_count):
+            self._tag_disk_sizes[tag_id] = self._tag_disk_size_of_origins(tag_id)
+        self._repository_disk_sizes = array('q', self._repository_sizes)
+        for repository_id in range(self.repository_count):
+            if self._repository_sizes[repository_id] == NO_SIZE:
+                continue
+            start, stop = self._tag_starts[repository_id], self._tag_stops[repository_id]
+            self._repository_sizes[repository_id] = sum(self._tag_sizes[start:stop])
+            self._repository_disk_sizes[repository_id] = sum(self._tag_disk_sizes[start:stop])
+
+    def _tag_disk_size_of_origins(self, tag_id: int) -> int:
+        return sum(
+            self._layer_sizes[layer_id]
+            for layer_id in self._tag_layer_id_slice(tag_id) if self._layer_origins[layer_id] == tag_id
+        )
+
+    def _layer_origin(self, layer_id: int) -> int:
+        """Return the tag which is charged for a layer (`-1`: not referenced) from the tags of the layer."""
+        return min(
+            self.layer_tag_ids(layer_id),
+            key=lambda tag_id: (self._tag_layer_count(tag_id), self._tag_repository_ids[tag_id], tag_id),
+            default=-1
+        )
+
+    def patched(
+        self, repository_results: Mapping[str, RepositoryResult], api_requests: int
+    ) -> Tuple['CompactRegistry', RegistryPatch]:
+        """Return a copy of the registry in which the repositories of `repository_results` (which must be in the
+        registry catalog) are replaced by the results of a targeted refresh, and the ids which changed.
+
+        Only the refreshed repositories, the layers they reference before or after the refresh and the tags which are
+        charged for these layers are updated, all other values are taken over by copying the typed arrays as a whole.
+        The tags of the refreshed repositories get new ids at the end of the tag arrays (and affected layers new tag
+        rows), so the ids of all other tags stay valid for the indexes of the registry. The replaced tags and rows are
+        left unreferenced in the arrays until the next full crawl builds a new registry. Repositories which failed keep
+        their data, like in a crawl, and so do the repositories which failed before and were not refreshed.
+        """
+        check_refreshed_results(repository_results)
+        registry = copy.copy(self)
+        registry._repository_sizes = self._repository_sizes[:]
+        registry._repository_disk_sizes = self._repository_disk_sizes[:]
+        registry._tag_starts = self._tag_starts[:]
+        registry._tag_stops = self._tag_stops[:]
+        registry._tag_name_ids = self._tag_name_ids[:]
+        registry._tag_repository_ids = self._tag_repository_ids[:]
+        registry._tag_layer_offsets = self._tag_layer_offsets[:]
+        registry._tag_layer_ids = self._tag_layer_ids[:]
+        registry._sorted_tag_ids = self._sorted_tag_ids[:]
+        registry._tag_sizes = self._tag_sizes[:]
+        registry._tag_disk_sizes = self._tag_disk_sizes[:]
+        registry._layer_sizes = self._layer_sizes[:]
+        registry._layer_origins = self._layer_origins[:]
+        registry._layer_tag_starts = self._layer_tag_starts[:]
+        registry._layer_tag_stops = self._layer_tag_stops[:]
+        registry._layer_tag_ids = self._layer_tag_ids[:]
+        results_by_id = sorted(
+            (cast(int, self._repositories.find(repository)), repository_result)
+            for repository, repository_result in repository_results.items()
+        )
+        refreshed_repository_ids = [
+            repository_id for repository_id, repository_result in results_by_id if repository_result.error is None
+        ]
+        replaced_tag_ids = set()  # type: Set[int]
+        layer_ids = set()  # type: Set[int]
+        added_layers = {}  # type: Dict[str, int]
+        added_tag_names = []  # type: List[str]
+        added_tag_digests = []  # type: List[str]
+        added_layer_tag_ids = {}  # type: Dict[int, List[int]]
+        for repository_id, repository_result in results_by_id:
+            if repository_result.error is not None:
+                continue
+            replaced_tag_ids.update(self.repository_tag_ids(repository_id))
+            for tag_id in self.repository_tag_ids(repository_id):
+                layer_ids.update(self._tag_layer_id_slice(tag_id))
+            start = registry.tag_count
+            sorted_tags = []  # type: List[Tuple[str, int]]
+            for tag, layers in (repository_result.tag_layers or {}).items():
+                tag_id = registry.tag_count
+                tag_layer_ids = []  # type: List[int]
+                for layer in layers:
+                    layer_id = self._layers.find(layer)
+                    if layer_id is None:
+                        layer_id = added_layers.setdefault(layer, self.layer_count + len(added_layers))
+                        if layer_id == len(registry._layer_sizes):
+                            registry._layer_sizes.append(repository_result.layer_sizes[layer])
+                            registry._layer_origins.append(-1)
+                    tag_layer_ids.append(layer_id)
+                registry._tag_name_ids.append(len(self._tag_names) + len(added_tag_names))
+                added_tag_names.append(tag)
+                added_tag_digests.append(repository_result.tag_digests.get(tag) or '')
+                registry._tag_repository_ids.append(repository_id)
+                registry._tag_layer_ids.extend(tag_layer_ids)
+                registry._tag_layer_offsets.append(len(registry._tag_layer_ids))
+                registry._tag_sizes.append(sum(registry._layer_sizes[layer_id] for layer_id in tag_layer_ids))
+                registry._tag_disk_sizes.append(0)
+                for layer_id in set(tag_layer_ids):
+                    added_layer_tag_ids.setdefault(layer_id, []).append(tag_id)
+                layer_ids.update(tag_layer_ids)
+                sorted_tags.append((tag, tag_id))
+            registry._tag_starts[repository_id] = start
+            registry._tag_stops[repository_id] = registry.tag_count
+            registry._sorted_tag_ids.extend(tag_id for _, tag_id in sorted(sorted_tags))
+            registry._repository_sizes[repository_id] = (
+                sum(registry._tag_sizes[start:]) if repository_result.tag_layers is not None else NO_SIZE
+            )
+        registry._tag_names = self._tag_names.extended(added_tag_names)
+        registry._tag_digests = self._tag_digests.extended(added_tag_digests)
+        if added_layers:
+            registry._layers = self._layers.extended(self._layers.strings.extended(added_layers))
+            registry._layer_tag_starts.extend(array('Q', bytes(8 * len(added_layers))))
+            registry._layer_tag_stops.extend(array('Q', bytes(8 * len(added_layers))))
+        # Rebuild the tag rows of the affected layers and charge them to their (possibly new) tags
+        charged_tag_ids = set(range(self.tag_count, registry.tag_count))
+        for layer_id in sorted(layer_ids):
+            registry._layer_tag_starts[layer_id] = len(registry._layer_tag_ids)
+            if layer_id < self.layer_count:
+                registry._layer_tag_ids.extend(
+                    tag_id for tag_id in self.layer_tag_ids(layer_id) if tag_id not in replaced_tag_ids
+                )
+            registry._layer_tag_ids.extend(added_layer_tag_ids.get(layer_id, ()))
+            registry._layer_tag_stops[layer_id] = len(registry._layer_tag_ids)
+            previous_origin = registry._layer_origins[layer_id]
+            registry._layer_origins[layer_id] = registry._layer_origin(layer_id)
+            if registry._layer_origins[layer_id] != previous_origin:
+                charged_tag_ids.update((previous_origin, registry._layer_origins[layer_id]))
+        charged_tag_ids -= replaced_tag_ids | {-1}
+        for tag_id in charged_tag_ids:
+            registry._tag_disk_sizes[tag_id] = registry._tag_disk_size_of_origins(tag_id)
+        changed_repository_ids = set(refreshed_repository_ids)
+        charged_repository_ids = {registry._tag_repository_ids[tag_id] for tag_id in charged_tag_ids}
+        for repository_id in changed_repository_ids | charged_repository_ids:
+            if registry._repository_sizes[repository_id] == NO_SIZE:
+                registry._repository_disk_sizes[repository_id] = NO_SIZE
+                continue
+            registry._repository_disk_sizes[repository_id] = sum(
+                registry._tag_disk_sizes[registry._tag_starts[repository_id]:registry._tag_stops[repository_id]]
+            )
+            if registry._repository_disk_sizes[repository_id] != self._repository_disk_sizes[repository_id]:
+                changed_repository_ids.add(repository_id)
+        registry._set_patch_statistics(self, results_by_id, api_requests)
+        return registry, RegistryPatch(
+            refreshed_repository_ids, sorted(changed_repository_ids), sorted(layer_ids), self.tag_count
+        )
+
+    def _set_patch_statistics(
+        self, previous_registry: 'CompactRegistry', results_by_id: List[Tuple[int, RepositoryResult]],
+        api_requests: int
+    ) -> None:
+        # Like `update_repositories`, repositories which were not refreshed count as reused unless they failed before
+        results = dict(results_by_id)
+        failed_repository_ids = {
+            repository_id for repository_id, repository_result in results_by_id if repository_result.error is not None
+        }
+        failed_repository_ids.update(
+            repository_id for repository_id in map(self._repositories.find, previous_registry.failed_repositories)
+            if repository_id is not None and repository_id not in results
+        )
+        self._failed_repositories = tuple(map(self.repository_name, sorted(failed_repository_ids)))
+        fetched_repositories = sum(
+            1 for _, repository_result in results_by_id
+            if repository_result.error is None and not repository_result.is_reused
+        )
+        previous_tag_count = sum(previous_registry._tag_stops) - sum(previous_registry._tag_starts)
+        self._refresh_statistics = RefreshStatistics(
+            fetched_repositories, self.repository_count - fetched_repositories - len(self._failed_repositories),
+            sum(repository_result.fetched_tags for _, repository_result in results_by_id),
+            previous_tag_count + sum(
+                repository_result.reused_tags - len(previous_registry.repository_tag_ids(repository_id))
+                for repository_id, repository_result in results_by_id
+            ), api_requests, len(self._failed_repositories)
+        )
+
+    def _has_tags(self, repository_id: int) -> bool:
+        return self._repository_sizes[repository_id] != NO_SIZE
+
+    def _tag_mapping(self, repository_id: int, value: Callable[[int], Any]) -> Optional[Mapping[str, Any]]:
+        if not self._has_tags(repository_id):
+            return None
+        return _TagMapping(
+            self.tag_name, self._sorted_tag_ids, self._tag_starts[repository_id], self._tag_stops[repository_id], value
+        )
+
+    def _repository_tags(self, repository_id: int) -> Optional[List[str]]:
+        if not self._has_tags(repository_id):
+            return None
+        return [self.tag_name(tag_id) for tag_id in self.repository_tag_ids(repository_id)]
+
+    def _tag_layers(self, tag_id: int) -> List[str]:
+        return [self._layers.strings[layer_id] for layer_id in self._tag_layer_id_slice(tag_id)]
+
+    def _repository_tag_digests(self, repository_id: int) -> Dict[str, str]:
+        return {
+            self.tag_name(tag_id): self._tag_digests[tag_id]
+            for tag_id in self.repository_tag_ids(repository_id) if self._tag_digests.encoded(tag_id)
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the registry in the format of `IncrementalGitLabRegistry.to_dict`."""
+        return {
+            'registry_catalog': self.registry_catalog,
+            'repository_layers': {
+                repository: dict(tag_layers) if tag_layers is not None else None
+                for repository, tag_layers in self.repository_layers.items()
+            },
+            # Layers of replaced tags (see `patched`) are kept in the table without references
+            'layer_sizes': {
+                digest: layer_size
+                for layer_id, (digest, layer_size) in enumerate(self.layer_sizes.items())
+                if self.layer_reference_count(layer_id) > 0
+            },
+            'tag_digests': dict(self.tag_digests.items()),
+        }
+
+    # Id based access for indexes which are built on the tables of the registry
+
+    @property
+    def repository_count(self) -> int:
+        return len(self._repository_sizes)
+
+    @property
+    def layer_count(self) -> int:
+        return len(self._layer_sizes)
+
+    @property
+    def tag_count(self) -> int:
+        """The number of tag ids (including the replaced tags of a patched registry)."""
+        return len(self._tag_name_ids)
+
+    def layer_id(self, digest: str) -> Optional[int]:
+        """Return the id of a layer which is referenced by a tag (`None` for unknown digests and the others)."""
+        layer_id = self._layers.find(digest)
+        return layer_id if layer_id is not None and self.layer_reference_count(layer_id) > 0 else None
+
+    def layer_digest(self, layer_id: int) -> str:
+        return self._layers.strings[layer_id]
+
+    def layer_size(self, layer_id: int) -> int:
+        return self._layer_sizes[layer_id]
+
+    def repository_id(self, repository: str) -> Optional[int]:
+        """Return the id of a repository with readable tags (`None` for unknown repositories and the others)."""
+        repository_id = self._repositories.find(repository)
+        return repository_id if repository_id is not None and self._has_tags(repository_id) else None
+
+    def repository_name(self, repository_id: int) -> str:
+        return self._repositories.strings[repository_id]
+
+    def repository_size(self, repository_id: int) -> Optional[int]:
+        """Return the size of a repository (`None` if its tags could not be read)."""
+        return self._repository_sizes[repository_id] if self._has_tags(repository_id) else None
+
+    def repository_disk_size(self, repository_id: int) -> Optional[int]:
+        return self._repository_disk_sizes[repository_id] if self._has_tags(repository_id) else None
+
+    def repository_tag_ids(self, repository_id: int) -> range:
+        return range(self._tag_starts[repository_id], self._tag_stops[repository_id])
+
+    def tag_id(self, repository: str, tag: str) -> Optional[int]:
+        repository_id = self.repository_id(repository)
+        if repository_id is None:
+            return None
+        return cast(Mapping[str, int], self._tag_mapping(repository_id, int)).get(tag)
+
+    def tag_repository_id(self, tag_id: int) -> int:
+        return self._tag_repository_ids[tag_id]
+
+    def tag_repository(self, tag_id: int) -> str:
+        return self.repository_name(self._tag_repository_ids[tag_id])
+
+    def tag_name(self, tag_id: int) -> str:
+        return self._tag_names[self._tag_name_ids[tag_id]]
+
+    def tag_size(self, tag_id: int) -> int:
+        return self._tag_sizes[tag_id]
+
+    def tag_disk_size(self, tag_id: int) -> int:
+        return self._tag_disk_sizes[tag_id]
+
+    def tag_layer_ids(self, tag_id: int) -> 'array[int]':
+        return self._tag_layer_id_slice(tag_id)
+
+    def tag_unique_layer_ids(self, tag_id: int) -> 'array[int]':
+        # A manifest may list the same layer twice, but the tag references it once
+        layer_ids = self._tag_layer_id_slice(tag_id)
+        if len(set(layer_ids)) < len(layer_ids):
+            return array('I', sorted(set(layer_ids)))
+        return layer_ids
+
+    def layer_tag_ids(self, layer_id: int) -> 'array[int]':
+        """Return the ids of the tags which reference a layer."""
+        return self._layer_tag_ids[self._layer_tag_starts[layer_id]:self._layer_tag_stops[layer_id]]
+
+    def layer_reference_count(self, layer_id: int) -> int:
+        return self._layer_tag_stops[layer_id] - self._layer_tag_starts[layer_id]
+
+    @property
+    def registry_catalog(self) -> List[str]:
+        return list(self._repositories.strings)
+
+    @property
+    def repository_sizes(self) -> Mapping[str, Optional[int]]:
+        return _IdMapping(self._repositories, self.repository_size)
+
+    @property
+    def repository_disk_sizes(self) -> Mapping[str, Optional[int]]:
+        return _IdMapping(self._repositories, self.repository_disk_size)
+
+    @property
+    def repository_tags(self) -> Mapping[str, Optional[List[str]]]:
+        return _IdMapping(self._repositories, self._repository_tags)
+
+    @property
+    def tag_sizes(self) -> Mapping[str, Optional[Mapping[str, int]]]:
+        return _IdMapping(
+            self._repositories,
+            lambda repository_id: self._tag_mapping(repository_id, self._tag_sizes.__getitem__)
+        )
+
+    @property
+    def tag_disk_sizes(self) -> Mapping[str, Optional[Mapping[str, int]]]:
+        return _IdMapping(
+            self._repositories,
+            lambda repository_id: self._tag_mapping(repository_id, self._tag_disk_sizes.__getitem__)
+        )
+
+    @property
+    def repository_layers(self) -> Mapping[str, Optional[Mapping[str, List[str]]]]:
+        return _IdMapping(
+            self._repositories, lambda repository_id: self._tag_mapping(repository_id, self._tag_layers)
+        )
+
+    @property
+    def tag_digests(self) -> Mapping[str, Dict[str, str]]:
+        return _IdMapping(self._repositories, self._repository_tag_digests)
+
+    @property
+    def layer_sizes(self) -> Mapping[str, int]:
+        return _IdMapping(self._layers, self._layer_sizes.__getitem__)
+
+    @property
+    def total_size(self) -> int:
+        return sum(size for size in self._repository_sizes if size != NO_SIZE)
+
+    @property
+    def total_disk_size(self) -> int:
+        return sum(disk_size for disk_size in self._repository_disk_sizes if disk_size != NO_SIZE)
+
+    @property
+    def refresh_statistics(self) -> Optional[RefreshStatistics]:
+        return self._refresh_statistics
+
+    @property
+    def failed_repositories(self) -> Tuple[str, ...]:
+        return self._failed_repositories
@@ -1,8 +1,22 @@
 import datetime
+import re
 from configparser import ConfigParser
-from typing import Any, Dict, Optional, TextIO, Union  # noqa: F401  # pylint: disable=unused-import
+from typing import Any, Dict, List, NamedTuple, Optional, TextIO, Union  # noqa: F401  # pylint: disable=unused-import
 
 DEFAULT_CONFIG_FILENAME = '/etc/gitlab_registry_usage_rest.conf'
+# Sections named `registry:<id>` configure additional registries
+REGISTRY_SECTION_PREFIX = 'registry:'
+REGISTRY_ID_PATTERN = r'^[A-Za-z0-9._-]+$'
+
+# Connection, refresh interval and files of one registry (a GitLab instance)
+RegistryConfig = NamedTuple(
+    'RegistryConfig', [
+        ('registry_id', str), ('gitlab_base_url', str), ('registry_base_url', str), ('username', str),
+        ('access_token', str), ('incremental_refresh', bool), ('workers', int),
+        ('refresh_interval', datetime.timedelta), ('stale_after', datetime.timedelta), ('snapshot_file', Optional[str]),
+        ('history_file', Optional[str])
+    ]
+)
 
 
 class ParseTimeDeltaError(Exception):
@@ -26,21 +40,65 @@ def parse_timedelta(timedelta_string: str) -> datetime.timedelta:
         pass
     else:
         raise ParseTimeDeltaError(timedelta_string)
-    if not timedelta_split[0].isdigit():
+    if not re.match(r'^\d+(?:\.\d+)?$', timedelta_split[0]):
         raise ParseTimeDeltaError(timedelta_string)
-    value, unit = int(timedelta_split[0]), timedelta_split[1]
+    value, unit = float(timedelta_split[0]), timedelta_split[1]
     for units, keyword in units_to_keyword.items():
         if unit in units:
             return datetime.timedelta(**{keyword: value})
     raise ParseTimeDeltaError(timedelta_string)
 
 
+class ParseSizeError(Exception):
+    def __init__(self, size_string: str) -> None:
+        super().__init__('"{}" cannot be parsed.'.format(size_string))
+
+
+def parse_size(size_string: str) -> int:
+    """Parse a size in bytes, optionally with a decimal (`KB`, `MB`, ...) or binary (`KiB`, `MiB`, ...) unit."""
+    unit_factors = {
+        ('', 'b', 'byte', 'bytes'): 1,
+        ('k', 'kb'): 1000,
+        ('m', 'mb'): 1000**2,
+        ('g', 'gb'): 1000**3,
+        ('t', 'tb'): 1000**4,
+        ('ki', 'kib'): 1024,
+        ('mi', 'mib'): 1024**2,
+        ('gi', 'gib'): 1024**3,
+        ('ti', 'tib'): 1024**4
+    }
+    size_match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([a-z]*)\s*$', size_string.lower())
+    if size_match is None:
+        raise ParseSizeError(size_string)
+    value, unit = float(size_match.group(1)), size_match.group(2)
+    for units, factor in unit_factors.items():
+        if unit in units:
+            return int(value * factor)
+    raise ParseSizeError(size_string)
+
+
+class InvalidRegistryIdError(Exception):
+    def __init__(self, registry_id: str) -> None:
+        super().__init__(
+            'The registry id "{}" is invalid or used twice, only letters, digits, ".", "_" and "-" are allowed.'.format(
+                registry_id
+            )
+        )
+
+
+class MissingConfigValueError(Exception):
+    def __init__(self, section: str, key: str) -> None:
+        super().__init__('The key "{}" is missing in the section [{}].'.format(key, section))
+
+
 class Config:
     _default_config = {
         'general': {
             'socket_host': '127.0.0.1',
             'socket_port': 5000,
             'server_prefix': '/',
+            'server': 'wsgi',
+            'processes': 4,
             'debug': False
         },
         'ldap': {
@@ -48,17 +106,53 @@ class Config:
             'base_dn': 'dc=example,dc=com',
             'valid_gid': '00000',
             'username_attribute': 'uid',
-            'gid_attribute': 'gidNumber'
+            'gid_attribute': 'gidNumber',
+            'pool_size': 4,
+            'cache_ttl': '5 minutes',
+            'cache_size': 1000
         },
         'jwt': {
             'auth_token_expires': '2 weeks',
             'secret_key': '00000000000000000000000000000000'
         },
         'registry': {
+            'id': 'default',
             'gitlab_base_url': 'https://mygitlab.com/',
             'registry_base_url': 'https://registry.mygitlab.com/',
             'username': 'root',
-            'access_token': '00000000000000000000'
+            'access_token': '00000000000000000000',
+            'incremental_refresh': True,
+            'workers': 8
+        },
+        'refresh': {
+            'interval': '60 minutes',
+            'jitter': 0.1,
+            'adaptive': False,
+            'min_interval': '5 minutes',
+            'max_interval': '6 hours',
+            'retry_delay': '1 minute',
+            'stale_after': ''
+        },
+        'cache': {
+            'snapshot_file': '',
+            'response_cache_size': 10000,
+            'change_generations': 100
+        },
+        'history': {
+            'file': '',
+            'retention': '52 weeks',
+            'downsample_after': '4 weeks'
+        },
+        'compression': {
+            'encodings': 'zstd, br, gzip',
+            'min_size': '1 KiB'
+        },
+        'metrics': {
+            'token': ''
+        },
+        'notifications': {
+            'token': '',
+            'delay': '5 seconds'
         }
     }  # type: Dict[str, Dict[str, Any]]
 
@@ -97,6 +191,14 @@ class Config:
     def server_prefix(self) -> str:
         return self._config['general']['server_prefix']
 
+    @property
+    def server(self) -> str:
+        return self._config['general']['server'].lower()
+
+    @property
+    def processes(self) -> int:
+        return int(self._config['general']['processes'])
+
     @property
     def debug(self) -> bool:
         return self._config['general']['debug'].lower() in ('true', 'yes', 't', 'y', '1')
@@ -121,6 +223,18 @@ class Config:
     def ldap_gid_attribute(self) -> str:
         return self._config['ldap']['gid_attribute']
 
+    @property
+    def ldap_pool_size(self) -> int:
+        return int(self._config['ldap']['pool_size'])
+
+    @property
+    def ldap_cache_ttl(self) -> datetime.timedelta:
+        return parse_timedelta(self._config['ldap']['cache_ttl'])
+
+    @property
+    def ldap_cache_size(self) -> int:
+        return int(self._config['ldap']['cache_size'])
+
     @property
     def jwt_auth_token_expires(self) -> datetime.timedelta:
         return parse_timedelta(self._config['jwt']['auth_token_expires'])
@@ -129,6 +243,10 @@ class Config:
     def jwt_secret_key(self) -> str:
         return self._config['jwt']['secret_key']
 
+    @property
+    def registry_id(self) -> str:
+        return self._config['registry']['id']
+
     @property
     def gitlab_base_url(self) -> str:
         return self._config['registry']['gitlab_base_url']
@@ -145,5 +263,142 @@ class Config:
     def access_token(self) -> str:
         return self._config['registry']['access_token']
 
+    @property
+    def incremental_refresh(self) -> bool:
+        return self._config['registry']['incremental_refresh'].lower() in ('true', 'yes', 't', 'y', '1')
+
+    @property
+    def workers(self) -> int:
+        return int(self._config['registry']['workers'])
+
+    @property
+    def refresh_interval(self) -> datetime.timedelta:
+        return parse_timedelta(self._config['refresh']['interval'])
+
+    @property
+    def refresh_jitter(self) -> float:
+        return float(self._config['refresh']['jitter'])
+
+    @property
+    def refresh_adaptive(self) -> bool:
+        return self._config['refresh']['adaptive'].lower() in ('true', 'yes', 't', 'y', '1')
+
+    @property
+    def refresh_min_interval(self) -> datetime.timedelta:
+        return parse_timedelta(self._config['refresh']['min_interval'])
+
+    @property
+    def refresh_max_interval(self) -> datetime.timedelta:
+        return parse_timedelta(self._config['refresh']['max_interval'])
+
+    @property
+    def refresh_retry_delay(self) -> datetime.timedelta:
+        return parse_timedelta(self._config['refresh']['retry_delay'])
+
+    @property
+    def refresh_stale_after(self) -> datetime.timedelta:
+        return self._stale_after(self.refresh_interval)
+
+    def _stale_after(self, refresh_interval: datetime.timedelta) -> datetime.timedelta:
+        stale_after = self._config['refresh']['stale_after']
+        if stale_after:
+            return parse_timedelta(stale_after)
+        # By default a snapshot is stale once two refreshes in a row are overdue
+        return 2 * (self.refresh_max_interval if self.refresh_adaptive else refresh_interval)
+
+    @property
+    def registries(self) -> List[RegistryConfig]:
+        """Return the default registry (the `[registry]` section) followed by the `[registry:<id>]` sections.
+
+        Keys which are missing in a `[registry:<id>]` section are taken from the `[registry]` section, except for the
+        urls (which are required) and the snapshot and history files (which are not shared). `interval` overrides the
+        refresh interval of the `[refresh]` section.
+        """
+        registry_ids = {self.registry_id}
+        if not re.match(REGISTRY_ID_PATTERN, self.registry_id):
+            raise InvalidRegistryIdError(self.registry_id)
+        registries = [
+            RegistryConfig(
+                self.registry_id, self.gitlab_base_url, self.registry_base_url, self.username, self.access_token,
+                self.incremental_refresh, self.workers, self.refresh_interval, self.refresh_stale_after,
+                self.cache_snapshot_file, self.history_file
+            )
+        ]
+        for section_name in self._config.sections():
+            if not section_name.startswith(REGISTRY_SECTION_PREFIX):
+                continue
+            registry_id = section_name[len(REGISTRY_SECTION_PREFIX):]
+            if not re.match(REGISTRY_ID_PATTERN, registry_id) or registry_id in registry_ids:
+                raise InvalidRegistryIdError(registry_id)
+            registry_ids.add(registry_id)
+            section = self._config[section_name]
+            for key in ('gitlab_base_url', 'registry_base_url'):
+                if not section.get(key):
+                    raise MissingConfigValueError(section_name, key)
+            default_section = self._config['registry']
+            refresh_interval = self.refresh_interval
+            if section.get('interval'):
+                refresh_interval = parse_timedelta(section['interval'])
+            registries.append(
+                RegistryConfig(
+                    registry_id, section['gitlab_base_url'], section['registry_base_url'],
+                    section.get('username', default_section['username']),
+                    section.get('access_token', default_section['access_token']),
+                    section.get('incremental_refresh', default_section['incremental_refresh']).lower()
+                    in ('true', 'yes', 't', 'y', '1'),
+                    int(section.get('workers', default_section['workers'])), refresh_interval,
+                    self._stale_after(refresh_interval), section.get('snapshot_file') or None,
+                    section.get('history_file') or None
+                )
+            )
+        return registries
+
+    @property
+    def cache_snapshot_file(self) -> Optional[str]:
+        return self._config['cache']['snapshot_file'] or None
+
+    @property
+    def cache_response_cache_size(self) -> int:
+        return int(self._config['cache']['response_cache_size'])
+
+    @property
+    def cache_change_generations(self) -> int:
+        return int(self._config['cache']['change_generations'])
+
+    @property
+    def history_file(self) -> Optional[str]:
+        return self._config['history']['file'] or None
+
+    @property
+    def history_retention(self) -> datetime.timedelta:
+        return parse_timedelta(self._config['history']['retention'])
+
+    @property
+    def history_downsample_after(self) -> datetime.timedelta:
+        return parse_timedelta(self._config['history']['downsample_after'])
+
+    @property
+    def compression_encodings(self) -> List[str]:
+        return [
+            content_encoding.strip().lower()
+            for content_encoding in self._config['compression']['encodings'].split(',') if content_encoding.strip()
+        ]
+
+    @property
+    def compression_min_size(self) -> int:
+        return parse_size(self._config['compression']['min_size'])
+
+    @property
+    def metrics_token(self) -> Optional[str]:
+        return self._config['metrics']['token'] or None
+
+    @property
+    def notifications_token(self) -> Optional[str]:
+        return self._config['notifications']['token'] or None
+
+    @property
+    def notifications_delay(self) -> datetime.timedelta:
+        return parse_timedelta(self._config['notifications']['delay'])
+
 
 config = Config(None)
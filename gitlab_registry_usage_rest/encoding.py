@@ -0,0 +1,105 @@
+import json
+import logging
+import zlib
+from werkzeug.datastructures import Accept
+from typing import Any, Callable, Iterable, Iterator, List, Sequence, Tuple  # noqa: F401
+
+# Optional dependencies of the `speedups` extra, without them the service uses gzip and the standard json module
+try:
+    import brotli
+except ImportError:
+    brotli = None  # type: ignore
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+GZIP_COMPRESS_LEVEL = 6
+# Brotli and zstd levels which compress better than gzip level 6 in a comparable time (the brotli default of 11 is
+# meant for static files and far too slow for api responses)
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+# All supported content codings, in the order of preference if a client accepts several of them equally
+CONTENT_ENCODINGS = ('zstd', 'br', 'gzip')
+
+
+def is_content_encoding_available(content_encoding: str) -> bool:
+    if content_encoding == 'br':
+        return brotli is not None
+    if content_encoding == 'zstd':
+        return zstandard is not None
+    return content_encoding == 'gzip'
+
+
+def available_content_encodings(content_encodings: Iterable[str]) -> Tuple[str, ...]:
+    """Return the given content codings (in the given order) which are supported and whose module is installed."""
+    available_encodings = []  # type: List[str]
+    for content_encoding in content_encodings:
+        if content_encoding not in CONTENT_ENCODINGS:
+            logger.warning('Ignoring the unknown content coding "%s"', content_encoding)
+        elif not is_content_encoding_available(content_encoding):
+            logger.warning('Ignoring the content coding "%s", its module is not installed', content_encoding)
+        else:
+            available_encodings.append(content_encoding)
+    return tuple(available_encodings)
+
+
+def negotiate_content_encoding(accept_encodings: Accept, content_encodings: Sequence[str]) -> str:
+    """Return the content coding with the highest quality in `accept_encodings`, the earlier one of `content_encodings`
+    for equal qualities (`identity` if the client accepts none of them)."""
+    best_encoding, best_quality = 'identity', 0.0
+    for content_encoding in content_encodings:
+        quality = accept_encodings[content_encoding]
+        if quality > best_quality:
+            best_encoding, best_quality = content_encoding, quality
+    return best_encoding
+
+
+def _compressor(content_encoding: str) -> Tuple[Callable[[bytes], bytes], Callable[[], bytes]]:
+    """Return a function which compresses the next chunk of a body and a function which finishes the body."""
+    if content_encoding == 'br':
+        brotli_compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return brotli_compressor.process, brotli_compressor.finish
+    if content_encoding == 'zstd':
+        zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return zstd_compressor.compress, zstd_compressor.flush
+    if content_encoding == 'gzip':
+        gzip_compressor = zlib.compressobj(GZIP_COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return gzip_compressor.compress, gzip_compressor.flush
+    raise ValueError('Unsupported content coding "{}"'.format(content_encoding))
+
+
+def compress(body: bytes, content_encoding: str) -> bytes:
+    compress_chunk, finish = _compressor(content_encoding)
+    return compress_chunk(body) + finish()
+
+
+def compress_chunks(chunks: Iterable[bytes], content_encoding: str) -> Iterator[bytes]:
+    """Compress a streamed body chunk by chunk (`identity` passes the chunks through)."""
+    if content_encoding == 'identity':
+        yield from chunks
+        return
+    compress_chunk, finish = _compressor(content_encoding)
+    for chunk in chunks:
+        compressed_chunk = compress_chunk(chunk)
+        if compressed_chunk:
+            yield compressed_chunk
+    yield finish()
+
+
+def encode_json(data: Any, indent: bool = False) -> bytes:
+    """Encode `data` as compact JSON with a trailing newline (like `flask_restful`), with `orjson` if it is installed.
+
+    With `indent` (debug mode), the document is indented with the standard json module.
+    """
+    if indent:
+        return (json.dumps(data, indent=4) + '\n').encode('utf-8')
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)  # type: ignore
+    return (json.dumps(data, separators=(',', ':')) + '\n').encode('utf-8')
@@ -0,0 +1,24 @@
+from typing import Any, Dict, Optional  # noqa: F401  # pylint: disable=unused-import
+
+
+class ApiError(Exception):
+    """Error which is sent to the client as json document with a message and the given status code."""
+
+    def __init__(self, message: str, status_code: int, payload: Optional[Any] = None) -> None:
+        super().__init__(message)
+        self._message = message
+        self._status_code = status_code
+        self._payload = payload
+
+    def to_dict(self) -> Dict[str, Any]:
+        rv = dict(self._payload or ())
+        rv['message'] = self._message
+        return rv
+
+    @property
+    def message(self) -> str:
+        return self._message
+
+    @property
+    def status_code(self) -> int:
+        return self._status_code
@@ -0,0 +1,80 @@
+import csv
+import io
+import json
+from .cache import RegistrySnapshot
+from .encoding import compress_chunks
+from typing import Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_FIELDS = ('type', 'repository', 'tag', 'size', 'disk_size', 'reclaimable_size')
+# Rows are encoded into chunks of about this size, so a response needs a bounded amount of memory
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+ExportRow = Tuple[str, str, Optional[str], Optional[int], Optional[int], Optional[int]]
+ExportValues = Tuple[Union[str, int, None], ...]
+
+
+def export_rows(snapshot: RegistrySnapshot) -> Iterator[ExportRow]:
+    """Yield one row per repository, followed by one row per tag of that repository (in catalog order)."""
+    registry = snapshot.registry
+    layers = snapshot.index.layers
+    for repository_id, repository in enumerate(registry.registry_catalog):
+        size = registry.repository_size(repository_id)
+        if size is None:
+            yield 'repository', repository, None, None, None, None
+            continue
+        yield (
+            'repository', repository, None, size, registry.repository_disk_size(repository_id),
+            layers.repository_reclaimable_size_by_id(repository_id)
+        )
+        for tag_id in registry.repository_tag_ids(repository_id):
+            yield (
+                'tag', repository, registry.tag_name(tag_id), registry.tag_size(tag_id), registry.tag_disk_size(tag_id),
+                layers.tag_reclaimable_size_by_id(tag_id)
+            )
+
+
+def _select_fields(rows: Iterable[ExportRow], fields: Sequence[str]) -> Iterator[ExportValues]:
+    field_indices = [EXPORT_FIELDS.index(field) for field in fields]
+    for row in rows:
+        yield tuple(row[field_index] for field_index in field_indices)
+
+
+def _encode_ndjson(rows: Iterable[ExportValues], fields: Sequence[str]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), separators=(',', ':')) + '\n'
+
+
+def _encode_csv(rows: Iterable[ExportValues], fields: Sequence[str]) -> Iterator[str]:
+    line_buffer = io.StringIO()
+    # `None` values are written as empty cells
+    writer = csv.writer(line_buffer, lineterminator='\n')
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow(row)
+        yield line_buffer.getvalue()
+        line_buffer.seek(0)
+        line_buffer.truncate()
+    yield line_buffer.getvalue()
+
+
+def _chunked(lines: Iterable[str]) -> Iterator[bytes]:
+    chunk = io.StringIO()
+    for line in lines:
+        chunk.write(line)
+        if chunk.tell() >= EXPORT_CHUNK_SIZE:
+            yield chunk.getvalue().encode('utf-8')
+            chunk.seek(0)
+            chunk.truncate()
+    if chunk.tell() > 0:
+        yield chunk.getvalue().encode('utf-8')
+
+
+def stream_export(
+    snapshot: RegistrySnapshot, export_format: str, fields: Sequence[str], content_encoding: str = 'identity'
+) -> Iterator[bytes]:
+    """Encode the repositories and tags of `snapshot` as NDJSON or CSV rows (with the given `fields`) on the fly."""
+    rows = _select_fields(export_rows(snapshot), fields)
+    lines = _encode_csv(rows, fields) if export_format == 'csv' else _encode_ndjson(rows, fields)
+    chunks = _chunked(lines)
+    return compress_chunks(chunks, content_encoding)
@@ -0,0 +1,195 @@
+import datetime
+import sqlite3
+import threading
+from typing import cast, Dict, List, Mapping, NamedTuple, Optional, Tuple  # noqa: F401  # pylint: disable=unused-import
+
+MAINTENANCE_INTERVAL = 24 * 60 * 60
+SECONDS_PER_DAY = 24 * 60 * 60
+
+UsageSample = NamedTuple('UsageSample', [('timestamp', int), ('size', Optional[int]), ('disk_size', Optional[int])])
+UsageGrowth = NamedTuple(
+    'UsageGrowth', [('name', str), ('size', int), ('size_delta', int), ('disk_size', int), ('disk_size_delta', int)]
+)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS repositories (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS samples (
+    repository_id INTEGER NOT NULL REFERENCES repositories (id),
+    timestamp INTEGER NOT NULL,
+    size INTEGER,
+    disk_size INTEGER,
+    PRIMARY KEY (repository_id, timestamp)
+) WITHOUT ROWID;
+'''
+
+
+class UsageHistory:
+    """Time series of repository sizes, stored in a sqlite database.
+
+    To stay small, a sample is only stored when the usage of a repository has changed since its previous sample, so the
+    values of a sample are valid until the next sample of the same repository. Removed repositories get a sample
+    without sizes. Samples older than `downsample_after` are thinned out to one sample per day and samples older than
+    `retention` are deleted (except for the last one before the retention limit, which is the baseline for later
+    samples).
+
+    A `read_only` history (in processes which do not record samples themselves) reloads its in-memory state from the
+    database to see the samples written by other processes. The recording process writes the samples of a refresh
+    before it publishes the snapshot, so the state is only reloaded when a query passes a new snapshot `generation`
+    (or none at all).
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        retention: datetime.timedelta = datetime.timedelta(weeks=52),
+        downsample_after: datetime.timedelta = datetime.timedelta(weeks=4),
+        read_only: bool = False
+    ) -> None:
+        self._retention = retention
+        self._downsample_after = downsample_after
+        self._read_only = read_only
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+        self._last_maintenance = None  # type: Optional[float]
+        self._loaded_generation = None  # type: Optional[int]
+        self._load_state()
+
+    def _load_state(self) -> None:
+        self._repository_ids = {
+            name: repository_id
+            for repository_id, name in self._connection.execute('SELECT id, name FROM repositories')
+        }  # type: Dict[str, int]
+        # Latest sample of every repository, used to detect changes without querying the database
+        self._latest_usages = {
+            repository_id: (size, disk_size)
+            for repository_id, size, disk_size, _ in self._connection.execute(
+                'SELECT repository_id, size, disk_size, MAX(timestamp) FROM samples GROUP BY repository_id'
+            )
+        }  # type: Dict[int, Tuple[Optional[int], Optional[int]]]
+
+    def _reload_state(self, generation: Optional[int]) -> None:
+        if self._read_only and (generation is None or generation != self._loaded_generation):
+            self._load_state()
+            self._loaded_generation = generation
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _repository_id(self, name: str) -> int:
+        if name not in self._repository_ids:
+            cursor = self._connection.execute('INSERT INTO repositories (name) VALUES (?)', (name, ))
+            self._repository_ids[name] = cast(int, cursor.lastrowid)
+        return self._repository_ids[name]
+
+    def record(
+        self,
+        timestamp: float,
+        repository_sizes: Mapping[str, Optional[int]],
+        repository_disk_sizes: Mapping[str, Optional[int]],
+        partial: bool = False
+    ) -> int:
+        """Store the usage of all repositories at `timestamp` and return the number of written samples.
+
+        A `partial` record only holds the repositories which changed, the other repositories are not marked as removed.
+        """
+        if self._read_only:
+            raise sqlite3.OperationalError('The usage history is opened read-only')
+        samples = []  # type: List[Tuple[int, int, Optional[int], Optional[int]]]
+        with self._lock, self._connection:
+            current_repository_ids = set()
+            for name, size in repository_sizes.items():
+                repository_id = self._repository_id(name)
+                current_repository_ids.add(repository_id)
+                usage = (size, repository_disk_sizes.get(name))
+                if self._latest_usages.get(repository_id) != usage:
+                    samples.append((repository_id, int(timestamp), usage[0], usage[1]))
+                    self._latest_usages[repository_id] = usage
+            for repository_id, usage in self._latest_usages.items() if not partial else ():
+                if repository_id not in current_repository_ids and usage != (None, None):
+                    samples.append((repository_id, int(timestamp), None, None))
+                    self._latest_usages[repository_id] = (None, None)
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO samples (repository_id, timestamp, size, disk_size) VALUES (?, ?, ?, ?)',
+                samples
+            )
+            if self._last_maintenance is None or timestamp - self._last_maintenance >= MAINTENANCE_INTERVAL:
+                self._maintain(int(timestamp))
+                self._last_maintenance = timestamp
+        return len(samples)
+
+    def _maintain(self, timestamp: int) -> None:
+        downsample_limit = timestamp - int(self._downsample_after.total_seconds())
+        retention_limit = timestamp - int(self._retention.total_seconds())
+        # Keep only the last sample per repository and day
+        self._connection.execute(
+            '''
+            DELETE FROM samples WHERE timestamp < :limit AND EXISTS (
+                SELECT 1 FROM samples AS newer
+                WHERE newer.repository_id = samples.repository_id AND newer.timestamp > samples.timestamp
+                AND newer.timestamp / :day = samples.timestamp / :day
+            )
+            ''', {
+                'limit': downsample_limit,
+                'day': SECONDS_PER_DAY
+            }
+        )
+        self._connection.execute(
+            '''
+            DELETE FROM samples WHERE timestamp < :limit AND EXISTS (
+                SELECT 1 FROM samples AS newer
+                WHERE newer.repository_id = samples.repository_id AND newer.timestamp > samples.timestamp
+                AND newer.timestamp <= :limit
+            )
+            ''', {'limit': retention_limit}
+        )
+
+    def samples(self, name: str, since: float = 0, generation: Optional[int] = None) -> Optional[List[UsageSample]]:
+        """Return all samples of a repository since the given timestamp, starting with the sample valid at `since`."""
+        with self._lock:
+            self._reload_state(generation)
+            if name not in self._repository_ids:
+                return None
+            rows = self._connection.execute(
+                '''
+                SELECT timestamp, size, disk_size FROM samples WHERE repository_id = :id AND timestamp >= (
+                    SELECT COALESCE(MAX(timestamp), 0) FROM samples WHERE repository_id = :id AND timestamp <= :since
+                ) ORDER BY timestamp
+                ''', {
+                    'id': self._repository_ids[name],
+                    'since': int(since)
+                }
+            ).fetchall()
+        return [UsageSample(*row) for row in rows]
+
+    def growth(self, since: float, limit: int, generation: Optional[int] = None) -> List[UsageGrowth]:
+        """Return the repositories with the largest size increase since the given timestamp."""
+        with self._lock:
+            self._reload_state(generation)
+            previous_usages = {
+                repository_id: (size, disk_size)
+                for repository_id, size, disk_size, _ in self._connection.execute(
+                    '''
+                    SELECT repository_id, size, disk_size, MAX(timestamp) FROM samples WHERE timestamp <= ?
+                    GROUP BY repository_id
+                    ''', (int(since), )
+                )
+            }
+            growths = []  # type: List[UsageGrowth]
+            for name, repository_id in self._repository_ids.items():
+                size, disk_size = self._latest_usages.get(repository_id, (None, None))
+                if size is None:
+                    continue
+                disk_size = disk_size or 0
+                previous_size, previous_disk_size = previous_usages.get(repository_id, (None, None))
+                growths.append(
+                    UsageGrowth(
+                        name, size, size - (previous_size or 0), disk_size, disk_size - (previous_disk_size or 0)
+                    )
+                )
+        growths.sort(key=lambda growth: (-growth.size_delta, growth.name))
+        return growths[:limit]
@@ -0,0 +1,291 @@
+import copy
+from array import array
+from itertools import accumulate, chain
+from .compact import CompactRegistry, RegistryPatch
+from .layers import LayerIndex
+from .search import SearchIndex
+from .tables import move_sorted_ids, StringIndex, StringTable
+from typing import (  # noqa: F401  # pylint: disable=unused-import
+    cast, Callable, Dict, List, Mapping, NamedTuple, Optional, Set, Tuple
+)
+
+SORT_KEYS = ('name', 'size', 'disk_size')
+ROOT_NAMESPACE = ''
+
+NamespaceUsage = NamedTuple(
+    'NamespaceUsage', [
+        ('size', int), ('disk_size', int), ('repository_count', int), ('namespaces', List[str]),
+        ('repositories', List[str])
+    ]
+)
+
+
+def parent_namespace(path: str) -> str:
+    return path.rsplit('/', 1)[0] if '/' in path else ROOT_NAMESPACE
+
+
+def _repository_layer_ids(gitlab_registry: CompactRegistry, repository_id: int) -> Set[int]:
+    return set(
+        layer_id for tag_id in gitlab_registry.repository_tag_ids(repository_id)
+        for layer_id in gitlab_registry.tag_layer_ids(tag_id)
+    )
+
+
+def build_namespace_usages(gitlab_registry: CompactRegistry) -> Dict[str, NamespaceUsage]:
+    """Aggregate the repository usage for every namespace (path prefix) of the registry catalog.
+
+    A namespace contains all repositories below its path and a repository with the same path (GitLab stores the default
+    image of the project `group/project` as `group/project` and additional images as `group/project/<image>`). The disk
+    size of a namespace counts every layer which is used in the namespace once.
+    """
+    registry_catalog = gitlab_registry.registry_catalog
+    namespace_paths = {ROOT_NAMESPACE}  # type: Set[str]
+    for repository in registry_catalog:
+        path = parent_namespace(repository)
+        while path not in namespace_paths:
+            namespace_paths.add(path)
+            path = parent_namespace(path)
+    sizes = dict.fromkeys(namespace_paths, 0)  # type: Dict[str, int]
+    layer_ids = {path: set() for path in namespace_paths}  # type: Dict[str, Set[int]]
+    repository_counts = dict.fromkeys(namespace_paths, 0)  # type: Dict[str, int]
+    child_namespaces = {path: [] for path in namespace_paths}  # type: Dict[str, List[str]]
+    child_repositories = {path: [] for path in namespace_paths}  # type: Dict[str, List[str]]
+    for path in namespace_paths:
+        if path != ROOT_NAMESPACE:
+            child_namespaces[parent_namespace(path)].append(path)
+    for repository_id, repository in enumerate(registry_catalog):
+        path = repository if repository in namespace_paths else parent_namespace(repository)
+        child_repositories[path].append(repository)
+        repository_layer_ids = _repository_layer_ids(gitlab_registry, repository_id)
+        while True:
+            sizes[path] += gitlab_registry.repository_size(repository_id) or 0
+            layer_ids[path].update(repository_layer_ids)
+            repository_counts[path] += 1
+            if path == ROOT_NAMESPACE:
+                break
+            path = parent_namespace(path)
+    return {
+        path: NamespaceUsage(
+            sizes[path], sum(map(gitlab_registry.layer_size, layer_ids[path])), repository_counts[path],
+            sorted(child_namespaces[path]), sorted(child_repositories[path])
+        )
+        for path in namespace_paths
+    }
+
+
+def _is_in_namespace(repository: str, path: str) -> bool:
+    return path == ROOT_NAMESPACE or repository == path or repository.startswith(path + '/')
+
+
+def _sized_repository_key(
+    gitlab_registry: CompactRegistry, sort_key: str
+) -> Callable[[int], Optional[Tuple[int, str]]]:
+    """Return the key of the repositories sorted by a size (`None` for repositories without size information)."""
+    size = gitlab_registry.repository_size if sort_key == 'size' else gitlab_registry.repository_disk_size
+
+    def key(repository_id: int) -> Optional[Tuple[int, str]]:
+        repository_size = size(repository_id)
+        if repository_size is None:
+            return None
+        return repository_size, gitlab_registry.repository_name(repository_id)
+
+    return key
+
+
+def _unsized_repository_key(gitlab_registry: CompactRegistry) -> Callable[[int], Optional[str]]:
+    """Return the key of the repositories without size information (`None` for the others)."""
+    return lambda repository_id: (
+        gitlab_registry.repository_name(repository_id)
+        if gitlab_registry.repository_size(repository_id) is None else None
+    )
+
+
+class _NamespaceTable:
+    """The namespace usages of `build_namespace_usages` in flat buffers (like `CompactRegistry`), a `NamespaceUsage` is
+    built on access."""
+
+    def __init__(self, gitlab_registry: CompactRegistry, namespace_usages: Dict[str, NamespaceUsage]) -> None:
+        self._registry = gitlab_registry
+        paths = sorted(namespace_usages)
+        usages = [namespace_usages[path] for path in paths]
+        path_ids = {path: path_id for path_id, path in enumerate(paths)}
+        repository_ids = {
+            repository: repository_id for repository_id, repository in enumerate(gitlab_registry.registry_catalog)
+        }
+        self._paths = StringIndex(StringTable(paths))
+        self._sizes = array('q', (usage.size for usage in usages))
+        self._disk_sizes = array('q', (usage.disk_size for usage in usages))
+        self._repository_counts = array('Q', (usage.repository_count for usage in usages))
+        # Child namespaces and repositories of every namespace, as flat arrays with start offsets
+        self._namespace_offsets = array('Q', accumulate(chain((0, ), (len(usage.namespaces) for usage in usages))))
+        self._namespace_ids = array('I', (path_ids[path] for usage in usages for path in usage.namespaces))
+        self._repository_offsets = array(
+            'Q', accumulate(chain((0, ), (len(usage.repositories) for usage in usages)))
+        )
+        self._repository_ids = array(
+            'I', (repository_ids[repository] for usage in usages for repository in usage.repositories)
+        )
+
+    def _namespace_path_ids(self, repository: str) -> List[int]:
+        """Return the ids of the namespaces which contain a repository."""
+        path = repository if self._paths.find(repository) is not None else parent_namespace(repository)
+        path_ids = [cast(int, self._paths.find(path))]
+        while path != ROOT_NAMESPACE:
+            path = parent_namespace(path)
+            path_ids.append(cast(int, self._paths.find(path)))
+        return path_ids
+
+    def patched(self, gitlab_registry: CompactRegistry, registry_patch: RegistryPatch) -> '_NamespaceTable':
+        """Return the table of `gitlab_registry`, which `registry_patch` patched from the registry of this table.
+
+        Only the usages of the namespaces of the refreshed repositories change: their sizes by the size differences of
+        the repositories and their disk sizes by the layers which the refreshed repositories of a namespace use before
+        but not after the refresh or the other way round (unless other repositories of the namespace use them).
+        """
+        previous_registry = self._registry
+        table = copy.copy(self)
+        table._registry = gitlab_registry
+        table._sizes = self._sizes[:]
+        table._disk_sizes = self._disk_sizes[:]
+        namespace_repository_ids = {}  # type: Dict[int, List[int]]
+        for repository_id in registry_patch.repository_ids:
+            size_delta = (
+                (gitlab_registry.repository_size(repository_id) or 0) -
+                (previous_registry.repository_size(repository_id) or 0)
+            )
+            for path_id in self._namespace_path_ids(gitlab_registry.repository_name(repository_id)):
+                table._sizes[path_id] += size_delta
+                namespace_repository_ids.setdefault(path_id, []).append(repository_id)
+        previous_layer_ids = {
+            repository_id: _repository_layer_ids(previous_registry, repository_id)
+            for repository_id in registry_patch.repository_ids
+        }
+        layer_ids = {
+            repository_id: _repository_layer_ids(gitlab_registry, repository_id)
+            for repository_id in registry_patch.repository_ids
+        }
+        refreshed_repository_ids = set(registry_patch.repository_ids)
+        for path_id, repository_ids in namespace_repository_ids.items():
+            path = self._paths.strings[path_id]
+            namespace_previous_layer_ids = set()  # type: Set[int]
+            namespace_layer_ids = set()  # type: Set[int]
+            for repository_id in repository_ids:
+                namespace_previous_layer_ids.update(previous_layer_ids[repository_id])
+                namespace_layer_ids.update(layer_ids[repository_id])
+            for layer_id in namespace_previous_layer_ids ^ namespace_layer_ids:
+                if any(
+                    repository_id not in refreshed_repository_ids and
+                    _is_in_namespace(gitlab_registry.repository_name(repository_id), path)
+                    for repository_id in map(gitlab_registry.tag_repository_id, gitlab_registry.layer_tag_ids(layer_id))
+                ):
+                    continue
+                layer_size = gitlab_registry.layer_size(layer_id)
+                table._disk_sizes[path_id] += layer_size if layer_id in namespace_layer_ids else -layer_size
+        return table
+
+    def get(self, path: str) -> Optional[NamespaceUsage]:
+        path_id = self._paths.find(path)
+        if path_id is None:
+            return None
+        return NamespaceUsage(
+            self._sizes[path_id], self._disk_sizes[path_id], self._repository_counts[path_id], [
+                self._paths.strings[child_id] for child_id in
+                self._namespace_ids[self._namespace_offsets[path_id]:self._namespace_offsets[path_id + 1]]
+            ], [
+                self._registry.repository_name(repository_id) for repository_id in
+                self._repository_ids[self._repository_offsets[path_id]:self._repository_offsets[path_id + 1]]
+            ]
+        )
+
+
+class RegistryIndex:
+    """Lookup structures which are built once per registry snapshot, so that requests do not need to scan or sort the
+    whole registry catalog.
+
+    Like the registry itself, the structures consist of flat buffers which refer to repositories by their id in the
+    `CompactRegistry`.
+    """
+
+    def __init__(self, gitlab_registry: CompactRegistry) -> None:
+        registry_catalog = gitlab_registry.registry_catalog
+        size_columns = {
+            'size': gitlab_registry.repository_size,
+            'disk_size': gitlab_registry.repository_disk_size,
+        }
+        self._registry = gitlab_registry
+        self._repository_count = len(registry_catalog)
+        name_sorted_ids = sorted(range(len(registry_catalog)), key=registry_catalog.__getitem__)
+        self._sorted_repository_ids = {'name': array('I', name_sorted_ids)}  # type: Dict[str, array[int]]
+        for sort_key, size in size_columns.items():
+            self._sorted_repository_ids[sort_key] = array(
+                'I',
+                sorted(
+                    (repository_id for repository_id in name_sorted_ids if size(repository_id) is not None),
+                    key=lambda repository_id, size=size: (  # type: ignore
+                        size(repository_id), registry_catalog[repository_id]
+                    )
+                )
+            )
+        # Repositories without size information (their tags could not be read) are always sorted last
+        self._unsized_repository_ids = array(
+            'I', (repository_id for repository_id in name_sorted_ids if size_columns['size'](repository_id) is None)
+        )
+        self._namespace_usages = _NamespaceTable(gitlab_registry, build_namespace_usages(gitlab_registry))
+        self._layer_index = LayerIndex(gitlab_registry)
+        self._search_index = SearchIndex(gitlab_registry, self._sorted_repository_ids['name'])
+
+    def patched(self, gitlab_registry: CompactRegistry, registry_patch: RegistryPatch) -> 'RegistryIndex':
+        """Return the index of `gitlab_registry`, which `registry_patch` patched from the registry of this index (see
+        `CompactRegistry.patched`), by moving and updating only the changed repositories and layers."""
+        previous_registry = self._registry
+        index = copy.copy(self)
+        index._registry = gitlab_registry
+        index._sorted_repository_ids = dict(self._sorted_repository_ids)
+        for sort_key in ('size', 'disk_size'):
+            index._sorted_repository_ids[sort_key] = self._sorted_repository_ids[sort_key][:]
+            move_sorted_ids(
+                index._sorted_repository_ids[sort_key], registry_patch.changed_repository_ids,
+                _sized_repository_key(previous_registry, sort_key), _sized_repository_key(gitlab_registry, sort_key)
+            )
+        index._unsized_repository_ids = self._unsized_repository_ids[:]
+        move_sorted_ids(
+            index._unsized_repository_ids, registry_patch.repository_ids,
+            _unsized_repository_key(previous_registry), _unsized_repository_key(gitlab_registry)
+        )
+        index._namespace_usages = self._namespace_usages.patched(gitlab_registry, registry_patch)
+        index._layer_index = self._layer_index.patched(gitlab_registry, registry_patch)
+        index._search_index = self._search_index.patched(gitlab_registry, registry_patch)
+        return index
+
+    def sorted_repositories(self, sort_key: str, descending: bool, start: int, stop: int) -> List[str]:
+        """Return the slice `[start:stop]` of all repositories in the given order without building the whole list."""
+        sorted_ids = self._sorted_repository_ids[sort_key]
+        sized_count = len(sorted_ids)
+        start, stop = max(start, 0), min(stop, self._repository_count)
+        if start >= stop:
+            return []
+        if descending:
+            # Map the slice of the reversed list to the ascending list
+            repository_ids = list(
+                sorted_ids[max(sized_count - stop, 0):max(sized_count - start, 0)]
+            )[::-1] if start < sized_count else []
+        else:
+            repository_ids = list(sorted_ids[start:stop])
+        if stop > sized_count:
+            repository_ids.extend(self._unsized_repository_ids[max(start - sized_count, 0):stop - sized_count])
+        return [self._registry.repository_name(repository_id) for repository_id in repository_ids]
+
+    def namespace_usage(self, path: str = ROOT_NAMESPACE) -> Optional[NamespaceUsage]:
+        return self._namespace_usages.get(path)
+
+    @property
+    def repository_count(self) -> int:
+        return self._repository_count
+
+    @property
+    def layers(self) -> LayerIndex:
+        return self._layer_index
+
+    @property
+    def search(self) -> SearchIndex:
+        return self._search_index
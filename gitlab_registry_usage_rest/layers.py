@@ -0,0 +1,150 @@
+import copy
+from array import array
+from .compact import CompactRegistry, RegistryPatch
+from .tables import move_sorted_ids
+from typing import cast, Dict, List, NamedTuple, Optional, Tuple  # noqa: F401  # pylint: disable=unused-import
+
+LayerUsage = NamedTuple(
+    'LayerUsage', [('digest', str), ('size', int), ('tag_count', int), ('repositories', List[str])]
+)
+TagReference = NamedTuple('TagReference', [('repository', str), ('tag', str)])
+
+
+class LayerIndex:
+    """Reclaimable sizes and shared layers of the tags and layers of a `CompactRegistry`.
+
+    The index is built on the id tables of the registry (layer ids, tag ids, the layer ids of every tag and the tag ids
+    of every layer) and only adds typed arrays indexed by these ids: the reclaimable sizes of every tag and repository
+    and the ids of the shared layers. Digests, tag names, the tags of a layer and the tag lookup (a binary search in the
+    sorted tag ids) are those of the registry.
+
+    The registry garbage collection frees a layer as soon as no tag references it anymore, so the reclaimable size of a
+    tag (or repository) is the size of all layers which are only referenced by this tag (or repository).
+    """
+
+    def __init__(self, gitlab_registry: CompactRegistry) -> None:
+        self._registry = gitlab_registry
+        self._tag_reclaimable_sizes = array('q', bytes(8 * gitlab_registry.tag_count))
+        self._repository_reclaimable_sizes = array('q', bytes(8 * gitlab_registry.repository_count))
+        for repository_id in range(gitlab_registry.repository_count):
+            for tag_id in gitlab_registry.repository_tag_ids(repository_id):
+                self._tag_reclaimable_sizes[tag_id] = self._tag_reclaimable_size(tag_id)
+            self._repository_reclaimable_sizes[repository_id] = self._repository_reclaimable_size(repository_id)
+        # Layers which are referenced by more than one tag, the largest first
+        self._shared_layer_ids = array(
+            'I',
+            sorted(
+                (
+                    layer_id for layer_id in range(gitlab_registry.layer_count)
+                    if gitlab_registry.layer_reference_count(layer_id) > 1
+                ),
+                key=lambda layer_id: cast(Tuple[int, str], self._shared_layer_key(layer_id))
+            )
+        )
+
+    def patched(self, gitlab_registry: CompactRegistry, registry_patch: RegistryPatch) -> 'LayerIndex':
+        """Return the index of `gitlab_registry`, which `registry_patch` patched from the registry of this index.
+
+        Only the reference counts of the patched layers changed, so besides the refreshed repositories only the tags
+        which are the only reference of such a layer before or after the patch and the repositories which hold all
+        references of such a layer are updated.
+        """
+        previous_registry = self._registry
+        tag_ids = set(range(registry_patch.first_tag_id, gitlab_registry.tag_count))
+        repository_ids = set(registry_patch.repository_ids)
+        for layer_id in registry_patch.layer_ids:
+            layer_tag_ids = gitlab_registry.layer_tag_ids(layer_id)
+            previous_layer_tag_ids = (
+                previous_registry.layer_tag_ids(layer_id) if layer_id < previous_registry.layer_count else array('I')
+            )
+            if len(layer_tag_ids) == 1 or len(previous_layer_tag_ids) == 1:
+                tag_ids.update(layer_tag_ids)
+            for registry, row in ((previous_registry, previous_layer_tag_ids), (gitlab_registry, layer_tag_ids)):
+                if row and all(
+                    registry.tag_repository_id(tag_id) == registry.tag_repository_id(row[0]) for tag_id in row
+                ):
+                    repository_ids.add(registry.tag_repository_id(row[0]))
+        index = copy.copy(self)
+        index._registry = gitlab_registry
+        index._tag_reclaimable_sizes = self._tag_reclaimable_sizes[:]
+        index._tag_reclaimable_sizes.extend(
+            array('q', bytes(8 * (gitlab_registry.tag_count - registry_patch.first_tag_id)))
+        )
+        index._repository_reclaimable_sizes = self._repository_reclaimable_sizes[:]
+        index._shared_layer_ids = self._shared_layer_ids[:]
+        for tag_id in tag_ids:
+            index._tag_reclaimable_sizes[tag_id] = index._tag_reclaimable_size(tag_id)
+        for repository_id in repository_ids:
+            index._repository_reclaimable_sizes[repository_id] = index._repository_reclaimable_size(repository_id)
+        move_sorted_ids(
+            index._shared_layer_ids, registry_patch.layer_ids, self._shared_layer_key, index._shared_layer_key
+        )
+        return index
+
+    def _tag_reclaimable_size(self, tag_id: int) -> int:
+        return sum(
+            self._registry.layer_size(layer_id) for layer_id in self._registry.tag_unique_layer_ids(tag_id)
+            if self._registry.layer_reference_count(layer_id) == 1
+        )
+
+    def _repository_reclaimable_size(self, repository_id: int) -> int:
+        repository_reference_counts = {}  # type: Dict[int, int]
+        for tag_id in self._registry.repository_tag_ids(repository_id):
+            for layer_id in self._registry.tag_unique_layer_ids(tag_id):
+                repository_reference_counts[layer_id] = repository_reference_counts.get(layer_id, 0) + 1
+        return sum(
+            self._registry.layer_size(layer_id)
+            for layer_id, reference_count in repository_reference_counts.items()
+            if self._registry.layer_reference_count(layer_id) == reference_count
+        )
+
+    def _shared_layer_key(self, layer_id: int) -> Optional[Tuple[int, str]]:
+        """Return the sort key of a shared layer (`None` if the layer is not shared)."""
+        if layer_id >= self._registry.layer_count or self._registry.layer_reference_count(layer_id) <= 1:
+            return None
+        return -self._registry.layer_size(layer_id), self._registry.layer_digest(layer_id)
+
+    def _tag_references(self, layer_id: int) -> List[TagReference]:
+        return sorted(
+            TagReference(self._registry.tag_repository(tag_id), self._registry.tag_name(tag_id))
+            for tag_id in self._registry.layer_tag_ids(layer_id)
+        )
+
+    def _layer_usage(self, layer_id: int) -> LayerUsage:
+        tag_references = self._tag_references(layer_id)
+        return LayerUsage(
+            self._registry.layer_digest(layer_id), self._registry.layer_size(layer_id), len(tag_references),
+            sorted(set(tag_reference.repository for tag_reference in tag_references))
+        )
+
+    def layer_usage(self, digest: str) -> Optional[LayerUsage]:
+        layer_id = self._registry.layer_id(digest)
+        return self._layer_usage(layer_id) if layer_id is not None else None
+
+    def layer_tags(self, digest: str) -> Optional[List[TagReference]]:
+        layer_id = self._registry.layer_id(digest)
+        return self._tag_references(layer_id) if layer_id is not None else None
+
+    def shared_layers(self, limit: int) -> List[LayerUsage]:
+        """Return the largest layers which are referenced by more than one tag."""
+        return [self._layer_usage(layer_id) for layer_id in self._shared_layer_ids[:limit]]
+
+    def tag_reclaimable_size(self, repository: str, tag: str) -> Optional[int]:
+        """Return the number of bytes which would be freed if the given tag was deleted."""
+        tag_id = self._registry.tag_id(repository, tag)
+        return self._tag_reclaimable_sizes[tag_id] if tag_id is not None else None
+
+    def repository_reclaimable_size(self, repository: str) -> Optional[int]:
+        """Return the number of bytes which would be freed if the given repository was deleted."""
+        repository_id = self._registry.repository_id(repository)
+        return self._repository_reclaimable_sizes[repository_id] if repository_id is not None else None
+
+    def tag_reclaimable_size_by_id(self, tag_id: int) -> int:
+        return self._tag_reclaimable_sizes[tag_id]
+
+    def repository_reclaimable_size_by_id(self, repository_id: int) -> int:
+        return self._repository_reclaimable_sizes[repository_id]
+
+    @property
+    def shared_layer_count(self) -> int:
+        return len(self._shared_layer_ids)
@@ -0,0 +1,338 @@
+import bisect
+import threading
+import time
+from .auth import auth_statistics
+from .cache import RefreshHealth, RegistrySnapshot
+from .index import ROOT_NAMESPACE
+from typing import cast, Dict, Iterable, List, Optional, Sequence, Tuple  # noqa: F401  # pylint: disable=unused-import
+
+METRICS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRICS_PREFIX = 'gitlab_registry_usage'
+REQUEST_DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RESPONSE_SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metric_header(name: str, metric_type: str, help_text: str) -> List[str]:
+    return [
+        '# HELP {prefix}_{name} {help}'.format(prefix=METRICS_PREFIX, name=name, help=help_text),
+        '# TYPE {prefix}_{name} {type}'.format(prefix=METRICS_PREFIX, name=name, type=metric_type),
+    ]
+
+
+def render_gauge(
+    name: str, help_text: str, samples: Iterable[Tuple[Dict[str, str], float]], metric_type: str = 'gauge'
+) -> List[str]:
+    lines = render_metric_header(name, metric_type, help_text)
+    for labels, value in samples:
+        lines.append(
+            '{prefix}_{name}{labels} {value}'.format(
+                prefix=METRICS_PREFIX, name=name, labels=render_labels(labels), value=format_value(value)
+            )
+        )
+    return lines
+
+
+def render_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(label_name, escape_label_value(label_value)) for label_name, label_value in labels.items()
+    ) + '}'
+
+
+class Histogram:
+    """Thread-safe histogram with one series per value of a single label (like the endpoint of a request)."""
+
+    def __init__(self, name: str, help_text: str, label_name: str, buckets: Sequence[float]) -> None:
+        self._name = name
+        self._help_text = help_text
+        self._label_name = label_name
+        self._buckets = tuple(buckets)
+        # Per label value: counts of observations per bucket (not cumulative, the last one is `+Inf`), sum of values
+        self._series = {}  # type: Dict[str, Tuple[List[int], List[float]]]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        bucket_index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            if label_value not in self._series:
+                self._series[label_value] = ([0] * (len(self._buckets) + 1), [0.0])
+            bucket_counts, value_sum = self._series[label_value]
+            bucket_counts[bucket_index] += 1
+            value_sum[0] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = {
+                label_value: (list(bucket_counts), value_sum[0])
+                for label_value, (bucket_counts, value_sum) in self._series.items()
+            }
+        lines = render_metric_header(self._name, 'histogram', self._help_text)
+        for label_value, (bucket_counts, value_sum) in sorted(series.items()):
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self._buckets + (float('inf'), ), bucket_counts):
+                cumulative_count += bucket_count
+                lines.append(
+                    '{prefix}_{name}_bucket{labels} {value}'.format(
+                        prefix=METRICS_PREFIX,
+                        name=self._name,
+                        labels=render_labels({
+                            self._label_name: label_value,
+                            'le': format_value(upper_bound)
+                        }),
+                        value=cumulative_count
+                    )
+                )
+            labels = render_labels({self._label_name: label_value})
+            lines.append(
+                '{prefix}_{name}_sum{labels} {value}'.format(
+                    prefix=METRICS_PREFIX, name=self._name, labels=labels, value=format_value(value_sum)
+                )
+            )
+            lines.append(
+                '{prefix}_{name}_count{labels} {value}'.format(
+                    prefix=METRICS_PREFIX, name=self._name, labels=labels, value=cumulative_count
+                )
+            )
+        return lines
+
+
+def render_registry_metrics(snapshot: RegistrySnapshot) -> str:
+    """Render the size gauges of all repositories and namespaces of a snapshot."""
+    gitlab_registry = snapshot.registry
+    layer_index = snapshot.index.layers
+    repository_sizes = gitlab_registry.repository_sizes
+    repository_disk_sizes = gitlab_registry.repository_disk_sizes
+    # Repositories whose tags could not be read have no sizes and are left out
+    repositories = [
+        repository for repository in gitlab_registry.registry_catalog if repository_sizes.get(repository) is not None
+    ]
+    namespace_usages = []
+    pending_paths = [ROOT_NAMESPACE]
+    while pending_paths:
+        path = pending_paths.pop()
+        namespace_usage = snapshot.index.namespace_usage(path)
+        if namespace_usage is not None:
+            if path != ROOT_NAMESPACE:
+                namespace_usages.append((path, namespace_usage))
+            pending_paths.extend(namespace_usage.namespaces)
+    namespace_usages.sort()
+    lines = []  # type: List[str]
+    lines.extend(
+        render_gauge(
+            'repository_size_bytes', 'Size of all layers of a repository',
+            (({'repository': repository}, cast(int, repository_sizes[repository])) for repository in repositories)
+        )
+    )
+    lines.extend(
+        render_gauge(
+            'repository_disk_size_bytes', 'Size of the distinct layers of a repository',
+            (({'repository': repository}, cast(int, repository_disk_sizes[repository])) for repository in repositories)
+        )
+    )
+    lines.extend(
+        render_gauge(
+            'repository_reclaimable_size_bytes', 'Size of the layers which are only used by a repository',
+            (({
+                'repository': repository
+            }, layer_index.repository_reclaimable_size(repository) or 0) for repository in repositories)
+        )
+    )
+    lines.extend(
+        render_gauge(
+            'namespace_size_bytes', 'Size of all layers of the repositories of a namespace',
+            (({'namespace': path}, namespace_usage.size) for path, namespace_usage in namespace_usages)
+        )
+    )
+    lines.extend(
+        render_gauge(
+            'namespace_disk_size_bytes', 'Size of the distinct layers of the repositories of a namespace',
+            (({'namespace': path}, namespace_usage.disk_size) for path, namespace_usage in namespace_usages)
+        )
+    )
+    lines.extend(
+        render_gauge(
+            'namespace_repositories', 'Number of repositories of a namespace',
+            (({'namespace': path}, namespace_usage.repository_count) for path, namespace_usage in namespace_usages)
+        )
+    )
+    root_usage = snapshot.index.namespace_usage(ROOT_NAMESPACE)
+    if root_usage is not None:
+        lines.extend(render_gauge('registry_size_bytes', 'Size of all layers of the registry', [({}, root_usage.size)]))
+        lines.extend(
+            render_gauge(
+                'registry_disk_size_bytes', 'Size of the distinct layers of the registry', [({}, root_usage.disk_size)]
+            )
+        )
+        lines.extend(
+            render_gauge('registry_repositories', 'Number of repositories', [({}, root_usage.repository_count)])
+        )
+    lines.extend(
+        render_gauge(
+            'registry_shared_layers', 'Number of layers used by more than one tag',
+            [({}, layer_index.shared_layer_count)]
+        )
+    )
+    return '\n'.join(lines) + '\n'
+
+
+def render_snapshot_metrics(snapshot: RegistrySnapshot) -> List[str]:
+    """Render the gauges which describe the served snapshot and its crawl."""
+    lines = []  # type: List[str]
+    lines.extend(
+        render_gauge(
+            'snapshot_timestamp_seconds', 'Unix time of the registry crawl of the served snapshot',
+            [({}, snapshot.timestamp)]
+        )
+    )
+    lines.extend(
+        render_gauge(
+            'snapshot_age_seconds', 'Age of the served snapshot', [({}, max(time.time() - snapshot.timestamp, 0.0))]
+        )
+    )
+    lines.extend(
+        render_gauge('snapshot_generation', 'Generation of the served snapshot', [({}, snapshot.generation)])
+    )
+    lines.extend(
+        render_gauge(
+            'snapshot_stale', 'Whether the served snapshot was loaded from disk and not crawled yet',
+            [({}, int(snapshot.is_stale))]
+        )
+    )
+    if snapshot.crawl_duration is not None:
+        lines.extend(
+            render_gauge(
+                'crawl_duration_seconds', 'Duration of the registry crawl of the served snapshot',
+                [({}, snapshot.crawl_duration)]
+            )
+        )
+    refresh_statistics = snapshot.registry.refresh_statistics
+    if refresh_statistics is not None:
+        lines.extend(
+            render_gauge(
+                'crawl_api_requests', 'GitLab and registry api requests of the crawl of the served snapshot',
+                [({}, refresh_statistics.api_requests)]
+            )
+        )
+        lines.extend(
+            render_gauge(
+                'crawl_repositories', 'Repositories of the registry crawl of the served snapshot by source', [
+                    ({'source': 'fetched'}, refresh_statistics.fetched_repositories),
+                    ({'source': 'reused'}, refresh_statistics.reused_repositories),
+                    ({'source': 'failed'}, refresh_statistics.failed_repositories),
+                ]
+            )
+        )
+        lines.extend(
+            render_gauge(
+                'crawl_tags', 'Tags of the registry crawl of the served snapshot by source', [
+                    ({'source': 'fetched'}, refresh_statistics.fetched_tags),
+                    ({'source': 'reused'}, refresh_statistics.reused_tags),
+                ]
+            )
+        )
+    return lines
+
+
+def render_refresh_health(refresh_health: RefreshHealth) -> List[str]:
+    lines = render_gauge(
+        'refresh_consecutive_failures', 'Failed registry refreshes since the last successful one',
+        [({}, refresh_health.consecutive_failures)]
+    )
+    if refresh_health.last_success_time is not None:
+        lines.extend(
+            render_gauge(
+                'refresh_last_success_timestamp_seconds', 'Unix time of the last successful registry refresh',
+                [({}, refresh_health.last_success_time)]
+            )
+        )
+    return lines
+
+
+class Metrics:
+    """Collects request metrics and renders all metrics in the Prometheus text exposition format.
+
+    The registry gauges are rendered once per snapshot generation (of each registry), a scrape only renders the internal
+    metrics. Request metrics are collected per process.
+    """
+
+    def __init__(self) -> None:
+        self._request_duration = Histogram(
+            'http_request_duration_seconds', 'Duration of api requests', 'endpoint', REQUEST_DURATION_BUCKETS
+        )
+        self._response_size = Histogram(
+            'http_response_size_bytes', 'Body size of api responses', 'endpoint', RESPONSE_SIZE_BUCKETS
+        )
+        # Generation and rendered gauges by registry id
+        self._registry_metrics = {}  # type: Dict[str, Tuple[int, str]]
+        self._lock = threading.Lock()
+
+    def observe_request(self, endpoint: str, duration: float, response_size: Optional[int]) -> None:
+        self._request_duration.observe(endpoint, duration)
+        if response_size is not None:
+            self._response_size.observe(endpoint, response_size)
+
+    def _rendered_registry_metrics(self, snapshot: RegistrySnapshot, registry_id: str) -> str:
+        with self._lock:
+            registry_metrics = self._registry_metrics.get(registry_id)
+        if registry_metrics is not None and registry_metrics[0] == snapshot.generation:
+            return registry_metrics[1]
+        rendered_registry_metrics = render_registry_metrics(snapshot)
+        with self._lock:
+            registry_metrics = self._registry_metrics.get(registry_id)
+            if registry_metrics is None or snapshot.generation >= registry_metrics[0]:
+                self._registry_metrics[registry_id] = (snapshot.generation, rendered_registry_metrics)
+        return rendered_registry_metrics
+
+    def render(
+        self,
+        snapshot: Optional[RegistrySnapshot],
+        refresh_health: Optional[RefreshHealth] = None,
+        registry_id: str = ''
+    ) -> str:
+        """Render all metrics; without a snapshot (no crawl succeeded yet) the registry metrics are left out.
+
+        `snapshot` and `refresh_health` belong to the registry `registry_id`.
+        """
+        lines = []  # type: List[str]
+        if refresh_health is not None:
+            lines.extend(render_refresh_health(refresh_health))
+        if snapshot is not None:
+            lines.extend(render_snapshot_metrics(snapshot))
+        current_auth_statistics = auth_statistics()
+        lines.extend(
+            render_gauge(
+                'auth_cache_lookups_total', 'Lookups in the login verification cache by result', [
+                    ({'result': 'hit'}, current_auth_statistics.cache_hits),
+                    ({'result': 'miss'}, current_auth_statistics.cache_misses),
+                ], 'counter'
+            )
+        )
+        lines.extend(
+            render_gauge(
+                'auth_ldap_verifications_total', 'Logins verified with the LDAP server',
+                [({}, current_auth_statistics.ldap_verifications)], 'counter'
+            )
+        )
+        lines.extend(
+            render_gauge(
+                'auth_ldap_verification_seconds_total', 'Time spent verifying logins with the LDAP server',
+                [({}, current_auth_statistics.ldap_verification_seconds)], 'counter'
+            )
+        )
+        lines.extend(self._request_duration.render())
+        lines.extend(self._response_size.render())
+        rendered_metrics = '\n'.join(lines) + '\n'
+        if snapshot is None:
+            return rendered_metrics
+        return self._rendered_registry_metrics(snapshot, registry_id) + rendered_metrics
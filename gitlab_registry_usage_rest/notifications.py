@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from .cache import GitLabRegistryCache
+from .errors import ApiError
+from .registry import RefreshCancelledError
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set  # noqa: F401  # pylint: disable=unused-import
+
+logger = logging.getLogger(__name__)
+
+# Registry events which change the tags of a repository (`pull` events are ignored)
+REGISTRY_EVENT_ACTIONS = ('push', 'delete', 'mount')
+
+RefreshRequest = NamedTuple('RefreshRequest', [('repositories', List[str]), ('projects', List[str])])
+
+
+class InvalidNotificationError(ApiError):
+    def __init__(self, status_code: int = 400, payload: Optional[Any] = None) -> None:
+        super().__init__(
+            'The request body is neither a registry notification nor a GitLab webhook payload', status_code, payload
+        )
+
+
+def parse_registry_notification(payload: Any) -> List[str]:
+    """Return the repositories of a Docker registry notification envelope (`{"events": [...]}`)."""
+    events = payload.get('events')
+    if not isinstance(events, list):
+        raise InvalidNotificationError
+    repositories = set()  # type: Set[str]
+    for event in events:
+        if not isinstance(event, dict) or event.get('action') not in REGISTRY_EVENT_ACTIONS:
+            continue
+        repository = (event.get('target') or {}).get('repository')
+        if not isinstance(repository, str) or not repository:
+            raise InvalidNotificationError
+        repositories.add(repository)
+    return sorted(repositories)
+
+
+def parse_gitlab_webhook(payload: Any) -> List[str]:
+    """Return the project path of a GitLab webhook payload (for example of a push, pipeline or job event)."""
+    project = payload.get('project')
+    project_path = project.get('path_with_namespace') if isinstance(project, dict) else None
+    if not isinstance(project_path, str) or not project_path:
+        raise InvalidNotificationError
+    return [project_path]
+
+
+def parse_notification(payload: Any) -> RefreshRequest:
+    if not isinstance(payload, dict):
+        raise InvalidNotificationError
+    if 'events' in payload:
+        return RefreshRequest(parse_registry_notification(payload), [])
+    return RefreshRequest([], parse_gitlab_webhook(payload))
+
+
+def project_repositories(project_path: str, registry_catalog: Iterable[str]) -> List[str]:
+    """Return the repositories of a GitLab project: its default image and all images below its path."""
+    repositories = [
+        repository for repository in registry_catalog
+        if repository == project_path or repository.startswith(project_path + '/')
+    ]
+    if project_path not in repositories:
+        # The default image may have been pushed for the first time
+        repositories.append(project_path)
+    return repositories
+
+
+class RepositoryRefreshQueue:
+    """Collects repositories to refresh and refreshes them in batches in a background thread.
+
+    A batch starts `delay` seconds after the first request which arrives while no batch is pending, so a burst of
+    notifications (a registry sends one event per layer and manifest) causes a single refresh of every affected
+    repository. Requests which arrive while a batch is refreshed are collected for the next batch.
+    """
+
+    def __init__(self, gitlab_registry_cache: GitLabRegistryCache, delay: float = 5.0) -> None:
+        self._gitlab_registry_cache = gitlab_registry_cache
+        self._delay = delay
+        self._repositories = set()  # type: Set[str]
+        self._projects = set()  # type: Set[str]
+        self._first_request_time = None  # type: Optional[float]
+        self._condition = threading.Condition()
+        self._is_stopped = False
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def add(self, refresh_request: RefreshRequest) -> None:
+        if not refresh_request.repositories and not refresh_request.projects:
+            return
+        with self._condition:
+            self._repositories.update(refresh_request.repositories)
+            self._projects.update(refresh_request.projects)
+            if self._first_request_time is None:
+                self._first_request_time = time.monotonic()
+            self._condition.notify()
+
+    def _next_batch(self) -> Optional[RefreshRequest]:
+        with self._condition:
+            while not self._is_stopped:
+                if self._first_request_time is None:
+                    self._condition.wait()
+                    continue
+                remaining_delay = self._first_request_time + self._delay - time.monotonic()
+                if remaining_delay > 0:
+                    self._condition.wait(remaining_delay)
+                    continue
+                refresh_request = RefreshRequest(sorted(self._repositories), sorted(self._projects))
+                self._repositories.clear()
+                self._projects.clear()
+                self._first_request_time = None
+                return refresh_request
+        return None
+
+    def _refresh(self, refresh_request: RefreshRequest) -> None:
+        snapshot = self._gitlab_registry_cache.current_snapshot
+        if snapshot is None:
+            # Nothing to merge into yet, the full crawl which publishes the first snapshot includes the repositories
+            logger.info('Ignoring a repository refresh request, the registry has not been crawled yet')
+            return
+        repositories = set(refresh_request.repositories)
+        if refresh_request.projects:
+            registry_catalog = snapshot.registry.registry_catalog
+            for project_path in refresh_request.projects:
+                repositories.update(project_repositories(project_path, registry_catalog))
+        logger.info('Refreshing %d repositories on notification', len(repositories))
+        if not self._gitlab_registry_cache.update_repositories(repositories):
+            logger.info('Skipped the repository refresh, the running registry refresh includes the repositories')
+
+    def _run(self) -> None:
+        while True:
+            refresh_request = self._next_batch()
+            if refresh_request is None:
+                return
+            try:
+                self._refresh(refresh_request)
+            except RefreshCancelledError:
+                return
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Repository refresh failed')
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='repository-refresh-queue', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Drop pending requests and cancel a running refresh; wait up to `timeout` seconds for it to finish."""
+        with self._condition:
+            self._is_stopped = True
+            self._condition.notify()
+        self._gitlab_registry_cache.cancel_update()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def pending_count(self) -> int:
+        with self._condition:
+            return len(self._repositories) + len(self._projects)
+
+
+class ForwardingRefreshQueue:
+    """Forwards refresh requests of a worker process to the `RepositoryRefreshQueue` of the main process.
+
+    `queue` is a `multiprocessing` queue which is read by the main process, it is shared by all registries and gets
+    `(registry_id, refresh_request)` tuples.
+    """
+
+    def __init__(self, queue: Any, registry_id: str) -> None:
+        self._queue = queue
+        self._registry_id = registry_id
+
+    def add(self, refresh_request: RefreshRequest) -> None:
+        if refresh_request.repositories or refresh_request.projects:
+            self._queue.put((self._registry_id, refresh_request))
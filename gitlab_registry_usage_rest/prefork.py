@@ -0,0 +1,119 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .app import create_wsgi_server, setup_app
+from .cache import GitLabRegistryCache
+from .config import config, RegistryConfig
+from .notifications import RepositoryRefreshQueue
+from .resources import create_refresh_scheduler, create_registry_cache, create_usage_history
+from .scheduler import RefreshScheduler  # noqa: F401  # pylint: disable=unused-import
+from .shared_snapshot import registry_snapshot_filename, SharingGitLabRegistryCache
+from typing import Any, Dict, List, Optional  # noqa: F401  # pylint: disable=unused-import
+
+logger = logging.getLogger(__name__)
+
+WORKER_SUPERVISION_INTERVAL = 1.0
+WORKER_STOP_TIMEOUT = 10.0
+
+
+def run_worker(config_filename: Optional[str], shared_snapshot_filename: str, refresh_request_queue: Any) -> None:
+    """Serve the api from the shared snapshot file; all workers listen on the same port (`SO_REUSEPORT`)."""
+    config.read_config(config_filename)
+    app = setup_app(shared_snapshot_filename, refresh_request_queue)
+    wsgi_server = create_wsgi_server(app, reuse_port=True)
+    # `safe_start` stops the server gracefully on `SystemExit`
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+    wsgi_server.safe_start()
+
+
+def serve(config_filename: Optional[str], processes: int) -> None:
+    """Refresh the registries in this process and serve the api from `processes` worker processes.
+
+    Every refresh is published to a shared snapshot file (one per registry) which the workers pick up without
+    restarting, so each registry is crawled only once regardless of the number of workers and the workers share the
+    snapshot memory (see `shared_snapshot`). Workers which exit are restarted. `SIGUSR1` triggers a refresh of all
+    registries. Repository refresh requests (notifications) which the workers receive are passed to this process
+    through a queue.
+    """
+    runtime_directory = tempfile.mkdtemp(prefix='gitlab-registry-usage-rest-')
+    shared_snapshot_filename = os.path.join(runtime_directory, 'snapshot')
+    # Spawn instead of fork, the worker processes must not inherit the refresh thread, the history database connection
+    # or the registry snapshot of this process
+    context = multiprocessing.get_context('spawn')
+    refresh_request_queue = context.Queue()
+    workers = []  # type: List[Any]
+    stop_event = threading.Event()
+    refresh_schedulers = []  # type: List[RefreshScheduler]
+    repository_refresh_queues = {}  # type: Dict[str, RepositoryRefreshQueue]
+
+    def start_worker() -> Any:
+        worker = context.Process(
+            target=run_worker,
+            args=(config_filename, shared_snapshot_filename, refresh_request_queue),
+            name='worker',
+            daemon=True
+        )
+        worker.start()
+        return worker
+
+    def request_stop(signal_number: int, frame: Any) -> None:  # pylint: disable=unused-argument
+        stop_event.set()
+
+    def request_refresh(signal_number: int, frame: Any) -> None:  # pylint: disable=unused-argument
+        for refresh_scheduler in refresh_schedulers:
+            if not refresh_scheduler.trigger():
+                logger.info('Ignoring the refresh request, a refresh is already running')
+
+    def forward_refresh_requests() -> None:
+        while True:
+            registry_id, refresh_request = refresh_request_queue.get()
+            repository_refresh_queues[registry_id].add(refresh_request)
+
+    def create_sharing_registry_cache(registry_config: RegistryConfig) -> GitLabRegistryCache:
+        return create_registry_cache(
+            registry_config,
+            create_usage_history(registry_config),
+            SharingGitLabRegistryCache,
+            shared_snapshot_filename=registry_snapshot_filename(shared_snapshot_filename, registry_config.registry_id)
+        )
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGUSR1, request_refresh)
+    try:
+        registry_configs = config.registries
+        # The initial crawls of the registries run concurrently
+        with ThreadPoolExecutor(max_workers=len(registry_configs)) as executor:
+            gitlab_registry_caches = list(executor.map(create_sharing_registry_cache, registry_configs))
+        workers.extend(start_worker() for _ in range(max(processes, 1)))
+        for registry_config, gitlab_registry_cache in zip(registry_configs, gitlab_registry_caches):
+            refresh_scheduler = create_refresh_scheduler(gitlab_registry_cache, registry_config)
+            refresh_scheduler.start()
+            refresh_schedulers.append(refresh_scheduler)
+            repository_refresh_queue = RepositoryRefreshQueue(
+                gitlab_registry_cache, config.notifications_delay.total_seconds()
+            )
+            repository_refresh_queue.start()
+            repository_refresh_queues[registry_config.registry_id] = repository_refresh_queue
+        threading.Thread(target=forward_refresh_requests, name='refresh-request-forwarder', daemon=True).start()
+        while not stop_event.wait(WORKER_SUPERVISION_INTERVAL):
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logger.warning('Worker %d exited with code %s, restarting it', worker.pid, worker.exitcode)
+                    workers[i] = start_worker()
+    finally:
+        for repository_refresh_queue in repository_refresh_queues.values():
+            repository_refresh_queue.stop(WORKER_STOP_TIMEOUT)
+        for refresh_scheduler in refresh_schedulers:
+            refresh_scheduler.stop(WORKER_STOP_TIMEOUT)
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join(WORKER_STOP_TIMEOUT)
+        shutil.rmtree(runtime_directory, ignore_errors=True)
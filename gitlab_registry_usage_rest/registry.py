@@ -0,0 +1,709 @@
+import bisect
+import json
+import logging
+import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from gitlab_registry_usage.registry.high_level_api import GitLabRegistry
+from gitlab_registry_usage.registry.low_level_api import (
+    AuthTokenError,
+    CatalogReadError,
+    TagsReadError,
+    LayersReadError,
+    LayerSizeReadError,
+)
+from typing import (  # noqa: F401  # pylint: disable=unused-import
+    cast, Any, Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple, Type, TYPE_CHECKING
+)
+
+if TYPE_CHECKING:
+    # Only needed for type comments, `compact` imports this module
+    from .compact import CompactRegistry  # noqa: F401  # pylint: disable=unused-import
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_ACCEPT_HEADER = 'application/vnd.oci.image.manifest.v2+json, application/vnd.oci.image.manifest.v1+json'
+PAGE_SIZE = 1000
+MAX_RETRIES = 5
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+RefreshStatistics = NamedTuple(
+    'RefreshStatistics', [
+        ('fetched_repositories', int), ('reused_repositories', int), ('fetched_tags', int), ('reused_tags', int),
+        ('api_requests', int), ('failed_repositories', int)
+    ]
+)
+
+HttpResponse = NamedTuple('HttpResponse', [('status_code', int), ('headers', Mapping[str, str]), ('content', bytes)])
+
+# `parse` returns the result of the request or a follow-up `ApiRequest`
+ApiRequest = NamedTuple(
+    'ApiRequest', [
+        ('method', str), ('url', str), ('headers', Dict[str, str]), ('basic_auth', bool),
+        ('parse', Callable[[HttpResponse], Any])
+    ]
+)
+
+CrawlProgress = NamedTuple('CrawlProgress', [('processed_repositories', int), ('total_repositories', Optional[int])])
+
+RepositoryResult = NamedTuple(
+    'RepositoryResult', [
+        ('tag_layers', Optional[Dict[str, List[str]]]), ('tag_digests', Dict[str, str]),
+        ('layer_sizes', Dict[str, int]), ('fetched_tags', int), ('reused_tags', int), ('is_reused', bool),
+        ('error', Optional[str])
+    ]
+)
+
+
+class RefreshCancelledError(Exception):
+    pass
+
+
+class RegistryUnavailableError(Exception):
+    pass
+
+
+class RegistryServerError(Exception):
+    """The registry or GitLab answered with a server error (or 429) after all retries."""
+
+    def __init__(self, status_code: int) -> None:
+        super().__init__('HTTP status {}'.format(status_code))
+        self.status_code = status_code
+
+
+# Errors which only fail the crawl of a single repository, the other repositories are still refreshed. Repositories
+# whose tags or manifests cannot be read (for example because all their tags were deleted) are no failures, they are
+# stored without tags like in `GitLabRegistry`. A layer size which cannot be read fails the repository.
+REPOSITORY_ERRORS = (
+    AuthTokenError, LayerSizeReadError, RegistryServerError, requests.RequestException
+)  # type: Tuple[Type[Exception], ...]
+
+# Error of a repository which failed in the previous refresh and is kept as failed by a targeted refresh of others
+PREVIOUS_FAILURE = 'Failed in the previous refresh'
+
+
+def _check_server_error(status_code: int) -> None:
+    if status_code in RETRY_STATUS_CODES:
+        raise RegistryServerError(status_code)
+
+
+def _load_json(content: bytes, error: Type[Exception]) -> Any:
+    try:
+        return json.loads(content.decode('utf-8'))
+    except ValueError:
+        raise error
+
+
+def parse_auth_token(status_code: int, content: bytes) -> str:
+    _check_server_error(status_code)
+    if status_code != 200:
+        raise AuthTokenError
+    json_response = _load_json(content, AuthTokenError)
+    if 'token' not in json_response:
+        raise AuthTokenError
+    return str(json_response['token'])
+
+
+def parse_registry_catalog(status_code: int, content: bytes) -> List[str]:
+    _check_server_error(status_code)
+    if status_code != 200:
+        raise CatalogReadError
+    json_response = _load_json(content, CatalogReadError)
+    if 'repositories' not in json_response:
+        raise CatalogReadError
+    if json_response['repositories'] is None:
+        return []
+    return [str(repository) for repository in json_response['repositories']]
+
+
+def parse_repository_tags(status_code: int, content: bytes) -> List[str]:
+    _check_server_error(status_code)
+    if status_code != 200:
+        raise TagsReadError
+    json_response = _load_json(content, TagsReadError)
+    if 'tags' not in json_response:
+        raise TagsReadError
+    if json_response['tags'] is None:
+        return []
+    return [str(tag) for tag in json_response['tags']]
+
+
+def parse_tag_layers(status_code: int, content: bytes) -> Dict[str, Optional[int]]:
+    _check_server_error(status_code)
+    if status_code != 200:
+        raise LayersReadError
+    json_response = _load_json(content, LayersReadError)
+    if 'fsLayers' in json_response:
+        layer_key = 'fsLayers'
+    elif 'layers' in json_response:
+        layer_key = 'layers'
+    else:
+        raise LayersReadError
+    fs_layers = {}  # type: Dict[str, Optional[int]]
+    if json_response[layer_key] is None:
+        return fs_layers
+    for layer in json_response[layer_key]:
+        if 'size' in layer and 'digest' in layer:
+            try:
+                fs_layers[str(layer['digest'])] = int(layer['size'])
+            except ValueError:
+                raise LayerSizeReadError
+        elif 'blobSum' in layer:
+            fs_layers[str(layer['blobSum'])] = None
+        else:
+            raise LayersReadError
+    return fs_layers
+
+
+def parse_tag_digest(status_code: int, headers: Mapping[str, str]) -> Optional[str]:
+    # Without a digest, the tag cannot be reused and its manifest is fetched
+    if status_code != 200:
+        return None
+    return headers.get('Docker-Content-Digest')
+
+
+def parse_layer_size(status_code: int, headers: Mapping[str, str]) -> int:
+    _check_server_error(status_code)
+    if status_code != 200:
+        raise LayerSizeReadError
+    try:
+        return int(headers['Content-Length'])
+    except (KeyError, ValueError):
+        raise LayerSizeReadError
+
+
+def previous_repository_result(
+    repository: str,
+    previous_repository_layers: Mapping[str, Optional[Mapping[str, List[str]]]],
+    previous_tag_digests: Mapping[str, Mapping[str, str]],
+    previous_layer_sizes: Mapping[str, int],
+    error: Optional[str] = None
+) -> RepositoryResult:
+    """Return the result of a repository which is taken over from the previous registry (`error` if it failed)."""
+    previous_tag_layers = previous_repository_layers.get(repository)
+    tag_layers = dict(previous_tag_layers) if previous_tag_layers is not None else None
+    repository_layer_sizes = {
+        layer: previous_layer_sizes[layer]
+        for layers in tag_layers.values() for layer in layers
+    } if tag_layers is not None else {}
+    return RepositoryResult(
+        tag_layers, dict(previous_tag_digests.get(repository, {})), repository_layer_sizes, 0,
+        len(tag_layers) if tag_layers is not None else 0, True, error
+    )
+
+
+def check_refreshed_results(refreshed_results: Mapping[str, RepositoryResult]) -> None:
+    """Raise `RegistryUnavailableError` if every repository of a targeted refresh failed, such a refresh counts as
+    failed like a crawl in which every repository fails."""
+    if refreshed_results and all(
+        repository_result.error is not None for repository_result in refreshed_results.values()
+    ):
+        raise RegistryUnavailableError(
+            'All {} refreshed repositories failed, the last one with: {}'.format(
+                len(refreshed_results), refreshed_results[max(refreshed_results)].error
+            )
+        )
+
+
+class RepositoryCrawl:
+    """Collects the tags, digests and layer sizes of one repository crawl and decides which tags are reused from the
+    previous registry and which layer sizes must be fetched.
+
+    The synchronous and the asyncio crawl feed it with the responses of their clients, only the requests differ.
+    """
+
+    def __init__(
+        self,
+        previous_tag_layers: Mapping[str, List[str]],
+        previous_tag_digests: Mapping[str, str],
+        previous_layer_sizes: Mapping[str, int],
+    ) -> None:
+        self._previous_tag_layers = previous_tag_layers
+        self._previous_tag_digests = previous_tag_digests
+        self._previous_layer_sizes = previous_layer_sizes
+        self._tag_layers = {}  # type: Dict[str, List[str]]
+        self._tag_digests = {}  # type: Dict[str, str]
+        self._layer_sizes = {}  # type: Dict[str, int]
+        self._fetched_tags = 0
+        self._reused_tags = 0
+
+    def reuse_tag(self, tag: str, tag_digest: Optional[str]) -> bool:
+        """Take over `tag` from the previous registry if its digest is unchanged; return whether it was reused."""
+        if tag_digest is not None:
+            self._tag_digests[tag] = tag_digest
+        if (
+            tag_digest is None or self._previous_tag_digests.get(tag) != tag_digest
+            or tag not in self._previous_tag_layers
+        ):
+            logger.info('  Processing tag "%s"', tag)
+            return False
+        logger.info('  Reusing tag "%s"', tag)
+        self._tag_layers[tag] = self._previous_tag_layers[tag]
+        for layer in self._previous_tag_layers[tag]:
+            self._layer_sizes[layer] = self._previous_layer_sizes[layer]
+        self._reused_tags += 1
+        return True
+
+    def add_tag_layers(self, tag: str, tag_layers: Mapping[str, Optional[int]]) -> List[str]:
+        """Add the fetched manifest layers of `tag`; return the layers whose size is unknown and must be fetched."""
+        self._tag_layers[tag] = list(tag_layers.keys())
+        unknown_layers = []  # type: List[str]
+        for layer, layer_size in tag_layers.items():
+            if not layer_size:
+                if layer in self._layer_sizes:
+                    layer_size = self._layer_sizes[layer]
+                elif layer in self._previous_layer_sizes:
+                    layer_size = self._previous_layer_sizes[layer]
+                else:
+                    unknown_layers.append(layer)
+                    continue
+            self.add_layer_size(layer, layer_size)
+        self._fetched_tags += 1
+        return unknown_layers
+
+    def add_layer_size(self, layer: str, layer_size: int) -> None:
+        self._layer_sizes[layer] = layer_size
+        logger.info('    Processing layer "%s", size "%d" bytes', layer, layer_size)
+
+    def result(self, repository_tags: Iterable[str]) -> RepositoryResult:
+        is_reused = self._fetched_tags == 0 and set(repository_tags) == set(self._previous_tag_layers)
+        return RepositoryResult(
+            self._tag_layers, self._tag_digests, self._layer_sizes, self._fetched_tags, self._reused_tags, is_reused,
+            None
+        )
+
+    def unreadable_result(self) -> RepositoryResult:
+        """Like `GitLabRegistry`, a repository without readable tags (for example all tags were deleted) is no failure
+        but a repository without tags."""
+        return RepositoryResult(None, {}, {}, self._fetched_tags, self._reused_tags, False, None)
+
+
+class RegistryApi:
+    """Builds the requests of the GitLab auth and registry v2 apis, `RegistryClient` and `AsyncRegistryClient` only
+    send them.
+
+    The `parse` function of a request turns the response into the result or into a follow-up request (like a redirect
+    of a blob to its storage backend).
+    """
+
+    def __init__(self, gitlab_url: str, registry_url: str) -> None:
+        self._gitlab_url = gitlab_url
+        self._registry_url = registry_url
+
+    def auth_token(self, scope: str) -> ApiRequest:
+        auth_url = '{base}jwt/auth?client_id=docker&service=container_registry&scope={scope}'.format(
+            base=self._gitlab_url, scope=scope
+        )
+        return ApiRequest(
+            'GET', auth_url, {}, True, lambda response: parse_auth_token(response.status_code, response.content)
+        )
+
+    def catalog_auth_token(self) -> ApiRequest:
+        return self.auth_token('registry:catalog:*')
+
+    def repository_auth_token(self, repository: str) -> ApiRequest:
+        return self.auth_token('repository:{}:*'.format(repository))
+
+    def registry_catalog(self, auth_token: str) -> ApiRequest:
+        catalog_url = '{base}v2/_catalog?n={size}'.format(base=self._registry_url, size=PAGE_SIZE)
+        return ApiRequest(
+            'GET', catalog_url, {'Authorization': 'Bearer ' + auth_token}, False,
+            lambda response: parse_registry_catalog(response.status_code, response.content)
+        )
+
+    def repository_tags(self, auth_token: str, repository: str) -> ApiRequest:
+        repository_tags_url = '{base}v2/{repository}/tags/list?n={size}'.format(
+            base=self._registry_url, repository=repository, size=PAGE_SIZE
+        )
+        return ApiRequest(
+            'GET', repository_tags_url, {'Authorization': 'Bearer ' + auth_token}, False,
+            lambda response: parse_repository_tags(response.status_code, response.content)
+        )
+
+    def tag_digest(self, auth_token: str, repository: str, tag: str) -> ApiRequest:
+        return ApiRequest(
+            'HEAD', self._tag_manifest_url(repository, tag), self._manifest_headers(auth_token), False,
+            lambda response: parse_tag_digest(response.status_code, response.headers)
+        )
+
+    def tag_layers(self, auth_token: str, repository: str, tag: str) -> ApiRequest:
+        return ApiRequest(
+            'GET', self._tag_manifest_url(repository, tag), self._manifest_headers(auth_token), False,
+            lambda response: parse_tag_layers(response.status_code, response.content)
+        )
+
+    def layer_size(self, auth_token: str, repository: str, layer: str) -> ApiRequest:
+        blob_url = '{base}v2/{repository}/blobs/{layer}'.format(
+            base=self._registry_url, repository=repository, layer=layer
+        )
+        return ApiRequest('HEAD', blob_url, {'Authorization': 'Bearer ' + auth_token}, False, self._parse_layer_size)
+
+    def _parse_layer_size(self, response: HttpResponse) -> Any:
+        # Handle redirect (S3 Backend for example)
+        if response.status_code == 307:
+            if 'Location' not in response.headers:
+                raise LayerSizeReadError
+            return ApiRequest(
+                'HEAD', response.headers['Location'], {}, False,
+                lambda response: parse_layer_size(response.status_code, response.headers)
+            )
+        return parse_layer_size(response.status_code, response.headers)
+
+    def _tag_manifest_url(self, repository: str, tag: str) -> str:
+        return '{base}v2/{repository}/manifests/{tag}'.format(base=self._registry_url, repository=repository, tag=tag)
+
+    @staticmethod
+    def _manifest_headers(auth_token: str) -> Dict[str, str]:
+        return {'Authorization': 'Bearer ' + auth_token, 'Accept': MANIFEST_ACCEPT_HEADER}
+
+
+class RegistryClient:
+    """HTTP client for the GitLab auth and registry v2 apis which shares one connection pool between all threads.
+
+    Transient errors (connection problems and 429/5xx responses) are retried with exponential backoff.
+    """
+
+    def __init__(
+        self, gitlab_url: str, registry_url: str, username: str, password: str, pool_size: int = 10
+    ) -> None:
+        self._api = RegistryApi(gitlab_url, registry_url)
+        self._username = username
+        self._password = password
+        retry = Retry(
+            total=MAX_RETRIES,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(('GET', 'HEAD')),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._session.hooks['response'].append(self._count_request)
+        self._request_count = 0
+        self._request_count_lock = threading.Lock()
+
+    def _count_request(self, response: requests.Response, *args: Any, **kwargs: Any) -> None:
+        with self._request_count_lock:
+            self._request_count += 1
+
+    def close(self) -> None:
+        self._session.close()
+
+    @property
+    def request_count(self) -> int:
+        return self._request_count
+
+    def _call(self, api_request: ApiRequest) -> Any:
+        result = api_request  # type: Any
+        while isinstance(result, ApiRequest):
+            response = self._session.request(
+                result.method,
+                result.url,
+                headers=result.headers,
+                auth=(self._username, self._password) if result.basic_auth else None,
+                allow_redirects=result.method != 'HEAD'
+            )
+            result = result.parse(HttpResponse(response.status_code, response.headers, response.content))
+        return result
+
+    def get_catalog_auth_token(self) -> str:
+        return cast(str, self._call(self._api.catalog_auth_token()))
+
+    def get_repository_auth_token(self, repository: str) -> str:
+        return cast(str, self._call(self._api.repository_auth_token(repository)))
+
+    def get_registry_catalog(self, auth_token: str) -> List[str]:
+        return cast(List[str], self._call(self._api.registry_catalog(auth_token)))
+
+    def get_repository_tags(self, auth_token: str, repository: str) -> List[str]:
+        return cast(List[str], self._call(self._api.repository_tags(auth_token, repository)))
+
+    def get_tag_digest(self, auth_token: str, repository: str, tag: str) -> Optional[str]:
+        return cast(Optional[str], self._call(self._api.tag_digest(auth_token, repository, tag)))
+
+    def get_tag_layers(self, auth_token: str, repository: str, tag: str) -> Dict[str, Optional[int]]:
+        return cast(Dict[str, Optional[int]], self._call(self._api.tag_layers(auth_token, repository, tag)))
+
+    def get_layer_size(self, auth_token: str, repository: str, layer: str) -> int:
+        return cast(int, self._call(self._api.layer_size(auth_token, repository, layer)))
+
+
+class IncrementalGitLabRegistry(GitLabRegistry):  # type: ignore
+    def __init__(
+        self,
+        gitlab_url: str,
+        registry_url: str,
+        admin_username: str,
+        admin_auth_token: str,
+        previous_registry: Optional['CompactRegistry'] = None,
+        incremental: bool = True,
+        workers: int = 1
+    ) -> None:
+        self._previous_registry = previous_registry if incremental else None
+        self._incremental = incremental
+        self._workers = max(workers, 1)
+        self._tag_digests = {}  # type: Dict[str, Dict[str, str]]
+        self._refresh_statistics = None  # type: Optional[RefreshStatistics]
+        self._failed_repositories = []  # type: List[str]
+        self._processed_repositories = 0
+        self._progress_lock = threading.Lock()
+        self._is_cancelled = False
+        super().__init__(gitlab_url, registry_url, admin_username, admin_auth_token)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        del state['_progress_lock']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._progress_lock = threading.Lock()
+
+    @classmethod
+    def from_dict(
+        cls,
+        registry_dict: Dict[str, Any],
+        gitlab_url: str,
+        registry_url: str,
+        admin_username: str,
+        admin_auth_token: str,
+        incremental: bool = True,
+        workers: int = 1
+    ) -> 'IncrementalGitLabRegistry':
+        gitlab_registry = cls(
+            gitlab_url, registry_url, admin_username, admin_auth_token, incremental=incremental, workers=workers
+        )
+        gitlab_registry._registry_catalog = registry_dict['registry_catalog']
+        gitlab_registry._repository_layers = registry_dict['repository_layers']
+        gitlab_registry._layer_sizes = registry_dict['layer_sizes']
+        gitlab_registry._tag_digests = registry_dict['tag_digests']
+        return gitlab_registry
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'registry_catalog': self.registry_catalog,
+            'repository_layers': self.repository_layers,
+            'layer_sizes': self.layer_sizes,
+            'tag_digests': self._tag_digests,
+        }
+
+    def update(self) -> None:
+        super().update()
+        # Only the direct predecessor is needed for an incremental refresh, do not keep a chain of old snapshots alive
+        self._previous_registry = None
+
+    def update_repositories(self, repositories: Iterable[str]) -> None:
+        """Refresh only `repositories` and take all other repositories from the previous registry.
+
+        Repositories which are not in the previous registry catalog are added if their tags can be read. Without a
+        previous registry, the whole registry is crawled.
+        """
+        if self._previous_registry is None:
+            self.update()
+            return
+        self.merge_repository_results(*self.fetch_repositories(repositories))
+
+    def fetch_repositories(self, repositories: Iterable[str]) -> Tuple[Dict[str, RepositoryResult], int]:
+        """Crawl only `repositories` (reusing the data of the previous registry) and return their results and the
+        number of API requests, without building a registry of them.
+
+        The results can be merged with `merge_repository_results` or patched into the previous registry with
+        `CompactRegistry.patched`.
+        """
+        repositories = sorted(set(repositories))
+        client = RegistryClient(
+            self._gitlab_url, self._registry_url, self._admin_username, self._admin_auth_token, self._workers
+        )
+        try:
+            return dict(zip(repositories, self._process_repositories(client, repositories))), client.request_count
+        finally:
+            client.close()
+
+    def merge_repository_results(self, refreshed_results: Mapping[str, RepositoryResult], api_requests: int) -> None:
+        """Take the results of `fetch_repositories` and all other repositories from the previous registry.
+
+        Repositories which failed in the previous registry and were not refreshed are still counted as failed.
+        """
+        check_refreshed_results(refreshed_results)
+        previous_registry = cast('CompactRegistry', self._previous_registry)
+        previous_failed_repositories = set(previous_registry.failed_repositories)
+        previous_repository_layers, previous_tag_digests, previous_layer_sizes = self._previous_state()
+        registry_catalog = list(previous_registry.registry_catalog)
+        known_repositories = set(registry_catalog)
+        for repository, repository_result in refreshed_results.items():
+            if repository not in known_repositories and repository_result.tag_layers is not None:
+                # The registry returns its catalog in lexical order
+                bisect.insort(registry_catalog, repository)
+        repository_results = []  # type: List[RepositoryResult]
+        for repository in registry_catalog:
+            if repository in refreshed_results:
+                repository_results.append(refreshed_results[repository])
+                continue
+            repository_results.append(
+                previous_repository_result(
+                    repository, previous_repository_layers, previous_tag_digests, previous_layer_sizes,
+                    PREVIOUS_FAILURE if repository in previous_failed_repositories else None
+                )
+            )
+        self.clear()
+        self._registry_catalog = registry_catalog
+        self._repository_layers, self._layer_sizes = self._collect_repository_results(repository_results, api_requests)
+        self._previous_registry = None
+
+    def cancel(self) -> None:
+        """Stop a running crawl, repositories which are not started yet raise a `RefreshCancelledError`."""
+        self._is_cancelled = True
+
+    def _check_cancelled(self) -> None:
+        if self._is_cancelled:
+            raise RefreshCancelledError
+
+    def _count_processed_repository(self) -> None:
+        with self._progress_lock:
+            self._processed_repositories += 1
+
+    def _process_repository(
+        self,
+        client: RegistryClient,
+        repository: str,
+        previous_tag_layers: Mapping[str, List[str]],
+        previous_tag_digests: Mapping[str, str],
+        previous_layer_sizes: Mapping[str, int],
+    ) -> RepositoryResult:
+        self._check_cancelled()
+        logger.info('Processing repository "%s"', repository)
+        repository_auth_token = client.get_repository_auth_token(repository)
+        crawl = RepositoryCrawl(previous_tag_layers, previous_tag_digests, previous_layer_sizes)
+        try:
+            repository_tags = client.get_repository_tags(repository_auth_token, repository)
+            for tag in repository_tags:
+                tag_digest = None  # type: Optional[str]
+                if self._incremental:
+                    tag_digest = client.get_tag_digest(repository_auth_token, repository, tag)
+                if crawl.reuse_tag(tag, tag_digest):
+                    continue
+                tag_layers = client.get_tag_layers(repository_auth_token, repository, tag)
+                for layer in crawl.add_tag_layers(tag, tag_layers):
+                    crawl.add_layer_size(layer, client.get_layer_size(repository_auth_token, repository, layer))
+        except (TagsReadError, LayersReadError):
+            return crawl.unreadable_result()
+        return crawl.result(repository_tags)
+
+    def _previous_state(
+        self
+    ) -> Tuple[Mapping[str, Optional[Mapping[str, List[str]]]], Mapping[str, Mapping[str, str]], Mapping[str, int]]:
+        """Return the repository layers, tag digests and layer sizes of the previous registry (or empty values)."""
+        previous_registry = self._previous_registry
+        if previous_registry is not None:
+            return previous_registry.repository_layers, previous_registry.tag_digests, previous_registry.layer_sizes
+        return {}, {}, {}
+
+    def _collect_repository_results(
+        self, repository_results: List[RepositoryResult], api_requests: int
+    ) -> Tuple[Dict[str, Optional[Dict[str, List[str]]]], Dict[str, int]]:
+        """Merge the results of all repositories of the registry catalog (in catalog order)."""
+        repository_layers = {}  # type: Dict[str, Optional[Dict[str, List[str]]]]
+        tag_digests = {}  # type: Dict[str, Dict[str, str]]
+        layer_sizes = {}  # type: Dict[str, int]
+        failed_repositories = []  # type: List[str]
+        fetched_repositories, reused_repositories, fetched_tags, reused_tags = 0, 0, 0, 0
+        for repository, repository_result in zip(self._registry_catalog, repository_results):
+            repository_layers[repository] = repository_result.tag_layers
+            tag_digests[repository] = repository_result.tag_digests
+            layer_sizes.update(repository_result.layer_sizes)
+            fetched_tags += repository_result.fetched_tags
+            reused_tags += repository_result.reused_tags
+            if repository_result.error is not None:
+                failed_repositories.append(repository)
+            elif repository_result.is_reused:
+                reused_repositories += 1
+            else:
+                fetched_repositories += 1
+        if failed_repositories and len(failed_repositories) == len(repository_results):
+            # A snapshot of nothing but previous data would hide that the registry cannot be crawled at all
+            raise RegistryUnavailableError(
+                'All {} repositories failed, the last one with: {}'.format(
+                    len(failed_repositories), repository_results[-1].error
+                )
+            )
+        self._tag_digests = tag_digests
+        self._failed_repositories = failed_repositories
+        self._refresh_statistics = RefreshStatistics(
+            fetched_repositories, reused_repositories, fetched_tags, reused_tags, api_requests,
+            len(failed_repositories)
+        )
+        return repository_layers, layer_sizes
+
+    def _failed_repository_result(
+        self,
+        repository: str,
+        error: Exception,
+        previous_repository_layers: Mapping[str, Optional[Mapping[str, List[str]]]],
+        previous_tag_digests: Mapping[str, Mapping[str, str]],
+        previous_layer_sizes: Mapping[str, int],
+    ) -> RepositoryResult:
+        """Keep the previous data of a repository which could not be crawled (no tags if it is a new repository)."""
+        error_message = str(error) or type(error).__name__
+        logger.warning('Could not refresh repository "%s", keeping its previous data: %s', repository, error_message)
+        return previous_repository_result(
+            repository, previous_repository_layers, previous_tag_digests, previous_layer_sizes, error_message
+        )
+
+    def _process_repositories(self, client: RegistryClient, repositories: List[str]) -> List[RepositoryResult]:
+        previous_repository_layers, previous_tag_digests, previous_layer_sizes = self._previous_state()
+
+        def process_repository(repository: str) -> RepositoryResult:
+            try:
+                repository_result = self._process_repository(
+                    client, repository,
+                    previous_repository_layers.get(repository) or {},
+                    previous_tag_digests.get(repository, {}), previous_layer_sizes
+                )
+            except REPOSITORY_ERRORS as e:
+                repository_result = self._failed_repository_result(
+                    repository, e, previous_repository_layers, previous_tag_digests, previous_layer_sizes
+                )
+            self._count_processed_repository()
+            return repository_result
+
+        with ThreadPoolExecutor(max_workers=max(min(self._workers, len(repositories)), 1)) as executor:
+            return list(executor.map(process_repository, repositories))
+
+    def _get_repository_layers_and_layer_sizes(
+        self,
+    ) -> Tuple[Dict[str, Optional[Dict[str, List[str]]]], Dict[str, int]]:
+        client = RegistryClient(
+            self._gitlab_url, self._registry_url, self._admin_username, self._admin_auth_token, self._workers
+        )
+        try:
+            if self._registry_catalog is None:
+                self._registry_catalog = client.get_registry_catalog(client.get_catalog_auth_token())
+            repository_results = self._process_repositories(client, self._registry_catalog)
+        finally:
+            client.close()
+        return self._collect_repository_results(repository_results, client.request_count)
+
+    @property
+    def tag_digests(self) -> Dict[str, Dict[str, str]]:
+        return self._tag_digests
+
+    @property
+    def refresh_statistics(self) -> Optional[RefreshStatistics]:
+        return self._refresh_statistics
+
+    @property
+    def failed_repositories(self) -> List[str]:
+        """Repositories of the last crawl which could not be refreshed and keep their previous data."""
+        return self._failed_repositories
+
+    @property
+    def crawl_progress(self) -> CrawlProgress:
+        registry_catalog = self._registry_catalog
+        return CrawlProgress(
+            self._processed_repositories, len(registry_catalog) if registry_catalog is not None else None
+        )
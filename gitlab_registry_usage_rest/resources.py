@@ -1,45 +1,352 @@
-from flask import Flask, jsonify, Response
-from flask_jwt_extended import jwt_required
+import datetime
+import hashlib
+import hmac
+import logging
+import math
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, Flask, g, has_request_context, jsonify, request, Response
+from flask_jwt_extended import jwt_required, verify_jwt_in_request
 from flask_restful import Resource as RestResource
 from flask_restful_hal import Api, Embedded, Link, Resource as HalResource
-from urllib.parse import quote
-from gitlab_registry_usage.registry.high_level_api import GitLabRegistry
+from urllib.parse import quote, urlencode
+from werkzeug.http import http_date, quote_etag
 from .auth import http_basic_auth, create_jwt
-from .config import config
-from .cache import GitLabRegistryCache
-from typing import cast, Any, Dict, List, NamedTuple, Optional, Union
+from .config import config, parse_size, parse_timedelta, ParseSizeError, ParseTimeDeltaError, RegistryConfig
+from .encoding import available_content_encodings, compress, encode_json, negotiate_content_encoding
+from .errors import ApiError
+from .cache import GitLabRegistryCache, RegistrySnapshot
+from .changes import merge_changes, RepositoryChange, SnapshotChanges
+from .export import EXPORT_FIELDS, EXPORT_MIMETYPES, stream_export
+from .history import UsageHistory
+from .index import NamespaceUsage, ROOT_NAMESPACE, SORT_KEYS, parent_namespace
+from .layers import LayerUsage
+from .metrics import Metrics, METRICS_MIMETYPE
+from .notifications import ForwardingRefreshQueue, parse_notification, RepositoryRefreshQueue
+from .response_cache import encoded_body, render_response, RenderedResponse, RenderedResponseCache
+from .scheduler import RefreshScheduler, RefreshStatus
+from .search import CollectionFilter, glob_to_regex, SIZE_KEYS, SizeRange
+from .shared_snapshot import registry_snapshot_filename, SharedSnapshotReader
+from typing import (  # noqa: F401
+    cast, Any, Callable, Dict, Hashable, List, Mapping, NamedTuple, Optional, Tuple, Type, Union
+)
 
-RequestContext = NamedTuple('RequestContext', [('registry', GitLabRegistry), ('timestamp', float)])
+HAL_MEDIATYPE = 'application/hal+json'
+# The deepest resource hierarchy is `Repositories` -> `Repository` -> `Tags` -> `Tag`
+MAX_EMBED_DEPTH = 3
+DEFAULT_PER_PAGE = 100
+DEFAULT_GROWTH_PERIOD = datetime.timedelta(weeks=1)
+DEFAULT_GROWTH_LIMIT = 10
+DEFAULT_LAYER_LIMIT = 100
+MAX_BATCH_SIZE = 1000
+# All registry resources are also served for a specific registry below this prefix
+REGISTRY_URL_PREFIX = '/registries/<registry_id>'
 
-_request_context = None  # type: Optional[RequestContext]
+logger = logging.getLogger(__name__)
 
+CollectionArguments = NamedTuple(
+    'CollectionArguments', [
+        ('sort', str), ('descending', bool), ('page', Optional[int]), ('per_page', Optional[int]),
+        ('limit', Optional[int])
+    ]
+)
 
-class ResourceNotExistingError(Exception):
+# The state of one registry: the source of its snapshots (its cache, or the shared snapshot file in worker processes),
+# the refresh scheduler (`None` in worker processes), the repository refresh queue, the usage history, the rendered
+# responses of the current snapshot and the age in seconds from which a snapshot is reported as stale
+RegistryContext = NamedTuple(
+    'RegistryContext', [
+        ('registry_id', str), ('snapshot_source', Union[GitLabRegistryCache, SharedSnapshotReader]),
+        ('refresh_scheduler', Optional[RefreshScheduler]),
+        ('repository_refresh_queue', Optional[Union[RepositoryRefreshQueue, ForwardingRefreshQueue]]),
+        ('history', Optional[UsageHistory]), ('response_cache', RenderedResponseCache), ('stale_after', float)
+    ]
+)
+
+# All registries by id in the configured order; the default registry is also served without `/registries/<id>` prefix
+_registries = {}  # type: Dict[str, RegistryContext]
+_default_registry_id = ''
+# Rendered documents of the cross-registry totals
+_registries_response_cache = RenderedResponseCache()
+# Enabled content codings in the order of preference and the minimum body size which is compressed
+_content_encodings = ('gzip', )  # type: Tuple[str, ...]
+_compression_min_size = 0
+_metrics = Metrics()
+
+
+class ResourceNotExistingError(ApiError):
     def __init__(self, resource_endpoint: str, status_code: int = 404, payload: Optional[Any] = None) -> None:
         message = 'The resource "{}" does not exist'.format(resource_endpoint)
-        super().__init__(message)
-        self._message = message
-        self._status_code = status_code
-        self._payload = payload
+        super().__init__(message, status_code, payload)
+
+
+class InvalidArgumentError(ApiError):
+    def __init__(self, argument: str, value: str, status_code: int = 400, payload: Optional[Any] = None) -> None:
+        message = 'The value "{}" is invalid for the argument "{}"'.format(value, argument)
+        super().__init__(message, status_code, payload)
+
+
+def get_registry(registry_id: Optional[str] = None) -> RegistryContext:
+    """Return the registry `registry_id`, by default the registry of the current request (or the default registry)."""
+    if registry_id is not None:
+        return _registries[registry_id]
+    if has_request_context() and 'registry' in g:
+        return cast(RegistryContext, g.registry)
+    return _registries[_default_registry_id]
+
+
+def get_registry_cache(registry_id: Optional[str] = None) -> Optional[GitLabRegistryCache]:
+    snapshot_source = get_registry(registry_id).snapshot_source
+    return snapshot_source if isinstance(snapshot_source, GitLabRegistryCache) else None
+
+
+def get_refresh_scheduler(registry_id: Optional[str] = None) -> Optional[RefreshScheduler]:
+    return get_registry(registry_id).refresh_scheduler
+
+
+def get_refresh_schedulers() -> List[RefreshScheduler]:
+    return [registry.refresh_scheduler for registry in _registries.values() if registry.refresh_scheduler is not None]
+
+
+def get_snapshot() -> Optional[RegistrySnapshot]:
+    return cast(Optional[RegistrySnapshot], g.get('registry_snapshot'))
+
+
+def get_registry_snapshots() -> Dict[str, Optional[RegistrySnapshot]]:
+    """Return the snapshots of all registries by id, pinned for the rest of the request on first use."""
+    if 'registry_snapshots' not in g:
+        request_registry = get_registry()
+        g.registry_snapshots = {
+            registry_id: get_snapshot() if registry is request_registry else registry.snapshot_source.current_snapshot
+            for registry_id, registry in _registries.items()
+        }
+    return cast(Dict[str, Optional[RegistrySnapshot]], g.registry_snapshots)
+
+
+def registry_url_prefix() -> str:
+    """Return the url prefix of the registry of the current request (empty if the request has no registry prefix)."""
+    if 'registry' not in g:
+        return ''
+    return '/registries/{}'.format(quote(get_registry().registry_id, safe=''))
+
+
+def is_stale(snapshot: RegistrySnapshot, registry_id: Optional[str] = None) -> bool:
+    """Whether a snapshot was loaded from disk and not refreshed yet or is older than the `stale_after` setting."""
+    return snapshot.is_stale or time.time() - snapshot.timestamp > get_registry(registry_id).stale_after
+
+
+def snapshot_unavailable_response() -> Response:
+    """Answer a request which needs registry data before the first crawl succeeded."""
+    response = Response(status=503)
+    refresh_scheduler = get_registry().refresh_scheduler
+    next_refresh_time = refresh_scheduler.status.next_refresh_time if refresh_scheduler is not None else None
+    if next_refresh_time is not None:
+        response.headers['Retry-After'] = str(max(int(math.ceil(next_refresh_time - time.time())), 1))
+    return response
+
+
+def parse_hal_arguments() -> Tuple[int, bool]:
+    def is_valid_true_string(string: Optional[str]) -> bool:
+        return string is not None and string.lower() in ('true', 'yes', '1', 't', 'y')
+
+    embed_argument = request.args.get('embed')
+    if embed_argument is not None and embed_argument.isdigit():
+        embed = int(embed_argument)
+    else:
+        embed = sys.maxsize if is_valid_true_string(embed_argument) else 0
+    include_links = is_valid_true_string(request.args.get('links'))
+    return embed, include_links
+
+
+def parse_collection_arguments() -> CollectionArguments:
+    def parse_positive_int(argument: str) -> Optional[int]:
+        value = request.args.get(argument)
+        if value is None:
+            return None
+        if not value.isdigit() or int(value) < 1:
+            raise InvalidArgumentError(argument, value)
+        return int(value)
+
+    sort = request.args.get('sort')
+    order = request.args.get('order')
+    page = parse_positive_int('page')
+    per_page = parse_positive_int('per_page')
+    limit = parse_positive_int('limit')
+    if sort is None:
+        # `limit` alone is a query for the largest repositories
+        sort = 'size' if limit is not None else 'name'
+    elif sort not in SORT_KEYS:
+        raise InvalidArgumentError('sort', sort)
+    if order is None:
+        descending = sort != 'name'
+    elif order in ('asc', 'desc'):
+        descending = order == 'desc'
+    else:
+        raise InvalidArgumentError('order', order)
+    if page is not None or per_page is not None:
+        page, per_page = page or 1, per_page or DEFAULT_PER_PAGE
+    return CollectionArguments(sort, descending, page, per_page, limit)
+
+
+def parse_filter_arguments() -> Optional[CollectionFilter]:
+    """Parse the `name` (glob pattern), `search` (substring) and `min_<size>` / `max_<size>` arguments (`None` if no
+    filter argument is given)."""
+    def parse_size_argument(argument: str) -> Optional[int]:
+        value = request.args.get(argument)
+        if value is None:
+            return None
+        try:
+            return parse_size(value)
+        except ParseSizeError:
+            raise InvalidArgumentError(argument, value)
+
+    size_ranges = []  # type: List[SizeRange]
+    for size_key in SIZE_KEYS:
+        minimum = parse_size_argument('min_{}'.format(size_key))
+        maximum = parse_size_argument('max_{}'.format(size_key))
+        if minimum is not None or maximum is not None:
+            size_ranges.append(SizeRange(size_key, minimum, maximum))
+    pattern = request.args.get('name')
+    if pattern is not None:
+        try:
+            re.compile(glob_to_regex(pattern))
+        except re.error:
+            raise InvalidArgumentError('name', pattern)
+    substring = request.args.get('search')
+    if pattern is None and substring is None and not size_ranges:
+        return None
+    return CollectionFilter(pattern, substring, tuple(size_ranges))
+
+
+def is_requested_resource(resource: Type[HalResource]) -> bool:
+    """Return whether `resource` is the requested resource (and not embedded in the requested resource)."""
+    return request.endpoint == resource.__name__.lower()
+
 
-    def to_dict(self) -> Dict[str, Any]:
-        rv = dict(self._payload or ())
-        rv['message'] = self._message
-        return rv
+def parse_since(default: float) -> float:
+    """Parse the `since` argument, either a unix timestamp or a time span (like `2 weeks`) before the snapshot time."""
+    since = request.args.get('since')
+    if since is None:
+        return default
+    try:
+        return float(since)
+    except ValueError:
+        pass
+    try:
+        return cast(RegistrySnapshot, get_snapshot()).timestamp - parse_timedelta(since).total_seconds()
+    except ParseTimeDeltaError:
+        raise InvalidArgumentError('since', since)
 
-    @property
-    def message(self) -> str:
-        return self._message
 
-    @property
-    def status_code(self) -> int:
-        return self._status_code
+def negotiate_request_content_encoding() -> str:
+    return negotiate_content_encoding(request.accept_encodings, _content_encodings)
+
+
+def make_rendered_response(rendered_response: RenderedResponse, content_encoding: str) -> Response:
+    # Small documents are sent uncompressed, compressing them saves less than it costs
+    if content_encoding != 'identity' and len(rendered_response.body) >= _compression_min_size:
+        response = Response(encoded_body(rendered_response, content_encoding), rendered_response.status_code)
+        response.headers['Content-Encoding'] = content_encoding
+    else:
+        response = Response(rendered_response.body, rendered_response.status_code)
+    response.headers['Content-Type'] = rendered_response.mimetype
+    return response
+
+
+def make_etag(generation: int, timestamp: float, response_key: Hashable, mediatype: str, content_encoding: str) -> str:
+    # The snapshot timestamp distinguishes generations of different service runs (generations restart at 1)
+    resource_hash = hashlib.sha1(repr((response_key, mediatype, content_encoding)).encode('utf-8')).hexdigest()
+    return '{:x}-{:x}-{}'.format(generation, int(timestamp * 1000), resource_hash[:20])
+
+
+def cache_validator_headers(etag: str, last_modified: datetime.datetime) -> Dict[str, str]:
+    return {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': 'private, no-cache',
+        'Vary': 'Accept, Accept-Encoding',
+    }
+
+
+def prefix_links(document: Dict[str, Any], url_prefix: str) -> Dict[str, Any]:
+    """Prefix the link targets of a HAL document and its embedded documents with `url_prefix` (in place).
+
+    Links to registries (`/registries/...`) already point to a specific registry and are left unchanged.
+    """
+    for links in document.get('_links', {}).values():
+        for link in links if isinstance(links, list) else [links]:
+            if not link['href'].startswith('/registries'):
+                link['href'] = url_prefix + link['href']
+    for embedded_documents in document.get('_embedded', {}).values():
+        for embedded_document in embedded_documents if isinstance(embedded_documents, list) else [embedded_documents]:
+            prefix_links(embedded_document, url_prefix)
+    return document
+
+
+def is_not_modified(etag: str, last_modified: datetime.datetime) -> bool:
+    # `If-None-Match` takes precedence over `If-Modified-Since` (RFC 7232, section 6)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        return request.if_modified_since >= last_modified
+    return False
 
 
 class SecuredHalResource(HalResource):  # type: ignore
+    @staticmethod
+    def query_arguments() -> Tuple[Any, ...]:
+        """Normalized query arguments (besides `embed` and `links`) the rendered document depends on"""
+        return ()
+
     @jwt_required()  # type: ignore
     def get(self, **kwargs: Any) -> Any:
-        return super().get(**kwargs)
+        snapshot = get_snapshot()
+        if snapshot is None:
+            return snapshot_unavailable_response()
+        # The staleness flag of a document changes with the age of the snapshot, not only with its generation
+        return self.cached_response(
+            snapshot.generation, snapshot.timestamp, (registry_url_prefix(), is_stale(snapshot)),
+            get_registry().response_cache, kwargs
+        )
+
+    def cached_response(
+        self, generation: int, timestamp: float, version_key: Hashable, response_cache: RenderedResponseCache,
+        kwargs: Dict[str, Any]
+    ) -> Any:
+        """Answer the request from `response_cache` for snapshot `generation` (created at `timestamp`).
+
+        `version_key` holds everything besides the generation and the request which the document depends on.
+        """
+        mediatype = request.accept_mimetypes.best_match((HAL_MEDIATYPE, 'text/html'), default=HAL_MEDIATYPE)
+        content_encoding = negotiate_request_content_encoding() if mediatype == HAL_MEDIATYPE else 'identity'
+        # HAL documents only depend on the snapshot, the resource and the normalized `embed` and `links` arguments, so
+        # they are rendered and encoded once per snapshot generation and can be validated without rendering them
+        embed, include_links = parse_hal_arguments()
+        response_key = (
+            type(self).__name__, tuple(sorted(kwargs.items())), min(embed, MAX_EMBED_DEPTH), include_links,
+            self.query_arguments(), version_key
+        )
+        etag = make_etag(generation, timestamp, response_key, mediatype, content_encoding)
+        last_modified = datetime.datetime.fromtimestamp(int(timestamp), datetime.timezone.utc)
+        headers = cache_validator_headers(etag, last_modified)
+        if is_not_modified(etag, last_modified):
+            return Response(status=304, headers=headers)
+        url_prefix = registry_url_prefix()
+        if mediatype != HAL_MEDIATYPE:
+            return prefix_links(super().get(**kwargs), url_prefix), 200, headers
+        hal_get = super().get
+
+        def render() -> RenderedResponse:
+            return render_response(
+                encode_json(prefix_links(hal_get(**kwargs), url_prefix), current_app.debug), HAL_MEDIATYPE
+            )
+
+        rendered_response = response_cache.get(generation, response_key, render)
+        response = make_rendered_response(rendered_response, content_encoding)
+        response.headers.update(headers)
+        return response
 
 
 class AuthToken(RestResource):  # type: ignore
@@ -51,51 +358,141 @@ class AuthToken(RestResource):  # type: ignore
 
 class Repositories(SecuredHalResource):
     @staticmethod
-    def data() -> Dict[str, Optional[float]]:
-        if _request_context is not None:
-            return {'timestamp': _request_context.timestamp}
+    def query_arguments() -> Tuple[Any, ...]:
+        return tuple(parse_collection_arguments()) + (parse_filter_arguments(), )
+
+    @staticmethod
+    def _filtered_repositories() -> Optional[List[str]]:
+        """Return all repositories which match the filter arguments in the requested order (`None` without filter)."""
+        # Data, embedded resources and links of a response need the same list, it is looked up once per request
+        if 'filtered_repositories' not in g:
+            snapshot = cast(RegistrySnapshot, get_snapshot())
+            collection_filter = parse_filter_arguments()
+            arguments = parse_collection_arguments()
+            g.filtered_repositories = snapshot.index.search.repositories(
+                collection_filter, arguments.sort, arguments.descending
+            ) if collection_filter is not None else None
+        return cast(Optional[List[str]], g.filtered_repositories)
+
+    @staticmethod
+    def _repository_range() -> Tuple[int, int, int]:
+        """Return the start and stop index of the requested repositories and the total collection size."""
+        snapshot = cast(RegistrySnapshot, get_snapshot())
+        arguments = parse_collection_arguments()
+        filtered_repositories = Repositories._filtered_repositories()
+        total = len(filtered_repositories) if filtered_repositories is not None else snapshot.index.repository_count
+        if arguments.limit is not None:
+            total = min(total, arguments.limit)
+        if arguments.page is not None and arguments.per_page is not None:
+            start = (arguments.page - 1) * arguments.per_page
+            return start, min(start + arguments.per_page, total), total
+        return 0, total, total
+
+    @staticmethod
+    def _repositories() -> List[str]:
+        snapshot = cast(RegistrySnapshot, get_snapshot())
+        arguments = parse_collection_arguments()
+        start, stop, _ = Repositories._repository_range()
+        filtered_repositories = Repositories._filtered_repositories()
+        if filtered_repositories is not None:
+            return filtered_repositories[start:stop]
+        return snapshot.index.sorted_repositories(arguments.sort, arguments.descending, start, stop)
+
+    @staticmethod
+    def data() -> Dict[str, Union[Optional[float], bool, int]]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            data = {
+                'timestamp': snapshot.timestamp,
+                'stale': is_stale(snapshot)
+            }  # type: Dict[str, Union[Optional[float], bool, int]]
+            arguments = parse_collection_arguments()
+            if arguments.page is not None and arguments.per_page is not None:
+                data.update(
+                    {
+                        'page': arguments.page,
+                        'per_page': arguments.per_page,
+                        'total': Repositories._repository_range()[2]
+                    }
+                )
+            return data
         else:
-            return {'timestamp': None}
+            return {'timestamp': None, 'stale': False}
 
     @staticmethod
     def embedded() -> Optional[Embedded]:
-        if _request_context is not None:
+        snapshot = get_snapshot()
+        if snapshot is not None:
             return Embedded(
                 'items',
                 Repository,
-                *[(repository, ) for repository in _request_context.registry.registry_catalog],
+                *[(repository, ) for repository in Repositories._repositories()],
                 always_as_list=True
             )
         else:
             return None
 
     @staticmethod
-    def links() -> Optional[Link]:
-        if _request_context is not None:
-            return Link(
-                'items',
-                *[
-                    ('/repositories/{}'.format(quote(repository_name, safe='')), {
-                        'title': repository_name
-                    }) for repository_name in _request_context.registry.registry_catalog
-                ],
-                always_as_list=True,
-                quote=False
-            )
+    def links() -> Optional[List[Link]]:
+        def page_link(rel: str, page: int) -> Link:
+            query_arguments = request.args.to_dict()
+            query_arguments['page'] = str(page)
+            return Link(rel, '/repositories?{}'.format(urlencode(query_arguments)), quote=False)
+
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            links = [
+                Link(
+                    'items',
+                    *[
+                        ('/repositories/{}'.format(quote(repository_name, safe='')), {
+                            'title': repository_name
+                        }) for repository_name in Repositories._repositories()
+                    ],
+                    always_as_list=True,
+                    quote=False
+                )
+            ]
+            arguments = parse_collection_arguments()
+            if arguments.page is not None and arguments.per_page is not None:
+                _, stop, total = Repositories._repository_range()
+                if arguments.page > 1:
+                    links.append(page_link('prev', arguments.page - 1))
+                if stop < total:
+                    links.append(page_link('next', arguments.page + 1))
+            return links
         else:
             return None
 
 
+def repository_data(snapshot: RegistrySnapshot, repository_name: str) -> Dict[str, Optional[Union[int, str]]]:
+    """Usage of a repository, raises a `KeyError` if the repository does not exist."""
+    return {
+        'name': repository_name,
+        'size': snapshot.registry.repository_sizes[repository_name],
+        'disk_size': snapshot.registry.repository_disk_sizes[repository_name],
+        'reclaimable_size': snapshot.index.layers.repository_reclaimable_size(repository_name)
+    }
+
+
+def tag_data(snapshot: RegistrySnapshot, repository_name: str, tag_name: str) -> Dict[str, Optional[Union[int, str]]]:
+    """Usage of a tag, raises a `KeyError` if the repository or tag does not exist."""
+    # Repositories whose tags could not be read have no tag sizes (`None`)
+    return {
+        'name': tag_name,
+        'size': cast(Mapping[str, int], snapshot.registry.tag_sizes[repository_name])[tag_name],
+        'disk_size': cast(Mapping[str, int], snapshot.registry.tag_disk_sizes[repository_name])[tag_name],
+        'reclaimable_size': snapshot.index.layers.tag_reclaimable_size(repository_name, tag_name)
+    }
+
+
 class Repository(SecuredHalResource):
     @staticmethod
-    def data(repository_name: str) -> Optional[Dict[str, Union[int, str]]]:
-        if _request_context is not None:
+    def data(repository_name: str) -> Optional[Dict[str, Optional[Union[int, str]]]]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
             try:
-                return {
-                    'name': repository_name,
-                    'size': _request_context.registry.repository_sizes[repository_name],
-                    'disk_size': _request_context.registry.repository_disk_sizes[repository_name]
-                }
+                return repository_data(snapshot, repository_name)
             except KeyError:
                 raise ResourceNotExistingError('/repositories/{}'.format(quote(repository_name, safe='')))
         else:
@@ -103,7 +500,8 @@ class Repository(SecuredHalResource):
 
     @staticmethod
     def embedded(repository_name: str) -> Optional[Embedded]:
-        if _request_context is not None and _request_context.registry.repository_tags[repository_name] is not None:
+        snapshot = get_snapshot()
+        if snapshot is not None and snapshot.registry.repository_tags[repository_name] is not None:
             return Embedded('related', Tags, (repository_name, ))
         else:
             return None
@@ -111,7 +509,8 @@ class Repository(SecuredHalResource):
     @staticmethod
     def links(repository_name: str) -> List[Link]:
         links = [Link('collection', '/repositories')]
-        if _request_context is not None and _request_context.registry.repository_tags[repository_name] is not None:
+        snapshot = get_snapshot()
+        if snapshot is not None and snapshot.registry.repository_tags[repository_name] is not None:
             links.append(
                 Link(
                     'related', ('/repositories/{}/tags'.format(quote(repository_name, safe='')), {
@@ -124,10 +523,26 @@ class Repository(SecuredHalResource):
 
 
 class Tags(SecuredHalResource):
+    @staticmethod
+    def query_arguments() -> Tuple[Any, ...]:
+        return (parse_filter_arguments(), )
+
+    @staticmethod
+    def _tags(repository_name: str) -> Optional[List[str]]:
+        """Return the tags of the repository, filtered by the filter arguments if the tags collection is requested."""
+        snapshot = get_snapshot()
+        repository_tags = snapshot.registry.repository_tags[repository_name] if snapshot is not None else None
+        if snapshot is not None and repository_tags is not None and is_requested_resource(Tags):
+            collection_filter = parse_filter_arguments()
+            if collection_filter is not None:
+                return snapshot.index.search.tags(repository_name, collection_filter)
+        return repository_tags
+
     @staticmethod
     def data(repository_name: str) -> Optional[Dict[str, Any]]:
-        if _request_context is not None:
-            if repository_name not in _request_context.registry.registry_catalog:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            if repository_name not in snapshot.registry.repository_tags:
                 raise ResourceNotExistingError('/repositories/{}/tags'.format(quote(repository_name, safe='')))
             return {}
         else:
@@ -135,14 +550,12 @@ class Tags(SecuredHalResource):
 
     @staticmethod
     def embedded(repository_name: str) -> Optional[Embedded]:
-        if _request_context is not None and _request_context.registry.repository_tags[repository_name] is not None:
+        repository_tags = Tags._tags(repository_name)
+        if repository_tags is not None:
             return Embedded(
                 'items',
                 Tag,
-                *[
-                    (repository_name, tag_name)
-                    for tag_name in _request_context.registry.repository_tags[repository_name]
-                ],
+                *[(repository_name, tag_name) for tag_name in repository_tags],
                 always_as_list=True
             )
         else:
@@ -151,7 +564,8 @@ class Tags(SecuredHalResource):
     @staticmethod
     def links(repository_name: str) -> List[Link]:
         links = [Link('up', '/repositories/{}'.format(quote(repository_name, safe='')), quote=False)]
-        if _request_context is not None and _request_context.registry.repository_tags[repository_name] is not None:
+        repository_tags = Tags._tags(repository_name)
+        if repository_tags is not None:
             links.append(
                 Link(
                     'items',
@@ -162,7 +576,7 @@ class Tags(SecuredHalResource):
                             ), {
                                 'title': repository_name
                             }
-                        ) for tag_name in _request_context.registry.repository_tags[repository_name]
+                        ) for tag_name in repository_tags
                     ],
                     always_as_list=True,
                     quote=False
@@ -173,14 +587,11 @@ class Tags(SecuredHalResource):
 
 class Tag(SecuredHalResource):
     @staticmethod
-    def data(repository_name: str, tag_name: str) -> Optional[Dict[str, Union[int, str]]]:
-        if _request_context is not None:
+    def data(repository_name: str, tag_name: str) -> Optional[Dict[str, Optional[Union[int, str]]]]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
             try:
-                return {
-                    'name': tag_name,
-                    'size': _request_context.registry.tag_sizes[repository_name][tag_name],
-                    'disk_size': _request_context.registry.tag_disk_sizes[repository_name][tag_name]
-                }
+                return tag_data(snapshot, repository_name, tag_name)
             except KeyError:
                 raise ResourceNotExistingError(
                     '/repositories/{}/tags/{}'.format(quote(repository_name, safe=''), quote(tag_name, safe=''))
@@ -193,36 +604,926 @@ class Tag(SecuredHalResource):
         return Link('collection', '/repositories/{}/tags'.format(quote(repository_name, safe='')), quote=False)
 
 
-def init_resources(app: Flask) -> None:
-    def init_registry() -> GitLabRegistryCache:
-        gitlab_registry_cache = GitLabRegistryCache(
-            config.gitlab_base_url, config.registry_base_url, config.username, config.access_token
+def parse_batch_request(key: str) -> List[Any]:
+    """Return the list of requested items which is stored under `key` in the JSON request body."""
+    body = request.get_json(force=True, silent=True)
+    items = body.get(key) if isinstance(body, dict) else None
+    if not isinstance(items, list):
+        raise InvalidArgumentError(key, str(items))
+    if len(items) > MAX_BATCH_SIZE:
+        raise InvalidArgumentError(
+            key, 'a list of {} items (at most {} are allowed)'.format(len(items), MAX_BATCH_SIZE)
+        )
+    return items
+
+
+def batch_response(snapshot: RegistrySnapshot, items: List[Dict[str, Any]]) -> Response:
+    return Response(
+        encode_json({
+            'timestamp': snapshot.timestamp,
+            'stale': is_stale(snapshot),
+            'items': items
+        }, current_app.debug),
+        mimetype='application/json'
+    )
+
+
+class RepositoryBatch(RestResource):  # type: ignore
+    @jwt_required()  # type: ignore
+    def post(self) -> Response:
+        snapshot = get_snapshot()
+        if snapshot is None:
+            return snapshot_unavailable_response()
+        repository_names = parse_batch_request('repositories')
+        if not all(isinstance(repository_name, str) for repository_name in repository_names):
+            raise InvalidArgumentError('repositories', str(repository_names))
+        items = []  # type: List[Dict[str, Any]]
+        for repository_name in repository_names:
+            try:
+                items.append(repository_data(snapshot, repository_name))
+            except KeyError:
+                # Unknown repositories are reported per item instead of failing the whole batch
+                items.append(
+                    {
+                        'name': repository_name,
+                        'error': ResourceNotExistingError(
+                            '/repositories/{}'.format(quote(repository_name, safe=''))
+                        ).message
+                    }
+                )
+        return batch_response(snapshot, items)
+
+
+class TagBatch(RestResource):  # type: ignore
+    @jwt_required()  # type: ignore
+    def post(self) -> Response:
+        snapshot = get_snapshot()
+        if snapshot is None:
+            return snapshot_unavailable_response()
+        tag_references = parse_batch_request('tags')
+        if not all(
+            isinstance(tag_reference, dict) and isinstance(tag_reference.get('repository'), str)
+            and isinstance(tag_reference.get('tag'), str) for tag_reference in tag_references
+        ):
+            raise InvalidArgumentError('tags', str(tag_references))
+        items = []  # type: List[Dict[str, Any]]
+        for tag_reference in tag_references:
+            repository_name, tag_name = tag_reference['repository'], tag_reference['tag']
+            try:
+                item = tag_data(snapshot, repository_name, tag_name)  # type: Dict[str, Any]
+            except (KeyError, TypeError):
+                # Repositories without readable tags have no tag sizes (`None`)
+                item = {
+                    'name': tag_name,
+                    'error': ResourceNotExistingError(
+                        '/repositories/{}/tags/{}'.format(quote(repository_name, safe=''), quote(tag_name, safe=''))
+                    ).message
+                }
+            item['repository'] = repository_name
+            items.append(item)
+        return batch_response(snapshot, items)
+
+
+class RepositoryHistory(SecuredHalResource):
+    @staticmethod
+    def query_arguments() -> Tuple[Any, ...]:
+        return (parse_since(0), )
+
+    @staticmethod
+    def data(repository_name: str) -> Optional[Dict[str, Any]]:
+        snapshot = get_snapshot()
+        history = get_registry().history
+        if history is None:
+            # Not all registries need to record a history
+            raise ResourceNotExistingError(request.path)
+        if snapshot is not None:
+            since = parse_since(0)
+            samples = history.samples(repository_name, since, snapshot.generation)
+            if samples is None:
+                raise ResourceNotExistingError(
+                    '/repositories/{}/history'.format(quote(repository_name, safe=''))
+                )
+            return {
+                'name': repository_name,
+                'since': since,
+                'samples': [sample._asdict() for sample in samples]
+            }
+        else:
+            return None
+
+    @staticmethod
+    def links(repository_name: str) -> Link:
+        return Link('up', '/repositories/{}'.format(quote(repository_name, safe='')), quote=False)
+
+
+class RepositoryGrowth(SecuredHalResource):
+    @staticmethod
+    def _arguments() -> Tuple[float, int]:
+        limit = request.args.get('limit', str(DEFAULT_GROWTH_LIMIT))
+        if not limit.isdigit() or int(limit) < 1:
+            raise InvalidArgumentError('limit', limit)
+        since = parse_since(
+            cast(RegistrySnapshot, get_snapshot()).timestamp - DEFAULT_GROWTH_PERIOD.total_seconds()
+        )
+        return since, int(limit)
+
+    @staticmethod
+    def query_arguments() -> Tuple[Any, ...]:
+        return RepositoryGrowth._arguments()
+
+    @staticmethod
+    def data() -> Optional[Dict[str, Any]]:
+        snapshot = get_snapshot()
+        history = get_registry().history
+        if history is None:
+            raise ResourceNotExistingError(request.path)
+        if snapshot is not None:
+            since, limit = RepositoryGrowth._arguments()
+            return {
+                'since': since,
+                'repositories': [growth._asdict() for growth in history.growth(since, limit, snapshot.generation)]
+            }
+        else:
+            return None
+
+    @staticmethod
+    def links() -> Link:
+        return Link('collection', '/repositories')
+
+
+def repository_change_data(repository_name: str, repository_change: RepositoryChange) -> Dict[str, Any]:
+    return {
+        'name': repository_name,
+        'change': repository_change.change,
+        'size_delta': repository_change.size_delta,
+        'disk_size_delta': repository_change.disk_size_delta,
+        'tags': [
+            {
+                'name': tag_name,
+                'change': tag_change.change,
+                'size_delta': tag_change.size_delta
+            } for tag_name, tag_change in sorted(repository_change.tags.items())
+        ]
+    }
+
+
+class Changes(SecuredHalResource):
+    @staticmethod
+    def _changes() -> Tuple[List[SnapshotChanges], bool]:
+        """Return the changes of all generations after the `since` argument and whether they reach back that far.
+
+        `since` is a generation, a unix timestamp or a time span before the snapshot time (default: the changes of the
+        last refresh). Only the changes of the last `change_generations` refreshes are kept.
+        """
+        snapshot = cast(RegistrySnapshot, get_snapshot())
+        since = request.args.get('since')
+        if since is None or (since.isdigit() and int(since) <= snapshot.generation):
+            since_generation = int(since) if since is not None else snapshot.generation - 1
+            return (
+                [changes for changes in snapshot.changes if changes.generation > since_generation],
+                since_generation >= snapshot.generation or
+                (bool(snapshot.changes) and snapshot.changes[0].previous_generation <= since_generation)
+            )
+        since_timestamp = parse_since(snapshot.timestamp)
+        return (
+            [changes for changes in snapshot.changes if changes.timestamp > since_timestamp],
+            since_timestamp >= snapshot.timestamp or
+            (bool(snapshot.changes) and snapshot.changes[0].previous_timestamp <= since_timestamp)
+        )
+
+    @staticmethod
+    def query_arguments() -> Tuple[Any, ...]:
+        changes, complete = Changes._changes()
+        return (changes[0].generation if changes else None, complete)
+
+    @staticmethod
+    def data() -> Optional[Dict[str, Any]]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            changes, complete = Changes._changes()
+            repository_changes = merge_changes(changes)
+            return {
+                'since_generation': changes[0].previous_generation if changes else snapshot.generation,
+                'since_timestamp': changes[0].previous_timestamp if changes else snapshot.timestamp,
+                'generation': snapshot.generation,
+                'timestamp': snapshot.timestamp,
+                'complete': complete,
+                'size_delta': sum(repository_change.size_delta for repository_change in repository_changes.values()),
+                'disk_size_delta': sum(
+                    repository_change.disk_size_delta for repository_change in repository_changes.values()
+                ),
+                'repositories': [
+                    repository_change_data(repository_name, repository_change)
+                    for repository_name, repository_change in sorted(repository_changes.items())
+                ]
+            }
+        else:
+            return None
+
+
+def namespace_data(namespace_usage: NamespaceUsage) -> Dict[str, int]:
+    return {
+        'size': namespace_usage.size,
+        'disk_size': namespace_usage.disk_size,
+        'repository_count': namespace_usage.repository_count
+    }
+
+
+def namespace_links(namespace_usage: NamespaceUsage) -> List[Link]:
+    return [
+        Link(
+            'items',
+            *[
+                ('/namespaces/{}'.format(quote(namespace_path, safe='')), {
+                    'title': namespace_path
+                }) for namespace_path in namespace_usage.namespaces
+            ],
+            always_as_list=True,
+            quote=False
+        ),
+        Link(
+            'repositories',
+            *[
+                ('/repositories/{}'.format(quote(repository_name, safe='')), {
+                    'title': repository_name
+                }) for repository_name in namespace_usage.repositories
+            ],
+            always_as_list=True,
+            quote=False
+        )
+    ]
+
+
+class Namespaces(SecuredHalResource):
+    @staticmethod
+    def data() -> Optional[Dict[str, Union[float, bool, int]]]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            data = {
+                'timestamp': snapshot.timestamp,
+                'stale': is_stale(snapshot)
+            }  # type: Dict[str, Union[float, bool, int]]
+            data.update(namespace_data(cast(NamespaceUsage, snapshot.index.namespace_usage(ROOT_NAMESPACE))))
+            return data
+        else:
+            return None
+
+    @staticmethod
+    def embedded() -> Optional[Embedded]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            namespace_usage = cast(NamespaceUsage, snapshot.index.namespace_usage(ROOT_NAMESPACE))
+            return Embedded(
+                'items', Namespace, *[(namespace_path, ) for namespace_path in namespace_usage.namespaces],
+                always_as_list=True
+            )
+        else:
+            return None
+
+    @staticmethod
+    def links() -> Optional[List[Link]]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            return namespace_links(cast(NamespaceUsage, snapshot.index.namespace_usage(ROOT_NAMESPACE)))
+        else:
+            return None
+
+
+class Namespace(SecuredHalResource):
+    @staticmethod
+    def _namespace_usage(namespace_path: str) -> NamespaceUsage:
+        namespace_usage = cast(RegistrySnapshot, get_snapshot()).index.namespace_usage(namespace_path)
+        if namespace_path == ROOT_NAMESPACE or namespace_usage is None:
+            raise ResourceNotExistingError('/namespaces/{}'.format(quote(namespace_path, safe='')))
+        return namespace_usage
+
+    @staticmethod
+    def data(namespace_path: str) -> Optional[Dict[str, Union[int, str]]]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            data = {'name': namespace_path}  # type: Dict[str, Union[int, str]]
+            data.update(namespace_data(Namespace._namespace_usage(namespace_path)))
+            return data
+        else:
+            return None
+
+    @staticmethod
+    def embedded(namespace_path: str) -> Optional[Embedded]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            namespace_usage = Namespace._namespace_usage(namespace_path)
+            return Embedded(
+                'items', Namespace, *[(child_path, ) for child_path in namespace_usage.namespaces],
+                always_as_list=True
+            )
+        else:
+            return None
+
+    @staticmethod
+    def links(namespace_path: str) -> List[Link]:
+        parent_path = parent_namespace(namespace_path)
+        if parent_path == ROOT_NAMESPACE:
+            links = [Link('up', '/namespaces')]
+        else:
+            links = [Link('up', '/namespaces/{}'.format(quote(parent_path, safe='')), quote=False)]
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            links.extend(namespace_links(Namespace._namespace_usage(namespace_path)))
+        return links
+
+
+def layer_data(layer_usage: LayerUsage) -> Dict[str, Union[int, str]]:
+    return {
+        'digest': layer_usage.digest,
+        'size': layer_usage.size,
+        'tag_count': layer_usage.tag_count,
+        'repository_count': len(layer_usage.repositories),
+        # Bytes which would be stored additionally if every tag had its own copy of the layer
+        'saved_size': layer_usage.size * (layer_usage.tag_count - 1)
+    }
+
+
+class Layers(SecuredHalResource):
+    @staticmethod
+    def _limit() -> int:
+        limit = request.args.get('limit', str(DEFAULT_LAYER_LIMIT))
+        if not limit.isdigit() or int(limit) < 1:
+            raise InvalidArgumentError('limit', limit)
+        return int(limit)
+
+    @staticmethod
+    def query_arguments() -> Tuple[Any, ...]:
+        return (Layers._limit(), )
+
+    @staticmethod
+    def data() -> Optional[Dict[str, Union[float, bool, int]]]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            return {
+                'timestamp': snapshot.timestamp,
+                'stale': is_stale(snapshot),
+                'shared_layer_count': snapshot.index.layers.shared_layer_count
+            }
+        else:
+            return None
+
+    @staticmethod
+    def embedded() -> Optional[Embedded]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            return Embedded(
+                'items', Layer, *[
+                    (layer_usage.digest, ) for layer_usage in snapshot.index.layers.shared_layers(Layers._limit())
+                ],
+                always_as_list=True
+            )
+        else:
+            return None
+
+    @staticmethod
+    def links() -> Optional[Link]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            return Link(
+                'items',
+                *[
+                    ('/layers/{}'.format(layer_usage.digest), {
+                        'title': layer_usage.digest
+                    }) for layer_usage in snapshot.index.layers.shared_layers(Layers._limit())
+                ],
+                always_as_list=True,
+                quote=False
+            )
+        else:
+            return None
+
+
+class Layer(SecuredHalResource):
+    @staticmethod
+    def data(layer_digest: str) -> Optional[Dict[str, Union[int, str]]]:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            layer_usage = snapshot.index.layers.layer_usage(layer_digest)
+            if layer_usage is None:
+                raise ResourceNotExistingError('/layers/{}'.format(quote(layer_digest, safe='')))
+            return layer_data(layer_usage)
+        else:
+            return None
+
+    @staticmethod
+    def links(layer_digest: str) -> List[Link]:
+        links = [Link('collection', '/layers')]
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            tag_references = snapshot.index.layers.layer_tags(layer_digest)
+            if tag_references is not None:
+                links.append(
+                    Link(
+                        'tags',
+                        *[
+                            (
+                                '/repositories/{}/tags/{}'.format(
+                                    quote(tag_reference.repository, safe=''), quote(tag_reference.tag, safe='')
+                                ), {
+                                    'title': '{}:{}'.format(tag_reference.repository, tag_reference.tag)
+                                }
+                            ) for tag_reference in tag_references
+                        ],
+                        always_as_list=True,
+                        quote=False
+                    )
+                )
+        return links
+
+
+def registry_data(registry_id: str, snapshot: Optional[RegistrySnapshot]) -> Dict[str, Any]:
+    """Totals of a registry (`None` before its first crawl), taken from the usage of the root namespace which is
+    computed once per refresh."""
+    if snapshot is None:
+        return {
+            'id': registry_id,
+            'generation': None,
+            'timestamp': None,
+            'stale': False,
+            'size': None,
+            'disk_size': None,
+            'repository_count': None
+        }
+    root_namespace_usage = cast(NamespaceUsage, snapshot.index.namespace_usage(ROOT_NAMESPACE))
+    return {
+        'id': registry_id,
+        'generation': snapshot.generation,
+        'timestamp': snapshot.timestamp,
+        'stale': is_stale(snapshot, registry_id),
+        'size': root_namespace_usage.size,
+        'disk_size': root_namespace_usage.disk_size,
+        'repository_count': root_namespace_usage.repository_count
+    }
+
+
+class Registries(SecuredHalResource):
+    @jwt_required()  # type: ignore
+    def get(self) -> Any:
+        registry_snapshots = get_registry_snapshots()
+        snapshots = [snapshot for snapshot in registry_snapshots.values() if snapshot is not None]
+        if not snapshots:
+            return snapshot_unavailable_response()
+        # The sum of all generations grows with every refresh of any registry, so the response cache is dropped then
+        return self.cached_response(
+            sum(snapshot.generation for snapshot in snapshots),
+            max(snapshot.timestamp for snapshot in snapshots),
+            tuple(
+                (registry_id, snapshot.generation, snapshot.timestamp, is_stale(snapshot, registry_id))
+                if snapshot is not None else (registry_id, )
+                for registry_id, snapshot in registry_snapshots.items()
+            ), _registries_response_cache, {}
+        )
+
+    @staticmethod
+    def data() -> Dict[str, Any]:
+        """Combined totals of all registries which have been crawled (they do not share storage, so the disk sizes
+        add up as well)."""
+        registries = [
+            registry_data(registry_id, snapshot) for registry_id, snapshot in get_registry_snapshots().items()
+            if snapshot is not None
+        ]
+        return {
+            'registry_count': len(_registries),
+            'available_registry_count': len(registries),
+            'stale': any(registry['stale'] for registry in registries),
+            'size': sum(registry['size'] for registry in registries),
+            'disk_size': sum(registry['disk_size'] for registry in registries),
+            'repository_count': sum(registry['repository_count'] for registry in registries)
+        }
+
+    @staticmethod
+    def embedded() -> Embedded:
+        return Embedded(
+            'items', Registry, *[{
+                'registry_id': registry_id
+            } for registry_id in _registries], always_as_list=True
+        )
+
+    @staticmethod
+    def links() -> Link:
+        return Link(
+            'items',
+            *[
+                ('/registries/{}'.format(quote(registry_id, safe='')), {
+                    'title': registry_id
+                }) for registry_id in _registries
+            ],
+            always_as_list=True,
+            quote=False
+        )
+
+
+class Registry(SecuredHalResource):
+    @jwt_required()  # type: ignore
+    def get(self) -> Any:
+        # The registry id is taken from the url by `select_registry`, the document (and its self link) needs it back
+        return super().get(registry_id=get_registry().registry_id)
+
+    @staticmethod
+    def data(registry_id: str) -> Dict[str, Any]:
+        return registry_data(registry_id, get_registry_snapshots()[registry_id])
+
+    @staticmethod
+    def links(registry_id: str) -> List[Link]:
+        registry_path = '/registries/{}'.format(quote(registry_id, safe=''))
+        return [
+            Link('collection', '/registries'),
+            Link(
+                'related',
+                *[(registry_path + path, {
+                    'title': path[1:]
+                }) for path in ('/repositories', '/namespaces', '/layers', '/changes')],
+                always_as_list=True,
+                quote=False
+            )
+        ]
+
+
+def refresh_status_data(refresh_status: RefreshStatus) -> Dict[str, Any]:
+    progress = refresh_status.progress
+    return {
+        'running': progress.is_running,
+        'start_time': progress.start_time,
+        'processed_repositories': progress.processed_repositories,
+        'total_repositories': progress.total_repositories,
+        'interval': refresh_status.interval,
+        'next_refresh_time': refresh_status.next_refresh_time,
+        'last_refresh_time': refresh_status.last_refresh_time,
+        'last_error': refresh_status.last_error,
+        'last_success_time': refresh_status.health.last_success_time,
+        'last_failure_time': refresh_status.health.last_failure_time,
+        'last_failure': refresh_status.health.last_failure,
+        'consecutive_failures': refresh_status.health.consecutive_failures,
+    }
+
+
+def failed_repositories_data() -> List[str]:
+    snapshot = get_snapshot()
+    return list(snapshot.registry.failed_repositories) if snapshot is not None else []
+
+
+class Refresh(RestResource):  # type: ignore
+    @jwt_required()  # type: ignore
+    def get(self) -> Response:
+        refresh_data = refresh_status_data(cast(RefreshScheduler, get_registry().refresh_scheduler).status)
+        # Only authenticated users see the names of the repositories which could not be refreshed
+        refresh_data['failed_repositories'] = failed_repositories_data()
+        return jsonify(refresh_data)
+
+    @jwt_required()  # type: ignore
+    def post(self) -> Response:
+        refresh_scheduler = cast(RefreshScheduler, get_registry().refresh_scheduler)
+        is_triggered = refresh_scheduler.trigger()
+        refresh_data = refresh_status_data(refresh_scheduler.status)
+        refresh_data['failed_repositories'] = failed_repositories_data()
+        response = jsonify(refresh_data)  # type: Response
+        # A refresh which is already running is not restarted
+        response.status_code = 202 if is_triggered else 409
+        return response
+
+
+def health() -> Response:
+    """Report whether registry data can be served and how current it is, without authentication (for probes).
+
+    The status is `ok` for a current snapshot, `degraded` if the snapshot is stale, the last refresh failed or some
+    repositories could not be refreshed and `unavailable` (with status code 503) as long as no crawl succeeded. Error
+    messages and repository names are only reported by the (authenticated) refresh endpoint.
+    """
+    snapshot = get_snapshot()
+    snapshot_data = None  # type: Optional[Dict[str, Any]]
+    failed_repositories = 0
+    if snapshot is not None:
+        failed_repositories = len(snapshot.registry.failed_repositories)
+        snapshot_data = {
+            'generation': snapshot.generation,
+            'timestamp': snapshot.timestamp,
+            'age': max(time.time() - snapshot.timestamp, 0.0),
+            'stale': is_stale(snapshot),
+            'failed_repositories': failed_repositories,
+        }
+    refresh_data = None  # type: Optional[Dict[str, Any]]
+    consecutive_failures = 0
+    registry = get_registry()
+    # Worker processes do not refresh the registry, they read the refresh health which the main process publishes
+    refresh_health = registry.snapshot_source.health
+    if refresh_health is not None:
+        consecutive_failures = refresh_health.consecutive_failures
+        refresh_status = registry.refresh_scheduler.status if registry.refresh_scheduler is not None else None
+        refresh_data = {
+            'running': refresh_status.progress.is_running if refresh_status is not None else None,
+            'next_refresh_time': refresh_status.next_refresh_time if refresh_status is not None else None,
+            'last_success_time': refresh_health.last_success_time,
+            'last_failure_time': refresh_health.last_failure_time,
+            'consecutive_failures': consecutive_failures,
+        }
+    if snapshot is None:
+        status = 'unavailable'
+    elif cast(Dict[str, Any], snapshot_data)['stale'] or consecutive_failures > 0 or failed_repositories > 0:
+        status = 'degraded'
+    else:
+        status = 'ok'
+    response = jsonify({'status': status, 'snapshot': snapshot_data, 'refresh': refresh_data})  # type: Response
+    response.status_code = 503 if snapshot is None else 200
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def verify_static_token_or_jwt(static_token: Optional[str], *token_headers: str) -> None:
+    """Accept `static_token` as bearer token or in one of `token_headers`, otherwise require a valid auth token."""
+    if static_token is not None:
+        # Scrapers and webhooks authenticate with a configured token instead of an (expiring) auth token
+        expected_token = static_token.encode()
+        scheme, _, bearer_token = request.headers.get('Authorization', '').partition(' ')
+        presented_tokens = [bearer_token] if scheme.lower() == 'bearer' else []
+        presented_tokens.extend(request.headers.get(token_header, '') for token_header in token_headers)
+        if any(hmac.compare_digest(token.encode(), expected_token) for token in presented_tokens):
+            return
+    verify_jwt_in_request()
+
+
+class Notifications(RestResource):  # type: ignore
+    def post(self) -> Response:
+        # GitLab sends the secret token of a webhook in the `X-Gitlab-Token` header
+        verify_static_token_or_jwt(config.notifications_token, 'X-Gitlab-Token')
+        # Registry notifications use their own media type
+        refresh_request = parse_notification(request.get_json(force=True, silent=True))
+        cast(
+            Union[RepositoryRefreshQueue, ForwardingRefreshQueue],
+            get_registry().repository_refresh_queue
+        ).add(refresh_request)
+        response = jsonify(
+            {
+                'repositories': refresh_request.repositories,
+                'projects': refresh_request.projects
+            }
+        )  # type: Response
+        response.status_code = 202
+        return response
+
+
+def stop_refreshes(timeout: Optional[float] = None) -> None:
+    """Stop the refresh schedulers and the repository refresh queues of all registries and cancel running refreshes."""
+    for registry in _registries.values():
+        if isinstance(registry.repository_refresh_queue, RepositoryRefreshQueue):
+            registry.repository_refresh_queue.stop(timeout)
+        if registry.refresh_scheduler is not None:
+            registry.refresh_scheduler.stop(timeout)
+
+
+@jwt_required()  # type: ignore
+def export() -> Response:
+    snapshot = get_snapshot()
+    if snapshot is None:
+        return snapshot_unavailable_response()
+    export_format = request.args.get('format')
+    if export_format is None:
+        export_format = 'csv' if request.accept_mimetypes.best_match(
+            (EXPORT_MIMETYPES['ndjson'], EXPORT_MIMETYPES['csv']), default=EXPORT_MIMETYPES['ndjson']
+        ) == EXPORT_MIMETYPES['csv'] else 'ndjson'
+    elif export_format not in EXPORT_MIMETYPES:
+        raise InvalidArgumentError('format', export_format)
+    fields_argument = request.args.get('fields')
+    if fields_argument is None:
+        fields = list(EXPORT_FIELDS)
+    else:
+        fields = [field.strip() for field in fields_argument.split(',')]
+        if not fields or any(field not in EXPORT_FIELDS for field in fields):
+            raise InvalidArgumentError('fields', fields_argument)
+    content_encoding = negotiate_request_content_encoding()
+    etag = make_etag(
+        snapshot.generation, snapshot.timestamp, (registry_url_prefix(), 'export', export_format, tuple(fields)),
+        export_format, content_encoding
+    )
+    last_modified = datetime.datetime.fromtimestamp(int(snapshot.timestamp), datetime.timezone.utc)
+    headers = cache_validator_headers(etag, last_modified)
+    if is_not_modified(etag, last_modified):
+        return Response(status=304, headers=headers)
+    # The rows are encoded while the response is sent and only depend on the (immutable) snapshot, not on the request
+    response = Response(
+        stream_export(snapshot, export_format, fields, content_encoding),
+        content_type='{}; charset=utf-8'.format(EXPORT_MIMETYPES[export_format]),
+        headers=headers
+    )
+    if content_encoding != 'identity':
+        response.headers['Content-Encoding'] = content_encoding
+    return response
+
+
+def metrics() -> Response:
+    verify_static_token_or_jwt(config.metrics_token)
+    registry = get_registry()
+    return Response(
+        _metrics.render(get_snapshot(), registry.snapshot_source.health, registry.registry_id),
+        content_type=METRICS_MIMETYPE
+    )
+
+
+def create_usage_history(registry_config: RegistryConfig, read_only: bool = False) -> Optional[UsageHistory]:
+    if registry_config.history_file is None:
+        return None
+    return UsageHistory(
+        registry_config.history_file, config.history_retention, config.history_downsample_after, read_only=read_only
+    )
+
+
+def create_registry_cache(
+    registry_config: RegistryConfig,
+    history: Optional[UsageHistory],
+    cache_class: Type[GitLabRegistryCache] = GitLabRegistryCache,
+    **kwargs: Any
+) -> GitLabRegistryCache:
+    gitlab_registry_cache = cache_class(
+        registry_config.gitlab_base_url,
+        registry_config.registry_base_url,
+        registry_config.username,
+        registry_config.access_token,
+        incremental_refresh=registry_config.incremental_refresh,
+        workers=registry_config.workers,
+        snapshot_filename=registry_config.snapshot_file,
+        history=history,
+        change_generations=config.cache_change_generations,
+        **kwargs
+    )
+    # Serve a previously saved snapshot (marked as stale) right away instead of blocking until a crawl is finished
+    if not gitlab_registry_cache.load_snapshot():
+        try:
+            gitlab_registry_cache.update()
+        except Exception:  # pylint: disable=broad-except
+            # Start anyway, the refresh scheduler retries the crawl and requests for registry data get a 503 meanwhile
+            logger.exception('The initial crawl of the registry "%s" failed', registry_config.registry_id)
+    return gitlab_registry_cache
+
+
+def create_refresh_scheduler(
+    gitlab_registry_cache: GitLabRegistryCache,
+    registry_config: RegistryConfig,
+    scheduler_class: Type[RefreshScheduler] = RefreshScheduler
+) -> RefreshScheduler:
+    return scheduler_class(
+        gitlab_registry_cache,
+        registry_config.refresh_interval.total_seconds(),
+        jitter=config.refresh_jitter,
+        adaptive=config.refresh_adaptive,
+        min_interval=config.refresh_min_interval.total_seconds(),
+        max_interval=config.refresh_max_interval.total_seconds(),
+        retry_delay=config.refresh_retry_delay.total_seconds()
+    )
+
+
+def init_resources(
+    app: Flask, shared_snapshot_filename: Optional[str] = None, refresh_request_queue: Optional[Any] = None
+) -> None:
+    """Set up the api, in worker processes (`shared_snapshot_filename` is set) without own registry caches.
+
+    Worker processes read the snapshots of each registry from `registry_snapshot_filename(shared_snapshot_filename,
+    <registry id>)` and forward repository refresh requests to the `refresh_request_queue` (a `multiprocessing` queue).
+    """
+
+    def init_registry(registry_config: RegistryConfig) -> RegistryContext:
+        registry_id = registry_config.registry_id
+        # Samples are only recorded by the process which refreshes the registry
+        history = create_usage_history(registry_config, read_only=shared_snapshot_filename is not None)
+        refresh_scheduler = None  # type: Optional[RefreshScheduler]
+        repository_refresh_queue = None  # type: Optional[Union[RepositoryRefreshQueue, ForwardingRefreshQueue]]
+        if shared_snapshot_filename is not None:
+            snapshot_source = SharedSnapshotReader(
+                registry_snapshot_filename(shared_snapshot_filename, registry_id)
+            )  # type: Union[GitLabRegistryCache, SharedSnapshotReader]
+            if refresh_request_queue is not None:
+                repository_refresh_queue = ForwardingRefreshQueue(refresh_request_queue, registry_id)
+        else:
+            if config.server == 'asgi':
+                # Only available with the optional asgi dependencies, the asgi server refreshes the caches on its event
+                # loop
+                from .asgi import AsyncGitLabRegistryCache, AsyncRefreshScheduler
+                gitlab_registry_cache = create_registry_cache(registry_config, history, AsyncGitLabRegistryCache)
+                refresh_scheduler = create_refresh_scheduler(
+                    gitlab_registry_cache, registry_config, AsyncRefreshScheduler
+                )
+            else:
+                gitlab_registry_cache = create_registry_cache(registry_config, history)
+                refresh_scheduler = create_refresh_scheduler(gitlab_registry_cache, registry_config)
+                refresh_scheduler.start()
+            repository_refresh_queue = RepositoryRefreshQueue(
+                gitlab_registry_cache, config.notifications_delay.total_seconds()
+            )
+            repository_refresh_queue.start()
+            snapshot_source = gitlab_registry_cache
+        return RegistryContext(
+            registry_id, snapshot_source, refresh_scheduler, repository_refresh_queue, history,
+            RenderedResponseCache(config.cache_response_cache_size), registry_config.stale_after.total_seconds()
         )
-        gitlab_registry_cache.update()
-        gitlab_registry_cache.update_continuously()
-        return gitlab_registry_cache
 
     def init_api() -> Api:
+        def add_registry_resource(resource: Type[RestResource], url: str) -> None:
+            api.add_resource(resource, url, REGISTRY_URL_PREFIX + url)
+
+        def add_registry_url_rule(url: str, view_function: Callable[[], Response]) -> None:
+            for url_prefix in ('', REGISTRY_URL_PREFIX):
+                app.add_url_rule(url_prefix + url, view_function.__name__, view_function)
+
+        registries = list(_registries.values())
         api = Api(app)
         api.add_resource(AuthToken, '/auth_token')
-        api.add_resource(Repositories, '/repositories')
-        api.add_resource(Repository, '/repositories/<path:repository_name>')
-        api.add_resource(Tags, '/repositories/<path:repository_name>/tags')
-        api.add_resource(Tag, '/repositories/<path:repository_name>/tags/<path:tag_name>')
+        api.add_resource(Registries, '/registries')
+        api.add_resource(Registry, REGISTRY_URL_PREFIX)
+        add_registry_resource(Repositories, '/repositories')
+        add_registry_resource(RepositoryBatch, '/repositories/_batch')
+        add_registry_resource(TagBatch, '/repositories/_batch/tags')
+        if any(registry.history is not None for registry in registries):
+            add_registry_resource(RepositoryGrowth, '/repositories/_growth')
+            add_registry_resource(RepositoryHistory, '/repositories/<path:repository_name>/history')
+        add_registry_resource(Repository, '/repositories/<path:repository_name>')
+        add_registry_resource(Tags, '/repositories/<path:repository_name>/tags')
+        add_registry_resource(Tag, '/repositories/<path:repository_name>/tags/<path:tag_name>')
+        add_registry_resource(Changes, '/changes')
+        add_registry_resource(Namespaces, '/namespaces')
+        add_registry_resource(Namespace, '/namespaces/<path:namespace_path>')
+        add_registry_resource(Layers, '/layers')
+        add_registry_resource(Layer, '/layers/<layer_digest>')
+        if any(registry.refresh_scheduler is not None for registry in registries):
+            add_registry_resource(Refresh, '/admin/refresh')
+        if any(registry.repository_refresh_queue is not None for registry in registries):
+            add_registry_resource(Notifications, '/admin/notifications')
+        add_registry_url_rule('/export', export)
+        add_registry_url_rule('/metrics', metrics)
+        add_registry_url_rule('/health', health)
         return api
 
     def init_errorhandlers() -> None:
-        @app.errorhandler(ResourceNotExistingError)  # type: ignore
-        def handle_invalid_usage(error: ResourceNotExistingError) -> Response:  # pylint: disable=unused-variable
+        @app.errorhandler(ApiError)  # type: ignore
+        def handle_invalid_usage(error: ApiError) -> Response:  # pylint: disable=unused-variable
             response = jsonify(error.to_dict())  # type: Response
             response.status_code = error.status_code
             return response
 
-    gitlab_registry_cache = init_registry()
+    global _registries, _default_registry_id, _registries_response_cache, _content_encodings, _compression_min_size
+    registry_configs = config.registries
+    _content_encodings = available_content_encodings(config.compression_encodings)
+    _compression_min_size = config.compression_min_size
+    _registries_response_cache = RenderedResponseCache(config.cache_response_cache_size)
+    # The initial crawls of the registries run concurrently
+    with ThreadPoolExecutor(max_workers=len(registry_configs)) as executor:
+        _registries = {registry.registry_id: registry for registry in executor.map(init_registry, registry_configs)}
+    _default_registry_id = registry_configs[0].registry_id
     init_api()
     init_errorhandlers()
 
+    @app.url_value_preprocessor  # type: ignore
+    def select_registry(  # pylint: disable=unused-variable
+        endpoint: Optional[str], values: Optional[Dict[str, Any]]
+    ) -> None:
+        # Resources below `/registries/<id>` get the registry from `get_registry` instead of an argument
+        if values is None or 'registry_id' not in values:
+            return
+        registry_id = values.pop('registry_id')
+        if registry_id not in _registries:
+            raise ResourceNotExistingError('/registries/{}'.format(quote(registry_id, safe='')))
+        g.registry = _registries[registry_id]
+
     @app.before_request  # type: ignore
-    def set_request_context() -> None:  # pylint: disable=unused-variable
-        global _request_context
-        _request_context = RequestContext(gitlab_registry_cache.registry, gitlab_registry_cache.timestamp)
+    def pin_snapshot() -> None:  # pylint: disable=unused-variable
+        # Every request works on the snapshot which was current when it started, even if a refresh publishes a new one
+        g.registry_snapshot = get_registry().snapshot_source.current_snapshot
+        g.request_start_time = time.monotonic()
+
+    @app.after_request  # type: ignore
+    def add_snapshot_headers(response: Response) -> Response:  # pylint: disable=unused-variable
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            response.headers['X-Snapshot-Generation'] = str(snapshot.generation)
+            # All data is as old as the crawl of the snapshot, even if the response was rendered just now
+            response.headers['Age'] = str(max(int(time.time() - snapshot.timestamp), 0))
+        return response
+
+    @app.after_request  # type: ignore
+    def observe_request(response: Response) -> Response:  # pylint: disable=unused-variable
+        request_start_time = g.get('request_start_time')
+        if request_start_time is not None:
+            # Label by url rule instead of path to keep the number of series bounded
+            endpoint = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+            _metrics.observe_request(endpoint, time.monotonic() - request_start_time, response.content_length)
+        return response
+
+    # Registered last, so it runs before the other `after_request` functions and they see the compressed body
+    @app.after_request  # type: ignore
+    def compress_response(response: Response) -> Response:  # pylint: disable=unused-variable
+        # HAL documents and exports are compressed by their endpoints, responses with an `ETag` must not change their
+        # body behind it and streamed responses are left alone
+        if (
+            response.status_code != 200 or response.direct_passthrough or response.is_streamed or
+            'Content-Encoding' in response.headers or 'ETag' in response.headers
+        ):
+            return response
+        content_encoding = negotiate_request_content_encoding()
+        if content_encoding == 'identity' or cast(int, response.content_length) < _compression_min_size:
+            return response
+        response.set_data(compress(response.get_data(), content_encoding))
+        response.headers['Content-Encoding'] = content_encoding
+        response.vary.add('Accept-Encoding')
+        return response
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+from .encoding import compress
+from typing import Callable, Dict, Hashable, NamedTuple, Optional  # noqa: F401  # pylint: disable=unused-import
+
+# `encoded_bodies` holds the compressed variants of `body` by content coding, filled on first use (see `encoded_body`)
+RenderedResponse = NamedTuple(
+    'RenderedResponse', [
+        ('body', bytes), ('mimetype', str), ('status_code', int), ('encoded_bodies', Dict[str, bytes])
+    ]
+)
+
+
+class RenderedResponseCache:
+    """Stores encoded response bodies for one snapshot generation.
+
+    All entries are dropped as soon as a response for a newer generation is requested. The number of stored responses
+    is bounded by evicting the least recently used ones.
+    """
+
+    def __init__(self, max_size: int = 10000) -> None:
+        self._max_size = max_size
+        self._generation = None  # type: Optional[int]
+        self._responses = OrderedDict()  # type: OrderedDict[Hashable, RenderedResponse]
+        self._lock = threading.Lock()
+
+    def get(
+        self, generation: int, key: Hashable, render: Callable[[], RenderedResponse]
+    ) -> RenderedResponse:
+        with self._lock:
+            if generation == self._generation and key in self._responses:
+                self._responses.move_to_end(key)
+                return self._responses[key]
+        # Render without holding the lock; concurrent misses for the same key may render twice which is harmless
+        rendered_response = render()
+        with self._lock:
+            if self._generation is None or generation > self._generation:
+                self._generation = generation
+                self._responses.clear()
+            if generation == self._generation and self._max_size > 0:
+                self._responses[key] = rendered_response
+                while len(self._responses) > self._max_size:
+                    self._responses.popitem(last=False)
+        return rendered_response
+
+    def clear(self) -> None:
+        with self._lock:
+            self._responses.clear()
+
+
+def render_response(body: bytes, mimetype: str, status_code: int = 200) -> RenderedResponse:
+    return RenderedResponse(body, mimetype, status_code, {})
+
+
+def encoded_body(rendered_response: RenderedResponse, content_encoding: str) -> bytes:
+    """Return the body of a rendered response in `content_encoding`, compressed once per cached response and coding."""
+    if content_encoding == 'identity':
+        return rendered_response.body
+    body = rendered_response.encoded_bodies.get(content_encoding)
+    if body is None:
+        # Concurrent requests may compress the same body twice, which is harmless
+        body = compress(rendered_response.body, content_encoding)
+        rendered_response.encoded_bodies[content_encoding] = body
+    return body
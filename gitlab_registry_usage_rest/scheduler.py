@@ -0,0 +1,178 @@
+import logging
+import random
+import threading
+import time
+from .cache import GitLabRegistryCache, RefreshHealth, RefreshProgress
+from .registry import RefreshCancelledError
+from typing import NamedTuple, Optional  # noqa: F401  # pylint: disable=unused-import
+
+logger = logging.getLogger(__name__)
+
+# An adaptive interval is at least this multiple of the last crawl duration (a crawl uses at most 10% of the time)
+CRAWL_COST_FACTOR = 10
+# Growth of an adaptive interval after a refresh which found no changed tags
+IDLE_BACKOFF_FACTOR = 1.5
+# Growth of the retry delay after every further failed refresh
+FAILURE_BACKOFF_FACTOR = 2
+# Delay (in seconds) until a skipped refresh is retried if `retry_delay` is disabled
+BUSY_RETRY_DELAY = 10
+
+RefreshStatus = NamedTuple(
+    'RefreshStatus', [
+        ('progress', RefreshProgress), ('interval', float), ('next_refresh_time', Optional[float]),
+        ('last_refresh_time', Optional[float]), ('last_error', Optional[str]), ('health', RefreshHealth)
+    ]
+)
+
+
+class RefreshScheduler:
+    """Refreshes a registry cache periodically in a background thread.
+
+    Every delay is the current interval randomized by +/- `jitter` (a fraction of the interval), so that several
+    instances which crawl the same registry do not run in lockstep. With `adaptive`, the interval grows while refreshes
+    find no changed tags, shrinks with the share of changed tags and never drops below `CRAWL_COST_FACTOR` times the
+    last crawl duration; it always stays between `min_interval` and `max_interval` (all in seconds).
+
+    A failed refresh is retried after `retry_delay` seconds, the delay grows by `FAILURE_BACKOFF_FACTOR` with every
+    further failure up to the regular interval. Meanwhile the cache keeps serving the last published snapshot. A
+    refresh which is skipped because another refresh (for example of notified repositories) holds the cache is retried
+    after `retry_delay` as well, so a steady stream of partial refreshes cannot postpone the full crawl by intervals.
+    """
+
+    def __init__(
+        self,
+        gitlab_registry_cache: GitLabRegistryCache,
+        interval: float = 3600,
+        jitter: float = 0.0,
+        adaptive: bool = False,
+        min_interval: float = 0,
+        max_interval: Optional[float] = None,
+        retry_delay: float = 60
+    ) -> None:
+        self._gitlab_registry_cache = gitlab_registry_cache
+        self._jitter = min(max(jitter, 0.0), 1.0)
+        self._adaptive = adaptive
+        self._min_interval = min_interval
+        self._max_interval = max_interval if max_interval is not None else float('inf')
+        self._interval = interval
+        self._retry_delay = retry_delay
+        self._next_refresh_time = None  # type: Optional[float]
+        self._last_refresh_time = None  # type: Optional[float]
+        self._last_error = None  # type: Optional[str]
+        self._wakeup_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def _adapt_interval(self) -> None:
+        if not self._adaptive:
+            return
+        snapshot = self._gitlab_registry_cache.snapshot
+        interval = self._interval
+        refresh_statistics = snapshot.registry.refresh_statistics
+        # Without incremental refreshes every tag is fetched, so changes cannot be detected
+        if refresh_statistics is not None and self._gitlab_registry_cache.incremental_refresh:
+            total_tags = refresh_statistics.fetched_tags + refresh_statistics.reused_tags
+            change_ratio = refresh_statistics.fetched_tags / total_tags if total_tags > 0 else 0.0
+            if change_ratio == 0:
+                interval *= IDLE_BACKOFF_FACTOR
+            else:
+                interval *= max(1 - change_ratio, 0.5)
+        if snapshot.crawl_duration is not None:
+            interval = max(interval, CRAWL_COST_FACTOR * snapshot.crawl_duration)
+        self._interval = min(max(interval, self._min_interval), self._max_interval)
+
+    def _failure_delay(self) -> Optional[float]:
+        """Return the delay until a failed refresh is retried (`None` if the last refresh did not fail)."""
+        consecutive_failures = self._gitlab_registry_cache.health.consecutive_failures
+        if consecutive_failures == 0 or self._retry_delay <= 0:
+            return None
+        # Bound the exponent, the delay reaches the interval long before and a huge power would overflow
+        backoff = FAILURE_BACKOFF_FACTOR**min(consecutive_failures - 1, 32)
+        delay = min(self._retry_delay * backoff, self._interval)
+        return delay * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+    def _busy_delay(self) -> float:
+        """Return the delay until a refresh which was skipped for a running refresh is tried again."""
+        delay = min(self._retry_delay if self._retry_delay > 0 else BUSY_RETRY_DELAY, self._interval)
+        return delay * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+    def _schedule_next_refresh(self, delay: Optional[float] = None) -> None:
+        if delay is None:
+            delay = self._interval * random.uniform(1 - self._jitter, 1 + self._jitter)
+        self._next_refresh_time = time.time() + delay
+        logger.info('Next registry refresh in %.0f seconds', delay)
+
+    def _refreshed(self, is_run: bool, error: Optional[BaseException] = None) -> None:
+        if not is_run:
+            logger.info('Skipping the scheduled registry refresh, another refresh is running')
+            self._schedule_next_refresh(self._busy_delay())
+            return
+        self._last_refresh_time = time.time()
+        if error is None:
+            self._last_error = None
+            self._adapt_interval()
+        else:
+            self._last_error = str(error) or type(error).__name__
+        self._schedule_next_refresh(self._failure_delay())
+
+    def _refresh(self) -> None:
+        try:
+            is_run = self._gitlab_registry_cache.update_if_idle()
+        except RefreshCancelledError:
+            raise
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('Registry refresh failed')
+            self._refreshed(True, e)
+            return
+        self._refreshed(is_run)
+
+    def _first_delay(self) -> Optional[float]:
+        # Refresh right away if the cache only holds a snapshot which was loaded from disk, retry soon if the initial
+        # crawl failed
+        return 0.0 if self._gitlab_registry_cache.is_stale else self._failure_delay()
+
+    def _run(self) -> None:
+        self._schedule_next_refresh(self._first_delay())
+        while True:
+            self._wakeup_event.wait(max(self._next_refresh_time_or_now - time.time(), 0))
+            self._wakeup_event.clear()
+            if self._stop_event.is_set():
+                return
+            if time.time() < self._next_refresh_time_or_now:
+                continue
+            try:
+                self._refresh()
+            except RefreshCancelledError:
+                return
+
+    def start(self) -> None:
+        # The refresh thread must not keep the process alive once the server has stopped
+        self._thread = threading.Thread(target=self._run, name='refresh-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop scheduling refreshes and cancel a running refresh; wait up to `timeout` seconds for it to finish."""
+        self._stop_event.set()
+        self._wakeup_event.set()
+        self._gitlab_registry_cache.cancel_update()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def trigger(self) -> bool:
+        """Run a refresh now; return `False` if a refresh is already running."""
+        if self._gitlab_registry_cache.progress.is_running:
+            return False
+        self._next_refresh_time = time.time()
+        self._wakeup_event.set()
+        return True
+
+    @property
+    def _next_refresh_time_or_now(self) -> float:
+        return self._next_refresh_time if self._next_refresh_time is not None else time.time()
+
+    @property
+    def status(self) -> RefreshStatus:
+        return RefreshStatus(
+            self._gitlab_registry_cache.progress, self._interval, self._next_refresh_time, self._last_refresh_time,
+            self._last_error, self._gitlab_registry_cache.health
+        )
@@ -0,0 +1,276 @@
+import copy
+import re
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from .compact import CompactRegistry, NO_SIZE, RegistryPatch
+from .tables import bisect_by_key, move_sorted_ids, StringTable
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple  # noqa: F401
+
+SIZE_KEYS = ('size', 'disk_size')
+
+SizeRange = NamedTuple('SizeRange', [('key', str), ('minimum', Optional[int]), ('maximum', Optional[int])])
+CollectionFilter = NamedTuple(
+    'CollectionFilter', [
+        ('pattern', Optional[str]), ('substring', Optional[str]), ('size_ranges', Tuple[SizeRange, ...])
+    ]
+)
+
+
+def glob_prefix(pattern: str) -> str:
+    """Return the literal start of a glob pattern, all names matching the pattern begin with it."""
+    match = re.match(r'[^*?\[]*', pattern)
+    return match.group() if match is not None else ''
+
+
+def glob_to_regex(pattern: str) -> str:
+    """Translate a glob pattern (`*`, `?` and `[...]` like `fnmatch`) to a regular expression which matches within a
+    single line (`*` also matches `/`)."""
+    regex_parts = []  # type: List[str]
+    i = 0
+    while i < len(pattern):
+        character = pattern[i]
+        i += 1
+        if character == '*':
+            regex_parts.append('[^\n]*')
+        elif character == '?':
+            regex_parts.append('[^\n]')
+        elif character == '[':
+            start = i + 1 if pattern[i:i + 1] == '!' else i
+            # A `]` right at the start of the class is a literal character
+            end = pattern.find(']', start + 1 if pattern[start:start + 1] == ']' else start)
+            if end < 0:
+                regex_parts.append(re.escape(character))
+                continue
+            negated = start > i
+            # Everything but ranges is literal in a glob character class
+            characters = ''.join(
+                '\\' + class_character if class_character in '\\[]^&~|' else class_character
+                for class_character in pattern[start:end]
+            )
+            i = end + 1
+            regex_parts.append('[{}{}]'.format('^\n' if negated else '', characters))
+        else:
+            regex_parts.append(re.escape(character))
+    return ''.join(regex_parts)
+
+
+class NameIndex:
+    """Names which are searched with one regular expression over the data of a `StringTable` (one name per line)
+    instead of a loop over the names in Python.
+
+    The names must be sorted in every group of names which is searched (`start` to `stop`), so the names matching the
+    literal prefix of a glob pattern are a range which is found by binary search and only that range is scanned. The
+    expression matches the UTF-8 encoded names, which gives the same results as matching the names themselves for the
+    ASCII repository and tag names of a registry.
+    """
+
+    def __init__(self, names: Iterable[str]) -> None:
+        self._names = StringTable(names)
+
+    def extended(self, names: Iterable[str]) -> 'NameIndex':
+        """Return an index of the names of this index followed by `names` (this index is not changed)."""
+        index = copy.copy(self)
+        index._names = self._names.extended(names)
+        return index
+
+    def search(
+        self, pattern: Optional[str], substring: Optional[str], start: int = 0, stop: Optional[int] = None
+    ) -> List[int]:
+        """Return the indices (in ascending order) of the names in `[start:stop]` which match the glob `pattern` and
+        contain `substring` (ignoring case)."""
+        if stop is None:
+            stop = len(self._names)
+        prefix = glob_prefix(pattern) if pattern is not None else ''
+        if prefix:
+            start = bisect_left(self._names, prefix, start, stop)
+            if ord(prefix[-1]) < sys.maxunicode:
+                stop = bisect_left(self._names, prefix[:-1] + chr(ord(prefix[-1]) + 1), start, stop)
+        if start >= stop:
+            return []
+        regex = re.compile(
+            '^{}{}$'.format(
+                '(?=[^\n]*?(?i:{}))'.format(re.escape(substring)) if substring else '',
+                glob_to_regex(pattern) if pattern is not None else '[^\n]*'
+            ).encode('utf-8'), re.MULTILINE
+        )
+        offsets = self._names.offsets
+        return [
+            bisect_right(offsets, match.start(), start, stop) - 1
+            for match in regex.finditer(self._names.data, offsets[start], offsets[stop] - 1)
+        ]
+
+    @property
+    def names(self) -> Sequence[str]:
+        return self._names
+
+
+class SearchIndex:
+    """Name and size lookup structures for filtering the repositories and the tags of a repository.
+
+    Repositories are identified by their position in the sorted registry catalog, the tags of a repository are a slice
+    of one list of the registry tag ids of all repositories, sorted by name in every slice. The sizes of repositories
+    are stored in typed arrays indexed by their positions and the repositories are additionally sorted by every size,
+    so a size range alone is found by binary search. The sizes of tags are looked up in the registry.
+    """
+
+    def __init__(self, gitlab_registry: CompactRegistry, sorted_repository_ids: Sequence[int]) -> None:
+        """Build the index for the repositories with the given registry ids, which must be sorted by name."""
+        self._registry = gitlab_registry
+        self._repository_names = NameIndex(map(gitlab_registry.repository_name, sorted_repository_ids))
+        self._repository_sizes = {}  # type: Dict[str, array[int]]
+        self._sorted_repository_ids = {}  # type: Dict[str, array[int]]
+        for size_key, size in self._repository_size_columns(gitlab_registry).items():
+            self._repository_sizes[size_key] = array(
+                'q', (
+                    repository_size if repository_size is not None else NO_SIZE
+                    for repository_size in map(size, sorted_repository_ids)
+                )
+            )
+            column = self._repository_sizes[size_key]
+            self._sorted_repository_ids[size_key] = array(
+                'I',
+                sorted(
+                    (repository_id for repository_id in range(len(column)) if column[repository_id] != NO_SIZE),
+                    key=column.__getitem__
+                )
+            )
+        self._tag_starts = array('Q')
+        self._tag_stops = array('Q')
+        self._tag_ids = array('I')
+        for repository_id in sorted_repository_ids:
+            self._tag_starts.append(len(self._tag_ids))
+            self._tag_ids.extend(
+                sorted(gitlab_registry.repository_tag_ids(repository_id), key=gitlab_registry.tag_name)
+            )
+            self._tag_stops.append(len(self._tag_ids))
+        self._tag_names = NameIndex(map(gitlab_registry.tag_name, self._tag_ids))
+
+    @staticmethod
+    def _repository_size_columns(gitlab_registry: CompactRegistry) -> Dict[str, Callable[[int], Optional[int]]]:
+        return {
+            'size': gitlab_registry.repository_size,
+            'disk_size': gitlab_registry.repository_disk_size,
+        }
+
+    def patched(self, gitlab_registry: CompactRegistry, registry_patch: RegistryPatch) -> 'SearchIndex':
+        """Return the index of `gitlab_registry`, which `registry_patch` patched from the registry of this index."""
+        index = copy.copy(self)
+        index._registry = gitlab_registry
+        repository_names = self._repository_names.names
+        positions = {
+            repository_id: bisect_left(repository_names, gitlab_registry.repository_name(repository_id))
+            for repository_id in registry_patch.changed_repository_ids
+        }
+        index._repository_sizes = {}
+        index._sorted_repository_ids = {}
+        for size_key, size in self._repository_size_columns(gitlab_registry).items():
+            previous_column = self._repository_sizes[size_key]
+            column = previous_column[:]
+            for repository_id, position in positions.items():
+                repository_size = size(repository_id)
+                column[position] = repository_size if repository_size is not None else NO_SIZE
+            index._repository_sizes[size_key] = column
+            index._sorted_repository_ids[size_key] = self._sorted_repository_ids[size_key][:]
+            move_sorted_ids(
+                index._sorted_repository_ids[size_key], positions.values(),
+                lambda position, column=previous_column: (  # type: ignore
+                    (column[position], position) if column[position] != NO_SIZE else None
+                ),
+                lambda position, column=column: (  # type: ignore
+                    (column[position], position) if column[position] != NO_SIZE else None
+                )
+            )
+        # The refreshed repositories get new tag slices at the end of the tag list
+        index._tag_starts = self._tag_starts[:]
+        index._tag_stops = self._tag_stops[:]
+        index._tag_ids = self._tag_ids[:]
+        for repository_id in registry_patch.repository_ids:
+            index._tag_starts[positions[repository_id]] = len(index._tag_ids)
+            index._tag_ids.extend(
+                sorted(gitlab_registry.repository_tag_ids(repository_id), key=gitlab_registry.tag_name)
+            )
+            index._tag_stops[positions[repository_id]] = len(index._tag_ids)
+        index._tag_names = self._tag_names.extended(
+            map(gitlab_registry.tag_name, index._tag_ids[len(self._tag_ids):])
+        )
+        return index
+
+    @staticmethod
+    def _is_in_size_ranges(
+        sizes: Mapping[str, Callable[[int], int]], size_ranges: Iterable[SizeRange], item_id: int
+    ) -> bool:
+        for size_range in size_ranges:
+            size = sizes[size_range.key](item_id)
+            if (
+                size == NO_SIZE or (size_range.minimum is not None and size < size_range.minimum) or
+                (size_range.maximum is not None and size > size_range.maximum)
+            ):
+                return False
+        return True
+
+    def repositories(self, collection_filter: CollectionFilter, sort_key: str, descending: bool) -> List[str]:
+        """Return all repositories which match the filter in the given order (repositories without size information are
+        sorted last, like in `RegistryIndex.sorted_repositories`)."""
+        size_ranges = collection_filter.size_ranges
+        if collection_filter.pattern is not None or collection_filter.substring is not None:
+            repository_ids = self._repository_names.search(
+                collection_filter.pattern, collection_filter.substring
+            )  # type: Sequence[int]
+        elif size_ranges:
+            # Look up the first size range in the repositories sorted by that size and check the others afterwards
+            sorted_ids = self._sorted_repository_ids[size_ranges[0].key]
+            column = self._repository_sizes[size_ranges[0].key]
+            minimum, maximum = size_ranges[0].minimum, size_ranges[0].maximum
+            repository_ids = sorted_ids[
+                bisect_by_key(sorted_ids, minimum, column.__getitem__) if minimum is not None else 0:
+                bisect_by_key(sorted_ids, maximum + 1, column.__getitem__) if maximum is not None else len(sorted_ids)
+            ]
+            size_ranges = size_ranges[1:]
+        else:
+            repository_ids = range(len(self._repository_names.names))
+        if size_ranges:
+            repository_size_columns = {
+                size_key: column.__getitem__ for size_key, column in self._repository_sizes.items()
+            }  # type: Dict[str, Callable[[int], int]]
+            repository_ids = [
+                repository_id for repository_id in repository_ids
+                if self._is_in_size_ranges(repository_size_columns, size_ranges, repository_id)
+            ]
+        if sort_key in SIZE_KEYS:
+            sizes = self._repository_sizes[sort_key]
+            sorted_repository_ids = sorted(
+                (repository_id for repository_id in repository_ids if sizes[repository_id] != NO_SIZE),
+                key=lambda repository_id: (sizes[repository_id], repository_id),
+                reverse=descending
+            )
+            sorted_repository_ids.extend(
+                repository_id for repository_id in repository_ids if sizes[repository_id] == NO_SIZE
+            )
+        else:
+            sorted_repository_ids = sorted(repository_ids, reverse=descending)
+        names = self._repository_names.names
+        return [names[repository_id] for repository_id in sorted_repository_ids]
+
+    def tags(self, repository: str, collection_filter: CollectionFilter) -> List[str]:
+        """Return the tags of `repository` which match the filter, sorted by name."""
+        repository_names = self._repository_names.names
+        repository_id = bisect_left(repository_names, repository)
+        if repository_id == len(repository_names) or repository_names[repository_id] != repository:
+            raise KeyError(repository)
+        start, stop = self._tag_starts[repository_id], self._tag_stops[repository_id]
+        if collection_filter.pattern is not None or collection_filter.substring is not None:
+            positions = self._tag_names.search(
+                collection_filter.pattern, collection_filter.substring, start, stop
+            )  # type: Sequence[int]
+        else:
+            positions = range(start, stop)
+        tag_size_columns = {
+            'size': self._registry.tag_size,
+            'disk_size': self._registry.tag_disk_size,
+        }
+        tag_names = self._tag_names.names
+        return [
+            tag_names[position] for position in positions
+            if self._is_in_size_ranges(tag_size_columns, collection_filter.size_ranges, self._tag_ids[position])
+        ]
@@ -0,0 +1,268 @@
+import io
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from .cache import GitLabRegistryCache, RefreshHealth, RegistrySnapshot
+from typing import cast, Any, Callable, Dict, IO, List, Optional, Tuple  # noqa: F401  # pylint: disable=unused-import
+
+logger = logging.getLogger(__name__)
+
+SHARED_SNAPSHOT_MAGIC = b'GRUS'
+SHARED_SNAPSHOT_FORMAT_VERSION = 2
+# magic, format version, snapshot generation, size of the pickled snapshot
+SHARED_SNAPSHOT_HEADER = struct.Struct('<4sIQQ')
+# Alignment of the data section and of every buffer in it
+BUFFER_ALIGNMENT = 8
+CHECK_INTERVAL = 0.5
+
+
+def registry_snapshot_filename(shared_snapshot_filename: str, registry_id: str) -> str:
+    """Return the shared snapshot file of the registry `registry_id`, every registry publishes to its own file."""
+    return '{}.{}'.format(shared_snapshot_filename, registry_id)
+
+
+def shared_health_filename(shared_snapshot_filename: str) -> str:
+    """Return the file next to a shared snapshot file to which the refresh health of its registry is published."""
+    return '{}.health'.format(shared_snapshot_filename)
+
+
+def _replace_file(filename: str, write: Callable[[IO[bytes]], None]) -> None:
+    """Write a new version of `filename` with `write` and replace the file atomically."""
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', prefix='.shared-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as shared_file:
+            write(shared_file)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // BUFFER_ALIGNMENT) * BUFFER_ALIGNMENT
+
+
+class _BufferPickler(pickle.Pickler):
+    """Pickler which leaves out the contents of typed arrays and pickles references to their position in a data section
+    instead, the arrays and their offsets are collected in `buffers` for writing the data section after the pickle."""
+
+    def __init__(self, file: IO[bytes]) -> None:
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.buffers = []  # type: List[Tuple[int, array]]
+        self.data_size = 0
+        self._buffer_ids = {}  # type: Dict[int, Tuple[str, int, int]]
+
+    def persistent_id(self, obj: Any) -> Optional[Tuple[str, int, int]]:
+        if type(obj) is not array:  # pylint: disable=unidiomatic-typecheck
+            return None
+        buffer_id = self._buffer_ids.get(id(obj))
+        if buffer_id is None:
+            offset = _aligned(self.data_size)
+            buffer_id = self._buffer_ids[id(obj)] = (obj.typecode, offset, len(obj))
+            self.buffers.append((offset, obj))
+            self.data_size = offset + len(obj) * obj.itemsize
+        return buffer_id
+
+
+class _BufferUnpickler(pickle.Unpickler):
+    """Unpickler for `_BufferPickler` which replaces the array references by views of the data section."""
+
+    def __init__(self, file: IO[bytes], data: memoryview) -> None:
+        super().__init__(file)
+        self._data = data
+
+    def persistent_load(self, pid: Any) -> memoryview:
+        typecode, offset, length = pid
+        return self._data[offset:offset + length * array(typecode).itemsize].cast(typecode)
+
+
+def write_shared_snapshot(filename: str, snapshot: RegistrySnapshot) -> None:
+    """Write a snapshot (including its index) to `filename` for other processes.
+
+    The snapshot consists of few objects which refer to large typed arrays (see `CompactRegistry`), so the file contains
+    the pickled objects and the raw contents of all arrays after them, which readers use in place. The file is replaced
+    atomically, so readers which still map the previous file keep a consistent view of it.
+    """
+    pickled_snapshot = io.BytesIO()
+    pickler = _BufferPickler(pickled_snapshot)
+    pickler.dump(snapshot)
+
+    pickle_size = len(pickled_snapshot.getbuffer())
+
+    def write(shared_snapshot_file: IO[bytes]) -> None:
+        shared_snapshot_file.write(
+            SHARED_SNAPSHOT_HEADER.pack(
+                SHARED_SNAPSHOT_MAGIC, SHARED_SNAPSHOT_FORMAT_VERSION, snapshot.generation, pickle_size
+            )
+        )
+        shared_snapshot_file.write(pickled_snapshot.getbuffer())
+        position = SHARED_SNAPSHOT_HEADER.size + pickle_size
+        data_start = _aligned(position)
+        for offset, buffer in pickler.buffers:
+            # Pad up to the aligned offset of the buffer
+            shared_snapshot_file.write(bytes(data_start + offset - position))
+            shared_snapshot_file.write(buffer)
+            position = data_start + offset + len(buffer) * buffer.itemsize
+
+    _replace_file(filename, write)
+
+
+def write_shared_health(filename: str, health: RefreshHealth) -> None:
+
+    def write(shared_health_file: IO[bytes]) -> None:
+        shared_health_file.write(json.dumps(health._asdict()).encode('utf-8'))
+
+    _replace_file(filename, write)
+
+
+def read_shared_health(filename: str) -> RefreshHealth:
+    with open(filename, 'rb') as shared_health_file:
+        return RefreshHealth(**json.loads(shared_health_file.read().decode('utf-8')))
+
+
+def read_shared_snapshot(filename: str) -> RegistrySnapshot:
+    """Load a snapshot which `write_shared_snapshot` wrote.
+
+    All arrays of the snapshot are read-only memoryviews of the mapped file, so the pages are shared between all
+    processes which loaded the same file. The mapping is released with the last view, when the snapshot is discarded.
+    """
+    with open(filename, 'rb') as shared_snapshot_file:
+        # The map stays open after the file is closed (until the last view is released)
+        shared_snapshot_map = mmap.mmap(shared_snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, format_version, _, pickle_size = SHARED_SNAPSHOT_HEADER.unpack_from(shared_snapshot_map)
+    if magic != SHARED_SNAPSHOT_MAGIC or format_version != SHARED_SNAPSHOT_FORMAT_VERSION:
+        raise ValueError('"{}" is not a shared snapshot file of a supported version'.format(filename))
+    pickle_end = SHARED_SNAPSHOT_HEADER.size + pickle_size
+    return cast(
+        RegistrySnapshot,
+        _BufferUnpickler(
+            io.BytesIO(shared_snapshot_map[SHARED_SNAPSHOT_HEADER.size:pickle_end]),
+            memoryview(shared_snapshot_map)[_aligned(pickle_end):]
+        ).load()
+    )
+
+
+class SharingGitLabRegistryCache(GitLabRegistryCache):
+    """Registry cache which additionally publishes every snapshot and every change of its refresh health to shared
+    files for worker processes.
+
+    The shared file is only read by processes of the same service, it must not be placed in a directory which is
+    writable by others (it is unpickled).
+    """
+
+    def __init__(self, *args: Any, shared_snapshot_filename: str, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._shared_snapshot_filename = shared_snapshot_filename
+        self._shared_generation = 0
+        self._share_lock = threading.Lock()
+        self._set_health(self.health)
+
+    def _set_health(self, health: RefreshHealth) -> None:
+        super()._set_health(health)
+        try:
+            write_shared_health(shared_health_filename(self._shared_snapshot_filename), health)
+        except OSError as e:
+            logger.warning('Could not publish the refresh health: %s', e)
+
+    def _publish(self, *args: Any, **kwargs: Any) -> RegistrySnapshot:
+        snapshot = super()._publish(*args, **kwargs)
+        with self._share_lock:
+            # Two refreshes may finish concurrently, never replace a newer shared snapshot with an older one
+            if snapshot.generation > self._shared_generation:
+                write_shared_snapshot(self._shared_snapshot_filename, snapshot)
+                self._shared_generation = snapshot.generation
+        return snapshot
+
+
+class SharedSnapshotReader:
+    """Read side of `SharingGitLabRegistryCache` for worker processes.
+
+    The shared files are checked for changes at most every `check_interval` seconds (one `stat` call each); a new
+    snapshot is loaded once per generation and worker by one request thread while the others keep serving the current
+    snapshot.
+    """
+
+    def __init__(self, shared_snapshot_filename: str, check_interval: float = CHECK_INTERVAL) -> None:
+        self._shared_snapshot_filename = shared_snapshot_filename
+        self._check_interval = check_interval
+        self._snapshot = None  # type: Optional[RegistrySnapshot]
+        self._file_id = None  # type: Optional[Tuple[int, int]]
+        self._health = None  # type: Optional[RefreshHealth]
+        self._health_file_id = None  # type: Optional[Tuple[int, int]]
+        self._last_check_time = None  # type: Optional[float]
+        self._is_checking = False
+        self._lock = threading.Lock()
+
+    def _load_if_modified(self) -> Optional[Tuple[RegistrySnapshot, Tuple[int, int]]]:
+        """Return the shared snapshot and the id of its file if the file changed since the last load."""
+        stat_result = os.stat(self._shared_snapshot_filename)
+        file_id = (stat_result.st_ino, stat_result.st_mtime_ns)
+        if file_id == self._file_id:
+            return None
+        return read_shared_snapshot(self._shared_snapshot_filename), file_id
+
+    def _load_health_if_modified(self) -> Optional[Tuple[RefreshHealth, Tuple[int, int]]]:
+        health_filename = shared_health_filename(self._shared_snapshot_filename)
+        stat_result = os.stat(health_filename)
+        file_id = (stat_result.st_ino, stat_result.st_mtime_ns)
+        if file_id == self._health_file_id:
+            return None
+        return read_shared_health(health_filename), file_id
+
+    def _check(self) -> None:
+        now = time.monotonic()
+        if self._last_check_time is not None and now - self._last_check_time < self._check_interval:
+            return
+        with self._lock:
+            if self._is_checking or (
+                self._last_check_time is not None and now - self._last_check_time < self._check_interval
+            ):
+                return
+            self._is_checking = True
+        # Load without holding the lock, requests keep using the current snapshot meanwhile
+        snapshot_update = None  # type: Optional[Tuple[RegistrySnapshot, Tuple[int, int]]]
+        health_update = None  # type: Optional[Tuple[RefreshHealth, Tuple[int, int]]]
+        try:
+            try:
+                snapshot_update = self._load_if_modified()
+            except FileNotFoundError:
+                # The initial crawl has not succeeded yet
+                pass
+            except (OSError, ValueError, pickle.UnpicklingError) as e:
+                logger.warning('Could not load the shared snapshot, keeping the current one: %s', e)
+            try:
+                health_update = self._load_health_if_modified()
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning('Could not load the shared refresh health, keeping the current one: %s', e)
+        finally:
+            with self._lock:
+                if snapshot_update is not None:
+                    snapshot, self._file_id = snapshot_update
+                    if self._snapshot is None or snapshot.generation > self._snapshot.generation:
+                        self._snapshot = snapshot
+                        logger.info('Loaded shared snapshot generation %d', snapshot.generation)
+                if health_update is not None:
+                    self._health, self._health_file_id = health_update
+                self._last_check_time = now
+                self._is_checking = False
+
+    @property
+    def current_snapshot(self) -> Optional[RegistrySnapshot]:
+        """The latest shared snapshot, `None` until the refreshing process published the first one."""
+        self._check()
+        return self._snapshot
+
+    @property
+    def health(self) -> Optional[RefreshHealth]:
+        """The refresh health of the refreshing process, `None` until it published it."""
+        self._check()
+        return self._health
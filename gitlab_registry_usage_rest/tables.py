@@ -0,0 +1,158 @@
+import zlib
+from array import array
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence, Union, overload
+
+# A typed array, or a memoryview of the shared snapshot file with the same contents in worker processes
+Buffer = Union['array[int]', memoryview]
+
+
+class StringTable(Sequence[str]):
+    """Immutable sequence of strings in two flat buffers: the UTF-8 encoded strings, each followed by a newline (so the
+    strings must not contain newlines), and the start offset of every string plus the end of the data.
+
+    Both buffers are typed arrays, which the shared snapshot file stores as raw buffers, so worker processes read the
+    strings of a snapshot from the mapped file instead of a private copy (see `shared_snapshot`).
+    """
+
+    def __init__(self, strings: Iterable[str] = ()) -> None:
+        self._data = array('B')
+        self._offsets = array('Q', [0])
+        for string in strings:
+            self._data.frombytes((string + '\n').encode('utf-8'))
+            self._offsets.append(len(self._data))
+
+    @overload
+    def __getitem__(self, index: int) -> str:
+        pass
+
+    @overload
+    def __getitem__(self, index: slice) -> List[str]:
+        pass
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return str(self._data[self._offsets[index]:self._offsets[index + 1] - 1], 'utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        # Decoding all strings at once is much faster than one by one
+        return iter(str(self._data, 'utf-8').split('\n')[:-1])
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def extended(self, strings: Iterable[str]) -> 'StringTable':
+        """Return a table of the strings of this table followed by `strings` (this table is not changed)."""
+        table = StringTable()
+        table._data = self._data[:]
+        table._offsets = self._offsets[:]
+        for string in strings:
+            table._data.frombytes((string + '\n').encode('utf-8'))
+            table._offsets.append(len(table._data))
+        return table
+
+    def encoded(self, index: int) -> memoryview:
+        """Return the UTF-8 encoded string `index` without copying it."""
+        return memoryview(self._data)[self._offsets[index]:self._offsets[index + 1] - 1]
+
+    @property
+    def data(self) -> Buffer:
+        """The newline terminated strings."""
+        return self._data
+
+    @property
+    def offsets(self) -> Buffer:
+        return self._offsets
+
+
+class StringIndex:
+    """Maps the strings of a `StringTable` to their positions.
+
+    The hash table is a flat buffer as well (open addressing with linear probing on the CRC-32 of the encoded strings,
+    which unlike `hash` is the same in every process), so it is shared between processes like the table. The hash of
+    every slot is stored too, so only strings with the same hash are compared. If a string occurs more than once, the
+    first position is found.
+    """
+
+    def __init__(self, strings: StringTable) -> None:
+        self._strings = strings
+        slot_count = 2 * len(strings) + 1
+        # Position + 1 of the string in every slot, 0 for free slots
+        self._slots = array('I', bytes(4 * slot_count))
+        self._slot_hashes = array('I', bytes(4 * slot_count))
+        for position in range(len(strings)):
+            self._insert(position)
+
+    def _insert(self, position: int) -> None:
+        string_hash = zlib.crc32(self._strings.encoded(position))
+        slot = string_hash % len(self._slots)
+        while self._slots[slot] != 0:
+            slot = (slot + 1) % len(self._slots)
+        self._slots[slot] = position + 1
+        self._slot_hashes[slot] = string_hash
+
+    def extended(self, strings: StringTable) -> 'StringIndex':
+        """Return an index of `strings`, which must start with the strings of this index (this index is not changed).
+
+        Only the additional strings are inserted into a copy of the hash table, unless the table would be filled to more
+        than two thirds.
+        """
+        if 3 * len(strings) > 2 * len(self._slots):
+            return StringIndex(strings)
+        index = StringIndex(StringTable())
+        index._strings = strings
+        index._slots = self._slots[:]
+        index._slot_hashes = self._slot_hashes[:]
+        for position in range(len(self._strings), len(strings)):
+            index._insert(position)
+        return index
+
+    def find(self, string: str) -> Optional[int]:
+        """Return the position of `string` in the table (`None` if it is not in the table)."""
+        encoded_string = string.encode('utf-8')
+        string_hash = zlib.crc32(encoded_string)
+        slots, slot_hashes = self._slots, self._slot_hashes
+        data, offsets = self._strings.data, self._strings.offsets
+        slot = string_hash % len(slots)
+        while slots[slot] != 0:
+            if slot_hashes[slot] == string_hash:
+                position = slots[slot] - 1
+                if data[offsets[position]:offsets[position + 1] - 1].tobytes() == encoded_string:
+                    return position
+            slot = (slot + 1) % len(slots)
+        return None
+
+    @property
+    def strings(self) -> StringTable:
+        return self._strings
+
+
+def bisect_by_key(ids: Buffer, key_value: Any, key: Callable[[int], Any]) -> int:
+    """Return the position of the first id in `ids` (sorted by `key`) whose key is not less than `key_value`, like
+    `bisect.bisect_left` with the `key` argument of Python 3.10."""
+    low, high = 0, len(ids)
+    while low < high:
+        middle = (low + high) // 2
+        if key(ids[middle]) < key_value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def move_sorted_ids(
+    ids: 'array[int]', moved_ids: Iterable[int], previous_key: Callable[[int], Any], key: Callable[[int], Any]
+) -> None:
+    """Move `moved_ids` in `ids`, which are sorted by the unique `previous_key` of every id, to their position by `key`
+    (all other ids must have the same key before and after). Ids whose key is `None` are not in the sorted ids."""
+    moved_ids = list(moved_ids)
+    for moved_id in moved_ids:
+        previous_key_value = previous_key(moved_id)
+        if previous_key_value is not None:
+            del ids[bisect_by_key(ids, previous_key_value, previous_key)]
+    for moved_id in moved_ids:
+        key_value = key(moved_id)
+        if key_value is not None:
+            ids.insert(bisect_by_key(ids, key_value, key), moved_id)
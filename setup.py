@@ -23,7 +23,7 @@ setup(
     name="gitlab-registry-usage-rest",
     version=version,
     packages=find_packages(),
-    python_requires="~=3.6",
+    python_requires="~=3.7",
     install_requires=[
         "cheroot",
         "Flask",
@@ -35,7 +35,10 @@ setup(
         "gitlab-registry-usage>=0.3.3",
         "json2html",
         "ldap3",
+        "requests",
+        "urllib3>=1.26",
     ],
+    extras_require={"asgi": ["a2wsgi", "aiohttp", "uvicorn"], "speedups": ["brotli", "orjson", "zstandard"]},
     entry_points={"console_scripts": ["gitlab-registry-usage-rest = gitlab_registry_usage_rest.app:main"]},
     author="Ingo Meyer",
     author_email="i.meyer@fz-juelich.de",
@@ -52,7 +55,6 @@ setup(
         "Intended Audience :: System Administrators",
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",